@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+from __future__ import with_statement
 
 __author__ = 'Tzury Bar Yochay'
 __version__ = '0.1'
 __license__ = 'GPLv3'
 
-
-from __future__ import with_statement
 from snoipclient import SnoipClient
 import time
 from logger import log
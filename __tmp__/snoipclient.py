@@ -77,12 +77,12 @@ class SnoipClient(object):
             elif isinstance(msg, ServerForwardInvite):
                 self.ack_invite(msg)
             elif isinstance(msg, ServerForwardRing):
-                self.invited_ctx = msg.client_ctx.value
-                #print 'current call_ctx', repr(self.call_ctx), 'new call_ctx', repr(msg.call_ctx.value)
-                self.call_ctx = msg.call_ctx.value
+                self.invited_ctx = msg.client_ctx
+                #print 'current call_ctx', repr(self.call_ctx), 'new call_ctx', repr(msg.call_ctx)
+                self.call_ctx = msg.call_ctx
                 print 'ringing...'
             elif isinstance(msg, ClientAnswer):
-                self.invited_ctx = msg.client_ctx.value
+                self.invited_ctx = msg.client_ctx
                 print 'call was answered by other party...'
             elif isinstance(msg, ClientRTP):
                 self.rtp_received(msg)
@@ -98,9 +98,9 @@ class SnoipClient(object):
         
     def login_reply(self, msg):
         print 'snoipclient-login_reply'
-        self.client_ctx = msg.client_ctx.value
-        self.client_public_ip = msg.client_public_ip.value
-        self.client_public_port = msg.client_public_port.value
+        self.client_ctx = msg.client_ctx
+        self.client_public_ip = msg.client_public_ip
+        self.client_public_port = msg.client_public_port
         
     def invite(self, username):
         print 'snoipclient-invite'
@@ -109,7 +109,7 @@ class SnoipClient(object):
         
     def ack_invite(self, sfi):
         print 'snoipclient-ack_invite'
-        self.call_ctx = sfi.call_ctx.value
+        self.call_ctx = sfi.call_ctx
         data = client_invite_ack(sfi)
         self._send(data)
         time.sleep(3)
@@ -132,7 +132,7 @@ class SnoipClient(object):
         self._send(crtp.pack())
         
     def rtp_received(self, msg):
-        bytes = msg.rtp_bytes.value
+        bytes = msg.rtp_bytes
         with open(self.username + '_incoming_rtp', 'a') as f:
             f.write(bytes + '\n')
                 
@@ -188,12 +188,12 @@ def create_invite(ctx, username):
 def client_invite_ack(invite):
     cia = ClientInviteAck()
     cia.set_values(
-        client_ctx = invite.client_ctx.value,
-        call_ctx = invite.call_ctx.value, 
+        client_ctx = invite.client_ctx,
+        call_ctx = invite.call_ctx, 
         client_status = ClientStatus.Ringing,
-        client_public_ip = invite.client_public_ip.value, 
-        client_public_port = invite.client_public_port.value
+        client_public_ip = invite.client_public_ip, 
+        client_public_port = invite.client_public_port
     )
     
-    print 'client ack invite of call_ctx:', repr(invite.call_ctx.value)
+    print 'client ack invite of call_ctx:', repr(invite.call_ctx)
     return cia.pack()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+__author__ = 'Tzury Bar Yochay'
+__version__ = '0.1'
+__license__ = 'GPLv3'
+
+'''
+**************************************
+admin.py (part of freespeech.py)
+**************************************
+
+the admin endpoint, a twisted.web site on a port of its own
+(config.ADMIN_PORT), apart from the listeners the clients talk to.
+
+    /metrics          the metrics registry, prometheus text format
+    /metrics.json     the metrics registry, json
+
+    /ctx                      summary of the ctx_table
+    /ctx/clients              clients, by ctx, a page at a time
+    /ctx/clients/<ctx>        a single client
+    /ctx/users/<username>     the client logged in as username
+    /ctx/calls                calls, by ctx, a page at a time
+    /ctx/calls/<ctx>          a single call
+
+    POST /users/invalidate             reload the user directory
+    POST /users/invalidate/<username>  drop username, reread on its 
+                                       next lookup
+
+a page holds up to ?limit= entries (at most config.ADMIN_PAGE_LIMIT)
+in the order of their allocator slots, from ?cursor= on. the reply 
+carries the cursor of the next page, null on the last one. the ctx 
+queries walk the table on one of config.ADMIN_THREADS threads, the 
+reactor only writes the reply. when config.ADMIN_BACKLOG queries wait 
+already, the next is answered 503.
+
+keep config.ADMIN_INTERFACE on a private address.
+'''
+
+__all__ = ['MetricsResource', 'CtxResource', 'UsersResource', 'site', 
+    'listen']
+
+import json, threading, Queue
+
+from twisted.internet import reactor
+from twisted.web import resource, server, http
+
+import config, metrics, session, handoff
+from logger import log
+
+class BadRequest(ValueError):
+    pass
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry, as_json=False):
+        resource.Resource.__init__(self)
+        self.registry = registry
+        self.as_json = as_json
+
+    def render_GET(self, request):
+        if self.as_json:
+            request.setHeader('content-type', 'application/json')
+            return json.dumps(self.registry.snapshot(), sort_keys=True,
+                indent=1)
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.registry.text()
+
+class QueryPool(object):
+    '''a fixed number of threads running the queries of the admin 
+    requests, with a bounded queue in front of them'''
+    def __init__(self, size=config.ADMIN_THREADS, 
+        backlog=config.ADMIN_BACKLOG):
+        self.size = size
+        self.queue = Queue.Queue(backlog)
+        self.threads = []
+        
+    def submit(self, job):
+        '''queues job, returns False if the queue is full.
+        called on the reactor thread'''
+        if not self.threads:
+            self.start()
+        try:
+            self.queue.put_nowait(job)
+            return True
+        except Queue.Full:
+            return False
+            
+    def start(self):
+        for i in xrange(self.size):
+            thread = threading.Thread(target=self.run, name='admin-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+            
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job()
+            except:
+                log.exception('exception')
+                
+pool = QueryPool()
+
+def reply_in_thread(request, query, *args):
+    '''runs query(*args) on the query pool and replies with its 
+    result as json, 404 if it returns None, 503 if the pool is busy'''
+    gone = []
+    request.notifyFinish().addErrback(gone.append)
+    
+    def finish(code, body):
+        if gone:
+            return
+        request.setResponseCode(code)
+        request.setHeader('content-type', 'application/json')
+        request.write(body)
+        request.finish()
+        
+    def run():
+        try:
+            code, result = http.OK, query(*args)
+            if result is None:
+                code, result = http.NOT_FOUND, dict(error='not found')
+        except BadRequest, e:
+            code, result = http.BAD_REQUEST, dict(error=str(e))
+        except:
+            log.exception('exception')
+            code, result = (http.INTERNAL_SERVER_ERROR, 
+                dict(error='internal error'))
+        # the fields may hold raw bytes (codecs, statuses)
+        body = json.dumps(result, sort_keys=True, indent=1, 
+            encoding='latin-1')
+        reactor.callFromThread(finish, code, body)
+        
+    if not pool.submit(run):
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        request.setHeader('content-type', 'application/json')
+        return json.dumps(dict(error='busy'))
+    return server.NOT_DONE_YET
+    
+def _int_arg(request, name, default):
+    try:
+        return int(request.args.get(name, [default])[0])
+    except ValueError:
+        raise BadRequest('%s must be an integer' % name)
+        
+class CtxResource(resource.Resource):
+    '''queries of the ctx_table, see the module doc'''
+    isLeaf = True
+    
+    def __init__(self, table, ids, call_ids):
+        resource.Resource.__init__(self)
+        self.table = table
+        self.ids = ids
+        self.call_ids = call_ids
+        
+    def render_GET(self, request):
+        path = [part for part in request.postpath if part]
+        return reply_in_thread(request, self.query, path, request)
+        
+    def query(self, path, request):
+        table = self.table
+        if not path:
+            return table.summary()
+        kind, key = path[0], len(path) > 1 and path[1]
+        if kind == 'users' and key:
+            ctx = self.ids.lookup(key)
+            return ctx and table.describe_client(ctx)
+        if kind not in ('clients', 'calls') or len(path) > 2:
+            return None
+        describe = (kind == 'clients' and table.describe_client 
+            or table.describe_call)
+        if key:
+            try:
+                return describe(int(key))
+            except ValueError:
+                raise BadRequest('ctx must be an integer')
+                
+        limit = min(max(1, _int_arg(request, 'limit', 100)), 
+            config.ADMIN_PAGE_LIMIT)
+        if kind == 'clients':
+            keyed, ids = table, self.ids
+        else:
+            keyed, ids = table.active_calls, self.call_ids
+        ctxs, cursor = table.page(keyed, ids, _int_arg(request, 'cursor', 0), 
+            limit)
+        # entries removed since the page was taken are left out
+        entries = [entry for entry in map(describe, ctxs) if entry]
+        return {kind: entries, 'next_cursor': cursor}
+        
+class UsersResource(resource.Resource):
+    '''invalidates the user directory, after the users table was edited 
+    by hand (see dblayer.UserDirectory)'''
+    isLeaf = True
+    
+    def __init__(self, users):
+        resource.Resource.__init__(self)
+        self.users = users
+        
+    def render_POST(self, request):
+        path = [part for part in request.postpath if part]
+        request.setHeader('content-type', 'application/json')
+        if not path or path[0] != 'invalidate' or len(path) > 2:
+            request.setResponseCode(http.NOT_FOUND)
+            return json.dumps(dict(error='not found'))
+        username = len(path) > 1 and path[1] or None
+        self.users.invalidate(username)
+        log.info('user directory invalidated: %s' % (username or 'all'))
+        return json.dumps(dict(invalidated=username or 'all'))
+        
+def site(registry=metrics.registry):
+    root = resource.Resource()
+    root.putChild('metrics', MetricsResource(registry))
+    root.putChild('metrics.json', MetricsResource(registry, as_json=True))
+    root.putChild('ctx', CtxResource(session.ctx_table, session.client_ids, 
+        session.call_ids))
+    root.putChild('users', UsersResource(session.users))
+    return server.Site(root)
+
+def listen(port=config.ADMIN_PORT, interface=config.ADMIN_INTERFACE, 
+    skt=None):
+    '''starts serving the admin endpoint, returns the listening port. 
+    skt - the listening socket, handed over by another server'''
+    if skt:
+        listening = reactor.listenWith(handoff.AdoptedTCPPort, skt, site())
+    else:
+        listening = reactor.listenTCP(port, site(), interface=interface)
+    log.info('admin endpoint on %s:%d' % (interface,
+        listening.getHost().port))
+    return listening
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+from __future__ import with_statement
+
+__author__ = 'Tzury Bar Yochay'
+__version__ = '0.1'
+__license__ = 'GPLv3'
+
+'''
+**************************************
+allocator.py (part of freespeech.py)
+**************************************
+'''
+
+__all__ = ['CtxAllocator']
+
+import threading
+from array import array
+from logger import log
+
+# an id is (generation << SLOT_BITS) | slot, a positive 32 bit integer
+SLOT_BITS = 20
+MAX_SLOTS = 1 << SLOT_BITS
+SLOT_MASK = MAX_SLOTS - 1
+# generations run from 1, so no id is ever 0 (EMPTY_CTX)
+MAX_GENERATION = (1 << (31 - SLOT_BITS)) - 1
+
+class CtxAllocator(object):
+    '''Issues dense context ids, each tagged with the generation of its
+    slot. Releasing an id bumps the generation, so an id which was
+    released is never valid again, even after its slot is reused
+    (until the generation wraps, every MAX_GENERATION reuses of a slot).
+
+    An id may be bound to a key (a username, a pair of parties),
+    allocating the same key again returns the same id until it is
+    released.'''
+    def __init__(self, max_slots=MAX_SLOTS):
+        self.max_slots = min(max_slots, MAX_SLOTS)
+        # slot -> generation of the id in that slot, 0 for a free slot
+        self.generations = array('H')
+        # slot -> key of the id in that slot
+        self.keys = []
+        # (slot, its next generation) of the released slots, reused first
+        self.free = []
+        # key -> id
+        self.ids = dict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        '''ids in use'''
+        return len(self.generations) - len(self.free)
+
+    def __contains__(self, ctx):
+        return self.slot(ctx) is not None
+
+    def slot(self, ctx):
+        '''the slot of ctx, None if ctx was released or never issued'''
+        if ctx < MAX_SLOTS:
+            # generation 0, never issued
+            return None
+        slot = ctx & SLOT_MASK
+        if slot < len(self.generations) \
+            and self.generations[slot] == ctx >> SLOT_BITS:
+            return slot
+        return None
+
+    def lookup(self, key):
+        '''the id bound to key, None if there is none'''
+        return self.ids.get(key)
+
+    def key(self, ctx):
+        slot = self.slot(ctx)
+        if slot is not None:
+            return self.keys[slot]
+
+    def allocate(self, key=None):
+        '''returns the id bound to key, issues a new one if needed.
+        None if all the slots are taken'''
+        with self.lock:
+            if key is not None and key in self.ids:
+                return self.ids[key]
+
+            if self.free:
+                slot, generation = self.free.pop()
+            elif len(self.generations) < self.max_slots:
+                slot, generation = len(self.generations), 1
+                self.generations.append(0)
+                self.keys.append(None)
+            else:
+                log.warning('all %d context slots are taken'
+                    % self.max_slots)
+                return None
+
+            self.generations[slot] = generation
+            self.keys[slot] = key
+            ctx = (generation << SLOT_BITS) | slot
+            if key is not None:
+                self.ids[key] = ctx
+            return ctx
+
+    def release(self, ctx):
+        '''frees the slot of ctx, returns False if ctx was not valid'''
+        with self.lock:
+            slot = self.slot(ctx)
+            if slot is None:
+                return False
+            key = self.keys[slot]
+            if key is not None and self.ids.get(key) == ctx:
+                del self.ids[key]
+            self.keys[slot] = None
+            generation = self.generations[slot] + 1
+            if generation > MAX_GENERATION:
+                generation = 1
+            self.generations[slot] = 0
+            self.free.append((slot, generation))
+            return True
+
+    def issued(self, start=0):
+        '''(slot, id) of the ids in use from slot start on, in slot 
+        order. reads without the lock, an id issued or released meanwhile 
+        may be left out or not'''
+        generations = self.generations
+        slot = max(start, 0)
+        while slot < len(generations):
+            generation = generations[slot]
+            if generation:
+                yield slot, (generation << SLOT_BITS) | slot
+            slot += 1
+
+    def state(self):
+        '''(generations, free) of the slots, what restore() takes. 
+        reads without the lock, see snapshot.py'''
+        return self.generations.tostring(), list(self.free)
+
+    def restore(self, generations, free, keys):
+        '''takes back the state() of an allocator, keys is {id: key} of 
+        the ids to keep, every other id is released'''
+        with self.lock:
+            self.generations = array('H')
+            self.generations.fromstring(generations)
+            self.keys = [None] * len(self.generations)
+            self.free = list(free)
+            self.ids = dict()
+            for ctx, key in keys.iteritems():
+                slot = ctx & SLOT_MASK
+                if slot < len(self.generations) \
+                    and self.generations[slot] == ctx >> SLOT_BITS:
+                    self.keys[slot] = key
+                    if key is not None:
+                        self.ids[key] = ctx
+            keys = self.keys
+            for slot, generation in enumerate(self.generations):
+                if generation and keys[slot] is None:
+                    generation += 1
+                    if generation > MAX_GENERATION:
+                        generation = 1
+                    self.generations[slot] = 0
+                    self.free.append((slot, generation))
@@ -0,0 +1,1036 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+__author__ = 'Tzury Bar Yochay'
+__version__ = '0.1'
+__license__ = 'GPLv3'
+
+'''
+**************************************
+benchmarks.py (part of freespeech.py)
+**************************************
+
+micro benchmarks for the server hot paths.
+
+USAGE:
+$ python benchmarks.py              # run all
+$ python benchmarks.py messages     # run one
+'''
+
+import os, sys, time
+from timeit import Timer
+
+from messages import *
+from messagefields import IPField
+
+# sample values for every message on the wire
+samples = {
+    ShortResponse: dict(client_ctx=7, result=-257),
+    LoginRequest: dict(username_length=3, username='121',
+        password='a121----------------', local_ip='10.0.0.1',
+        local_port=5000),
+    LoginReply: dict(client_ctx=-5, client_public_ip='1.2.3.4',
+        client_public_port=50009, ctx_expire=60, num_of_codecs=3,
+        codec_list='\x01\x02\x03'),
+    AlternateServerMessage: dict(),
+    Logout: dict(client_ctx=99),
+    KeepAlive: dict(client_ctx=1, client_public_ip='127.0.0.1',
+        client_public_port=1),
+    KeepAliveAck: dict(client_ctx=1, expire=60, refresh_contact_list=0),
+    ClientInvite: dict(client_ctx=1, calle_name_length=3, calle_name='120',
+        num_of_codecs=2, codec_list='\x01\x02'),
+    ServerRejectInvite: dict(client_ctx=1, result=771),
+    ServerForwardInvite: dict(client_ctx=1, call_ctx=2, call_type=1,
+        client_name_length=3, client_name='121',
+        client_public_ip='8.8.8.8', client_public_port=3,
+        num_of_codecs=1, codec_list='\x01'),
+    ClientInviteAck: dict(client_ctx=1, call_ctx=2, client_status='\x02',
+        client_public_ip='9.9.9.9', client_public_port=4),
+    ServerForwardRing: dict(client_ctx=1, call_ctx=2, client_status='\x02',
+        call_type=1, client_public_ip='9.9.9.9', client_public_port=4),
+    ClientAnswer: dict(client_ctx=1, call_ctx=2, codec='\x01'),
+    ClientRTP: dict(client_ctx=1, call_ctx=2, sequence=3,
+        rtp_bytes_length=160, rtp_bytes='\xd5' * 160),
+    HangupRequest: dict(client_ctx=1, call_ctx=2),
+    HangupRequestAck: dict(client_ctx=1, call_ctx=2),
+    ServerOverloaded: dict(alternate_ip='4.4.4.4'),
+}
+
+def report(name, seconds, count, unit='op'):
+    print '%-40s %10.2f usec/%s' % (name, seconds * 1e6 / count, unit)
+
+def check_round_trip():
+    '''every entry in MessageTypes must survive pack -> parse -> decode'''
+    parser = Parser()
+    checked = 0
+    for type_code, ctr in sorted(MessageTypes.iteritems()):
+        # MessageTypes also holds its keyof() helper
+        if not isinstance(ctr, type):
+            continue
+        values = samples[ctr]
+        msg = ctr()
+        msg.set_values(**values)
+        msg_type, buf = parser.body(msg.pack())
+        decoded = MessageTypes[msg_type](buf=buf).dict_fields()
+        fields = dict(params[:2] for params in ctr.seq)
+        for name, value in values.iteritems():
+            if fields[name] is IPField:
+                value = IPField.encode(value)
+            assert decoded[name] == value, (ctr.__name__, name,
+                decoded[name], value)
+        checked += 1
+    print 'round trip ok for %d message types' % checked
+
+def bench_messages(number=100000):
+    check_round_trip()
+    for ctr in (KeepAlive, ServerForwardInvite, ClientRTP):
+        msg = ctr()
+        msg.set_values(**samples[ctr])
+        buf = msg.serialize()
+
+        t = Timer(lambda: msg.serialize()).timeit(number)
+        report('%s.serialize' % ctr.__name__, t, number)
+
+        t = Timer(lambda: ctr(buf=buf)).timeit(number)
+        report('%s(buf=...)' % ctr.__name__, t, number)
+
+def fill_ctx_table(table, num_of_clients, num_of_calls, 
+    client_type=None, call_type=None):
+    '''registers num_of_clients and pairs the first ones into calls'''
+    from session import ClientContext, CallContext, ClientStatus
+    ClientContext = client_type or ClientContext
+    CallContext = call_type or CallContext
+    for ctx in xrange(1, num_of_clients + 1):
+        table[ctx] = ClientContext(addr=('10.0.%d.%d' % (ctx / 256 % 256, 
+            ctx % 256), 5000 + ctx % 1000), status=ClientStatus.Active, 
+            expire=time.time() + 60, last_keep_alive=time.time(), 
+            ctx_id=ctx, current_call=None, client_name=str(ctx))
+            
+    for i in xrange(num_of_calls):
+        caller_ctx, callee_ctx = 2 * i + 1, 2 * i + 2
+        table.add_call(CallContext(caller_ctx=caller_ctx, 
+            callee_ctx=callee_ctx, start_time=time.time(), answer_time=0, 
+            end_time=0, rtp_expire=0, codec=None, ctx_id=-caller_ctx))
+    return table
+    
+def bench_ctx_table(number=100000, num_of_calls=50):
+    '''per packet lookup cost must not depend on registered clients'''
+    import session
+    for num_of_clients in (100, 1000, 10000, 100000):
+        table = fill_ctx_table(session.CtxTable(), num_of_clients, 
+            num_of_calls)
+        calls = [(call.caller_ctx, call.ctx_id) for call in table.calls()]
+        
+        def per_packet():
+            for client_ctx, call_ctx in calls:
+                # what the fast path and CallSession._handle_rtp look up
+                table.peer_addr(client_ctx, call_ctx)
+                table.find_call(call_ctx)
+                table.get_other_addr(client_ctx, call_ctx)
+                
+        t = Timer(per_packet).timeit(number / len(calls))
+        report('%6d clients, %d calls' % (num_of_clients, num_of_calls), 
+            t, number, 'packet')
+            
+def bench_ctx_ids(number=100000, num_of_users=1000000):
+    '''context ids: the allocator against the hashed usernames it replaced'''
+    from ctypes import c_int
+    from allocator import CtxAllocator
+    
+    def hashed_ctx(*args):
+        # string_to_ctx, as it was (its debug line formatted eagerly)
+        v = ''.join((str(arg) for arg in args))
+        h = c_int(hash(v)).value
+        'hashing %s as %d' % (repr(v), h)
+        return h
+        
+    t = Timer(lambda: hashed_ctx(1048577, 1048578)).timeit(number)
+    report('hashed call ctx', t, number, 'id')
+    
+    ids = CtxAllocator()
+    def cycle():
+        ids.release(ids.allocate((1048577, 1048578)))
+    t = Timer(cycle).timeit(number)
+    report('allocate + release', t, number, 'id')
+    
+    ctx = ids.allocate('120')
+    t = Timer(lambda: ids.lookup('120')).timeit(number)
+    report('username -> ctx', t, number, 'lookup')
+    t = Timer(lambda: ids.slot(ctx)).timeit(number)
+    report('ctx -> slot', t, number, 'lookup')
+    
+    names = ['user%d' % i for i in xrange(num_of_users)]
+    hashed = set(hashed_ctx(name) for name in names)
+    allocated = set(ids.allocate(name) for name in names)
+    print '%d usernames: %d hashed ids collide, %d allocated ids collide' % (
+        num_of_users, num_of_users - len(hashed), 
+        num_of_users - len(allocated))
+        
+def check_ctx_table(table):
+    '''returns the places where the indexes of table disagree 
+    with its clients'''
+    problems = []
+    for call_ctx, call in table.active_calls.items():
+        for ctx, other in ((call.caller_ctx, call.callee_ctx), 
+                (call.callee_ctx, call.caller_ctx)):
+            client = table.get(ctx)
+            if not client or client.current_call is not call:
+                problems.append('call %d is not current for %d' 
+                    % (call_ctx, ctx))
+            if table.peers.get(ctx) != other:
+                problems.append('peer of %d is not %d' % (ctx, other))
+    for ctx, client in table.items():
+        call = client.current_call
+        if call and table.active_calls.get(call.ctx_id) is not call:
+            problems.append('current call of %d is not active' % ctx)
+    for ctx, other in table.peers.items():
+        if table.peers.get(other) != ctx:
+            problems.append('peers %d, %d are not mutual' % (ctx, other))
+    return problems
+    
+def ctx_table_workload(table, ctxs, ops, seed):
+    '''random logins, invites, answers, hangups and logouts of ctxs'''
+    import random, session
+    rng = random.Random(seed)
+    now = time.time()
+    for i in xrange(ops):
+        a, b = rng.choice(ctxs), rng.choice(ctxs)
+        op = rng.random()
+        if op < 0.25:
+            table.add_client((a, session.ClientContext(
+                addr=('10.0.0.1', a % 65536), expire=now + 60, ctx_id=a)))
+        elif op < 0.5:
+            call_ctx = session.call_ids.allocate()
+            if a == b or not table.add_call(session.CallContext(
+                    caller_ctx=a, callee_ctx=b, ctx_id=call_ctx)):
+                session.call_ids.release(call_ctx)
+        elif op < 0.65:
+            table.mark_answer(a)
+        elif op < 0.9:
+            table.terminate_call(a)
+        else:
+            table.remove_client(a)
+            
+def bench_concurrency(ops=40000, num_of_clients=200):
+    '''stress test of CtxTable: handler threads hammer the same clients 
+    while another thread iterates the table, then the indexes are 
+    checked. compares the throughput with a single handler thread'''
+    import threading, logging, session
+    session.log.logger.setLevel(logging.CRITICAL)
+    session.cdr_logger.logger.setLevel(logging.CRITICAL)
+    ctxs = [session.client_ids.allocate('stress%d' % i) 
+        for i in xrange(num_of_clients)]
+        
+    for num_of_threads in (1, 2, 4, 8):
+        table = session.CtxTable()
+        done = threading.Event()
+        def iterate():
+            while not done.isSet():
+                table.clear_orphan_calls()
+                for client in table.clients():
+                    client.current_call
+                    
+        iterator = threading.Thread(target=iterate)
+        iterator.start()
+        handlers = [threading.Thread(target=ctx_table_workload, 
+            args=(table, ctxs, ops / num_of_threads, seed)) 
+            for seed in xrange(num_of_threads)]
+        start = time.time()
+        for handler in handlers:
+            handler.start()
+        for handler in handlers:
+            handler.join()
+        elapsed = time.time() - start
+        done.set()
+        iterator.join()
+        
+        problems = check_ctx_table(table)
+        print '%d handler threads %10.0f ops/sec, %d clients %d calls, %s' % (
+            num_of_threads, ops / elapsed, len(table), 
+            len(table.active_calls), 
+            problems and '%d problems: %s' % (len(problems), problems[:3]) 
+            or 'consistent')
+            
+def resident_memory():
+    '''bytes of resident memory of this process (linux)'''
+    import resource
+    return int(open('/proc/self/statm').read().split()[1]) \
+        * resource.getpagesize()
+        
+def ctx_memory(kind, num_of_clients, num_of_calls):
+    '''prints the bytes per client and per call of the ctx_table, 
+    with records of kind 'record' (slots) or 'storage' (dicts)'''
+    import gc, session
+    from utils import Storage
+    types = (None, None)
+    if kind == 'storage':
+        types = (Storage, Storage)
+        
+    gc.collect()
+    base = resident_memory()
+    table = fill_ctx_table(session.CtxTable(), num_of_clients, 0, *types)
+    gc.collect()
+    clients = resident_memory()
+    fill_ctx_table(table, 0, num_of_calls, *types)
+    gc.collect()
+    calls = resident_memory()
+    print '%-8s %8d bytes/client %8d bytes/call %8.1f ms/gc' % (kind, 
+        (clients - base) / num_of_clients, (calls - clients) / num_of_calls,
+        Timer(gc.collect).timeit(1) * 1e3)
+    
+def bench_ctx_memory(num_of_clients=200000, num_of_calls=100000):
+    '''memory of registered clients and active calls, each kind 
+    measured in a fresh process'''
+    import subprocess
+    print '%d clients, %d calls' % (num_of_clients, num_of_calls)
+    for kind in ('storage', 'record'):
+        subprocess.call([sys.executable, __file__, 'ctx_memory', kind, 
+            str(num_of_clients), str(num_of_calls)])
+
+def bench_packer(number=2000):
+    '''frames per read and reassembly of a large frame from small reads'''
+    import session
+    
+    class Discard(object):
+        def shedding(self, name):
+            return False
+            
+        def put(self, msg, block=True):
+            pass
+            
+    packer = session.Packer(Discard())
+    rtp = ClientRTP()
+    rtp.set_values(**samples[ClientRTP])
+    frame = rtp.pack()
+    
+    t = Timer(lambda: packer.pack(('127.0.0.1', 1), frame)).timeit(number)
+    report('single frame datagram', t, number, 'frame')
+    
+    burst = frame * 10
+    t = Timer(lambda: packer.pack(('127.0.0.1', 2), burst)).timeit(number)
+    report('10 frames per read', t, number * 10, 'frame')
+    
+    large = ClientRTP()
+    large.set_values(client_ctx=1, call_ctx=2, sequence=3, 
+        rtp_bytes_length=30000, rtp_bytes='\xd5' * 30000)
+    frame = large.pack()
+    chunks = [frame[i:i + 100] for i in xrange(0, len(frame), 100)]
+    def reassemble():
+        for chunk in chunks:
+            packer.pack(('127.0.0.1', 3), chunk)
+    t = Timer(reassemble).timeit(number / 20)
+    report('30KB frame in 100 byte reads', t, number / 20, 'frame')
+    
+def bench_udp_read(rounds=500, burst=200):
+    '''cost of reading rtp datagrams off an udp port, one 
+    datagramReceived call per datagram against a datagramsReceived 
+    batch read into the port's buffer. both handlers route every 
+    datagram, the first step of the relay'''
+    import socket
+    from twisted.internet import udp
+    from twisted.internet.interfaces import IBulkDatagramProtocol
+    from twisted.internet.protocol import DatagramProtocol
+    from zope.interface import implements
+    
+    class Single(DatagramProtocol):
+        received = 0
+        def datagramReceived(self, data, addr):
+            if rtp_route(data):
+                self.received += 1
+            
+    class Bulk(DatagramProtocol):
+        implements(IBulkDatagramProtocol)
+        received = 0
+        def datagramsReceived(self, datagrams):
+            for data, addr in datagrams:
+                if rtp_route(data):
+                    self.received += 1
+            
+    rtp = ClientRTP()
+    rtp.set_values(**samples[ClientRTP])
+    frame = rtp.pack()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for name, protocol in (('datagramReceived', Single()), 
+        ('datagramsReceived', Bulk())):
+        port = udp.Port(0, protocol, '127.0.0.1')
+        port.startListening()
+        port.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        addr = port.socket.getsockname()
+        elapsed = 0
+        for i in xrange(rounds):
+            for j in xrange(burst):
+                sender.sendto(frame, addr)
+            start = time.time()
+            port.doRead()
+            elapsed += time.time() - start
+        report('%s, %d byte datagrams' % (name, len(frame)), 
+            elapsed, protocol.received, 'datagram')
+        port.stopListening()
+        
+def bench_udp_write(seconds=2.0, num_of_peers=16, burst=50):
+    '''relayed rtp packets per second an udp port sends on loopback, 
+    with sendto and through sockets connected to the peers'''
+    import socket
+    from twisted.internet import udp
+    from twisted.internet.protocol import DatagramProtocol
+    
+    rtp = ClientRTP()
+    rtp.set_values(**samples[ClientRTP])
+    frame = rtp.pack()
+    peers = []
+    for i in xrange(num_of_peers):
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(('127.0.0.1', 0))
+        peer.setblocking(0)
+        peers.append(peer)
+    addrs = [peer.getsockname() for peer in peers]
+    
+    def drain():
+        for peer in peers:
+            try:
+                while True:
+                    peer.recv(8192)
+            except socket.error:
+                pass
+                
+    for mode in ('sendto', 'connected'):
+        port = udp.Port(0, DatagramProtocol(), '127.0.0.1')
+        if mode == 'connected':
+            port.maxPeers = num_of_peers
+        port.startListening()
+        if mode == 'connected':
+            for addr in addrs:
+                port.connectPeer(addr)
+        sent, elapsed = 0, 0
+        while elapsed < seconds:
+            start = time.time()
+            for addr in addrs:
+                for i in xrange(burst):
+                    port.write(frame, addr)
+            elapsed += time.time() - start
+            sent += len(addrs) * burst
+            drain()
+        print '%-40s %10.0f packets/sec' % ('%s, %d peers' % (
+            mode, num_of_peers), sent / elapsed)
+        port.stopListening()
+        
+def percentiles(samples, points=(50, 90, 99)):
+    samples = sorted(samples)
+    return [samples[min(len(samples) - 1, len(samples) * p / 100)] 
+        for p in points]
+        
+def run_server(mode, port, client):
+    '''runs the server with the given pipeline mode on port and client() 
+    on a thread of its own, the server stops once client() returns. 
+    runs in a child process since the reactor can not be restarted'''
+    import threading, logging
+    import session, serverfactory
+    from twisted.internet import reactor
+    
+    session.log.logger.setLevel(logging.WARNING)
+    session.use_pipeline(mode)
+    
+    def run_client():
+        try:
+            client()
+        finally:
+            session.thread_loop_active = False
+            session.stop_pipeline()
+            reactor.callFromThread(reactor.stop)
+            
+    for fn in session.pipeline_threads():
+        thread = threading.Thread(target=fn)
+        thread.setDaemon(True)
+        thread.start()
+    reactor.callLater(0.2, threading.Thread(target=run_client).start)
+    serverfactory.serve((('udp', port),))
+    
+def keep_alive_client(port):
+    '''a logged in socket and the keep-alive it may send'''
+    import socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(2)
+    client_ctx = login(sock, samples[LoginRequest]['username'], 
+        port).client_ctx
+    ka = KeepAlive()
+    ka.set_values(client_ctx=client_ctx, client_public_ip='127.0.0.1', 
+        client_public_port=0)
+    return sock, ka.pack()
+    
+def keep_alive_latency(mode, port=50119, count=2000):
+    '''measures the keep-alive round trip of a single client'''
+    def client():
+        sock, data = keep_alive_client(port)
+        rtts = []
+        for i in xrange(count):
+            start = time.time()
+            sock.sendto(data, ('127.0.0.1', port))
+            sock.recv(4096)
+            rtts.append(time.time() - start)
+        print '%-10s keep-alive rtt p50 %.3f p90 %.3f p99 %.3f msec' % (
+            (mode,) + tuple(t * 1e3 for t in percentiles(rtts)))
+    run_server(mode, port, client)
+    
+def outbound_load(batch, interval, port=50119, bursts=200, burst=64):
+    '''bursts of keep-alives through the threaded pipeline, with 
+    OUTBOUND_BATCH and OUTBOUND_FLUSH_INTERVAL set to batch and interval'''
+    import session
+    session.OUTBOUND_BATCH = batch
+    session.OUTBOUND_FLUSH_INTERVAL = interval
+    
+    def client():
+        sock, data = keep_alive_client(port)
+        session.reply_batcher.rates()
+        start = time.time()
+        for i in xrange(bursts):
+            for j in xrange(burst):
+                sock.sendto(data, ('127.0.0.1', port))
+            for j in xrange(burst):
+                sock.recv(4096)
+        elapsed = time.time() - start
+        per_batch, wakeups = session.reply_batcher.rates()
+        print ('batch %4d interval %5.3f %8.0f replies/sec %6.1f replies/batch'
+            ' %8.0f wakeups/sec' % (batch, interval, bursts * burst / elapsed, 
+                per_batch, wakeups))
+    run_server('threaded', port, client)
+    
+def bench_outbound():
+    '''reactor wakeups of the outbound stage by batch size and interval'''
+    import subprocess
+    for batch, interval in ((1, 0), (16, 0), (256, 0), (256, 0.001)):
+        subprocess.call([sys.executable, __file__, 'outbound_load', 
+            str(batch), str(interval)])
+            
+def bench_pipeline():
+    '''signaling round trip in the threaded and the inline pipeline'''
+    import subprocess
+    for mode in ('threaded', 'inline'):
+        subprocess.call([sys.executable, __file__, 'keep_alive_latency', mode])
+        
+def login_storm(port, seconds, rate):
+    '''sends logins of users 122-148 at rate per second for seconds, 
+    the replies are read and thrown away'''
+    import socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    logins = []
+    for user in xrange(122, 149):
+        msg = LoginRequest()
+        msg.set_values(username_length=3, username=str(user), 
+            password=('a%d' % user).ljust(20, '-'), local_ip='0.0.0.0', 
+            local_port=0)
+        logins.append(msg.pack())
+    sent, start = 0, time.time()
+    while time.time() - start < seconds:
+        due = int((time.time() - start) * rate)
+        while sent < due:
+            try:
+                sock.sendto(logins[sent % len(logins)], ('127.0.0.1', port))
+            except socket.error:
+                pass
+            sent += 1
+        try:
+            while True:
+                sock.recv(4096)
+        except socket.error:
+            time.sleep(0.001)
+    print sent
+    
+def keep_alive_probe(port, delay, seconds):
+    '''logs in, then after delay seconds sends a keep-alive every 
+    10 msec for seconds. prints the round trips and the keep-alives lost'''
+    import socket
+    sock, data = keep_alive_client(port)
+    sock.settimeout(0.5)
+    time.sleep(delay)
+    rtts, lost = [], 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        start = time.time()
+        sock.sendto(data, ('127.0.0.1', port))
+        try:
+            # the only replies this socket gets are keep-alive acks
+            sock.recv(4096)
+            rtts.append(time.time() - start)
+        except socket.timeout:
+            lost += 1
+        time.sleep(0.01)
+    answered = len(rtts)
+    rtts = rtts or [0]
+    print ('keep-alive rtt p50 %.1f p90 %.1f p99 %.1f max %.1f msec, '
+        '%d answered, %d lost' % (tuple(t * 1e3 
+            for t in percentiles(rtts) + [max(rtts)]) + (answered, lost)))
+    
+def saturation_load(admission, rate, seconds=5.0, port=50119):
+    '''keep-alive round trip of a client already logged in while logins 
+    pour in at rate per second, with admission control on or off. the 
+    client measures once the storm is a second old. the inbound queue 
+    stays bounded by the limit of its class (TRAFFIC_CLASSES) either way'''
+    import subprocess
+    import session
+    if admission == 'off':
+        session.admission.max_depth = session.admission.max_latency = 0
+        
+    def client():
+        probe = subprocess.Popen([sys.executable, __file__, 
+            'keep_alive_probe', str(port), '1.5', str(seconds - 1)], 
+            stdout=subprocess.PIPE)
+        time.sleep(0.5)
+        storm = subprocess.Popen([sys.executable, __file__, 'login_storm', 
+            str(port), str(seconds), str(rate)], stdout=subprocess.PIPE)
+        deepest = 0
+        while storm.poll() is None:
+            deepest = max(deepest, session.inbound_messages.qsize())
+            time.sleep(0.01)
+        sent = int(storm.communicate()[0] or 0)
+        print ('admission %-3s %6d logins/sec offered, %5d turned away, '
+            '%5d shed, deepest queue %5d' % (admission, sent / seconds, 
+                session.admission_rejected[LoginRequest].value, 
+                session.requests_shed.value, deepest))
+        print '              %s' % probe.communicate()[0].strip()
+    run_server('threaded', port, client)
+    
+def bench_saturation(rate=20000):
+    '''latency of a client already logged in while a login storm drives 
+    the threaded pipeline past saturation, without and with admission 
+    control'''
+    import subprocess
+    for admission in ('off', 'on'):
+        subprocess.call([sys.executable, __file__, 'saturation_load', 
+            admission, str(rate)])
+            
+def histogram_percentile(histogram, point):
+    '''the upper bound of the bucket holding the point-th percentile'''
+    count = sum(histogram.counts)
+    seen = 0
+    for bound, bucket in zip(histogram.bounds + (float('inf'),), 
+        histogram.counts):
+        seen += bucket
+        if seen * 100 >= count * point:
+            return bound
+    return 0
+    
+def priority_load(scheduling, burst, seconds=8, port=50119):
+    '''a loadgen.py run against the threaded pipeline with the rtp taking 
+    the queues (no media fast path), every party sending burst rtp packets 
+    each 20ms. scheduling is 'fifo', a single traffic class, or 'classes', 
+    TRAFFIC_CLASSES'''
+    import subprocess, tempfile, json
+    import session, serverfactory
+    serverfactory.UDPServer.mediaHandler = lambda self, addr, data: False
+    if scheduling == 'fifo':
+        session.TRAFFIC_CLASSES = (('signaling', 1, 12000, 0),)
+        session.traffic_class = lambda msg: 'signaling'
+        
+    def client():
+        output = tempfile.NamedTemporaryFile(suffix='.json')
+        subprocess.call([sys.executable, 'loadgen.py', '--port', str(port), 
+            '--duration', str(seconds), '--rtp-burst', str(burst), 
+            '--output', output.name], stdout=open(os.devnull, 'w'))
+        results = json.load(open(output.name))
+        latency = results['latency_ms']
+        print ('%-8s burst %2d %3d calls %6.0f rtp/sec, loss %5.1f%%, '
+            '%5d late %6d shed' % (scheduling, burst, 
+                results['calls']['completed'], results['rtp']['per_sec'], 
+                results['rtp']['loss'] * 100, 
+                sum(metric.value 
+                    for metric in session.inbound_late.values()),
+                session.requests_shed.value))
+        print ('         invite p50 %6.1f p99 %6.1f  ring p50 %6.1f p99 %6.1f '
+            ' signaling queued p99 < %5.1f msec' % (
+                latency['invite'].get('p50', 0), 
+                latency['invite'].get('p99', 0),
+                latency['ring'].get('p50', 0), latency['ring'].get('p99', 0),
+                histogram_percentile(
+                    session.inbound_wait['signaling'], 99) * 1e3))
+    run_server('threaded', port, client)
+    
+def bench_priority():
+    '''invite and ring latency as the rtp through the pipeline rises, 
+    one fifo for everything against signaling and media apart'''
+    import subprocess
+    for burst in (1, 8, 16, 32):
+        for scheduling in ('fifo', 'classes'):
+            subprocess.call([sys.executable, __file__, 'priority_load', 
+                scheduling, str(burst)])
+                
+def fill_session(num_of_clients, num_of_calls):
+    '''logs num_of_clients into the session table and pairs the first 
+    ones into answered calls, the ids come from the allocators'''
+    import session
+    from session import ClientContext, CallContext, ClientStatus
+    now = time.time()
+    ctxs = []
+    for i in xrange(num_of_clients):
+        name = 'user%d' % i
+        ctx = session.client_ids.allocate(name)
+        session.ctx_table[ctx] = ClientContext(addr=('10.%d.%d.%d' % (
+            i >> 16 & 255, i >> 8 & 255, i & 255), 5000 + i % 1000), 
+            status=ClientStatus.Active, expire=now + 60, 
+            last_keep_alive=now, ctx_id=ctx, current_call=None, 
+            client_name=name)
+        ctxs.append(ctx)
+    for i in xrange(num_of_calls):
+        caller_ctx, callee_ctx = ctxs[2 * i], ctxs[2 * i + 1]
+        session.ctx_table.add_call(CallContext(caller_ctx=caller_ctx, 
+            callee_ctx=callee_ctx, start_time=now, answer_time=now, 
+            end_time=0, rtp_expire=now + 20, codec='\x01', 
+            ctx_id=session.call_ids.allocate((caller_ctx, callee_ctx))))
+            
+def snapshot_load(path, limit):
+    '''restores the snapshot at path into the empty session table'''
+    import snapshot
+    data = open(path, 'rb').read()
+    start = time.time()
+    clients, calls = snapshot.load(data, limit)
+    print '%-40s %10.3f sec' % ('restore %d clients, %d calls' % (
+        clients, calls), time.time() - start)
+    
+def bench_snapshot(num_of_clients=100000, num_of_calls=50000):
+    '''snapshot of the session table and its restore in a new process'''
+    import subprocess, tempfile, snapshot
+    fill_session(num_of_clients, num_of_calls)
+    path = tempfile.mktemp(suffix='.snapshot')
+    try:
+        start = time.time()
+        data = snapshot.dump()
+        print '%-40s %10.3f sec, %d bytes' % ('dump %d clients, %d calls' % (
+            num_of_clients, num_of_calls), time.time() - start, len(data))
+        start = time.time()
+        pid = os.fork()
+        if pid == 0:
+            snapshot._write(path, data)
+            os._exit(0)
+        print '%-40s %10.1f msec' % ('fork, the pause of the server', 
+            (time.time() - start) * 1e3)
+        os.waitpid(pid, 0)
+        subprocess.call([sys.executable, __file__, 'snapshot_load', path, 
+            str(num_of_clients)])
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+            
+def bench_logging(number=20000):
+    '''cost of a log call on the calling thread, and of writing it'''
+    import logging, logger
+    addr = ('127.0.0.1', 50009)
+    
+    log = logger.Logger('snoip.bench', filename=os.devnull, stream=None)
+    t = Timer(lambda: log.debug('server received ', ClientRTP, ' to ', 
+        addr)).timeit(number)
+    report('log.debug, level disabled', t, number, 'call')
+    
+    start = time.time()
+    t = Timer(lambda: log.info('server received ', KeepAlive, ' to ', 
+        addr)).timeit(number)
+    report('log.info, queued', t, number, 'call')
+    log.flush()
+    report('log.info, queued and written', time.time() - start, number, 
+        'call')
+        
+    # what every log call did before, synchronous and formatted upfront
+    sync = logging.getLogger('snoip.bench.sync')
+    sync.propagate = False
+    sync.setLevel(logging.INFO)
+    handler = logging.FileHandler(os.devnull)
+    handler.setFormatter(log.file_frmt)
+    sync.addHandler(handler)
+    t = Timer(lambda: sync.debug(logger.theme.style_prompt 
+        + 'server received %s to %s' % (ClientRTP, repr(addr)) 
+        + logger.theme.style_normal)).timeit(number)
+    report('synchronous, debug disabled', t, number, 'call')
+    t = Timer(lambda: sync.info(logger.theme.style_yellow 
+        + 'server received %s to %s' % (KeepAlive, repr(addr)) 
+        + logger.theme.style_normal)).timeit(number)
+    report('synchronous, info', t, number, 'call')
+    
+def bench_metrics(number=200000):
+    '''cost of updating a metric on the hot path, and of reading them all'''
+    import metrics
+    registry = metrics.Registry()
+    counter = registry.counter('counter')
+    family = registry.family('family', 'type', keys=MessageTypes.values())
+    histogram = registry.family('histogram', 'type', 
+        kind=metrics.Histogram)
+    
+    t = Timer(lambda: counter.inc()).timeit(number)
+    report('counter', t, number, 'inc')
+    t = Timer(lambda: family[ClientRTP].inc()).timeit(number)
+    report('counter by message type', t, number, 'inc')
+    t = Timer(lambda: histogram[KeepAlive].observe(0.0003)).timeit(number)
+    report('histogram by message type', t, number, 'observe')
+    for i in xrange(20):
+        registry.gauge('gauge%d' % i, lambda: 1)
+    t = Timer(lambda: registry.text()).timeit(number / 1000)
+    report('registry as text', t, number / 1000, 'read')
+    
+def bench_db(number=1000):
+    '''user provisioning through db.DB, on a scratch database'''
+    import sqlite3, tempfile, shutil
+    from db import DB
+    path = tempfile.mkdtemp()
+    try:
+        dbname = os.path.join(path, 'bench.db')
+        db = DB(dbname)
+        db.use_wal()
+        db.close()
+        db.execute('CREATE TABLE users(username text, password text, '
+            'login_status int default 0)')
+        rows = [dict(username=str(i), password='a%d' % i) 
+            for i in xrange(number)]
+            
+        def open_per_statement():
+            # what every statement did before
+            for row in rows:
+                conn = sqlite3.connect(dbname)
+                conn.execute('INSERT INTO users (password, username) '
+                    'VALUES ("%(password)s", "%(username)s")' % row)
+                conn.commit()
+                conn.close()
+        t = Timer(open_per_statement).timeit(1)
+        report('connect, insert, commit', t, number, 'row')
+        
+        t = Timer(lambda: [db.insert('users', **row) for row in rows]
+            ).timeit(1)
+        report('db.insert', t, number, 'row')
+        
+        t = Timer(lambda: db.insert_many('users', rows)).timeit(1)
+        report('db.insert_many', t, number, 'row')
+        
+        t = Timer(lambda: list(db.select('SELECT * FROM users '
+            'WHERE username=?', ('7',)))).timeit(number)
+        report('db.select by username', t, number, 'query')
+        db.close()
+    finally:
+        shutil.rmtree(path)
+    
+def bench_users(number=10000):
+    '''user directory lookups, and picking up newly provisioned users'''
+    import sqlite3, tempfile, shutil
+    from db import DB
+    from dblayer import UserDirectory, migrate
+    path = tempfile.mkdtemp()
+    try:
+        dbname = os.path.join(path, 'bench.db')
+        db = DB(dbname)
+        db.use_wal()
+        db.close()
+        db.execute('CREATE TABLE users(username text, password text, '
+            'login_status int default 0)')
+        migrate(db)
+        db.insert_many('users', (dict(username=str(i), password='a%d' % i) 
+            for i in xrange(number)))
+        users = UserDirectory(limit=10 * number, database=db)
+        
+        t = Timer(lambda: users.get('7')).timeit(number)
+        report('get, cached', t, number, 'lookup')
+        t = Timer(lambda: users.get('nobody')).timeit(number / 10)
+        report('get, unknown user', t, number / 10, 'lookup')
+        t = Timer(users.refresh).timeit(number / 10)
+        report('refresh, nothing changed', t, number / 10, 'refresh')
+        
+        # provisioned by another process
+        other = sqlite3.connect(dbname)
+        other.executemany('INSERT INTO users (username, password) '
+            'VALUES (?, ?)', (('new%d' % i, 'p') for i in xrange(number)))
+        other.commit()
+        other.close()
+        t = Timer(users.refresh).timeit(1)
+        report('refresh, %d new users' % number, t, 1, 'refresh')
+        
+        other = sqlite3.connect(dbname)
+        other.execute("UPDATE users SET password='q' WHERE rowid <= 100")
+        other.execute('DELETE FROM users WHERE rowid > 100 AND rowid <= 200')
+        other.commit()
+        other.close()
+        t = Timer(users.refresh).timeit(1)
+        report('refresh, 100 updated, 100 deleted', t, 1, 'refresh')
+        assert users.get('0').password == 'q' and '100' not in users
+        t = Timer(users.reload).timeit(1)
+        report('reload of %d users' % len(users), t, 1, 'reload')
+        print users.stats
+        db.close()
+    finally:
+        shutil.rmtree(path)
+    
+def login(sock, username, port):
+    msg = LoginRequest()
+    msg.set_values(username_length=len(username), username=username, 
+        password=('a' + username).ljust(20, '-'), local_ip='0.0.0.0', 
+        local_port=0)
+    sock.sendto(msg.pack(), ('127.0.0.1', port))
+    return receive(sock)
+    
+def receive(sock):
+    msg_type, buf = Parser().body(sock.recv(8192))
+    return MessageTypes[msg_type](buf=buf)
+    
+def rtp_blaster(caller, callee, seconds=3.0, window=32, port=50009):
+    '''sets a call between two users and sends rtp from caller to callee 
+    for `seconds`, `window` packets in flight. prints the packets relayed'''
+    import socket
+    a, b = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in (0, 1)]
+    for sock in (a, b):
+        sock.settimeout(2)
+    caller_ctx = login(a, caller, port).client_ctx
+    callee_ctx = login(b, callee, port).client_ctx
+    
+    invite = ClientInvite()
+    invite.set_values(client_ctx=caller_ctx, calle_name_length=len(callee), 
+        calle_name=callee, num_of_codecs=1, codec_list='\x01')
+    a.sendto(invite.pack(), ('127.0.0.1', port))
+    call_ctx = receive(b).call_ctx
+    answer = ClientAnswer()
+    answer.set_values(client_ctx=callee_ctx, call_ctx=call_ctx, codec='\x01')
+    b.sendto(answer.pack(), ('127.0.0.1', port))
+    receive(a)
+    
+    rtp = ClientRTP()
+    rtp.set_values(client_ctx=caller_ctx, call_ctx=call_ctx, sequence=0,
+        rtp_bytes_length=160, rtp_bytes='\xd5' * 160)
+    data = rtp.pack()
+    relayed = 0
+    b.settimeout(0.5)
+    deadline = time.time() + seconds
+    try:
+        while time.time() < deadline:
+            for i in xrange(window):
+                a.sendto(data, ('127.0.0.1', port))
+            for i in xrange(window):
+                b.recv(8192)
+                relayed += 1
+    except socket.timeout:
+        pass
+    hangup = HangupRequest()
+    hangup.set_values(client_ctx=caller_ctx, call_ctx=call_ctx)
+    a.sendto(hangup.pack(), ('127.0.0.1', port))
+    print relayed
+    
+def bench_workers(num_of_calls=8, seconds=3.0):
+    '''relayed rtp packets per second with 1, 2 and 4 worker processes.
+    the server runs on config port (see server.py workers N), 
+    each call is driven by a process of its own'''
+    import subprocess, signal, multiprocessing
+    print 'cpus: %d' % multiprocessing.cpu_count()
+    devnull = open(os.devnull, 'w')
+    for num_of_workers in (1, 2, 4):
+        server = subprocess.Popen([sys.executable, 'server.py', 'workers', 
+            str(num_of_workers)], stdout=devnull, stderr=devnull)
+        try:
+            time.sleep(2)
+            blasters = [subprocess.Popen([sys.executable, __file__, 
+                'rtp_blaster', str(120 + 2 * i), str(121 + 2 * i), 
+                str(seconds)], stdout=subprocess.PIPE) 
+                for i in xrange(num_of_calls)]
+            relayed = sum(int(blaster.communicate()[0] or 0) 
+                for blaster in blasters)
+            print '%d workers, %d calls %12.0f packets/sec' % (
+                num_of_workers, num_of_calls, relayed / seconds)
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+            
+def bench_transcode(number=100000):
+    '''per packet cost of converting G.711 on the relay path, and the 
+    converted streams (calls, 50 packets/sec each way) one core relays'''
+    import audioop, g711, session
+    from config import Codecs
+    payload = samples[ClientRTP]['rtp_bytes']
+    table = g711.ALAW_TO_ULAW
+    
+    t = Timer(lambda: payload.translate(table)).timeit(number)
+    report('str.translate, 160 bytes', t, number, 'packet')
+    t = Timer(lambda: audioop.lin2ulaw(audioop.alaw2lin(payload, 2), 2)
+        ).timeit(number)
+    report('audioop through linear, 160 bytes', t, number, 'packet')
+    
+    msg = ClientRTP()
+    msg.set_values(**samples[ClientRTP])
+    fill_session(2, 1)
+    call = session.ctx_table.active_calls.values()[0]
+    msg.set_values(client_ctx=call.caller_ctx, call_ctx=call.ctx_id)
+    frame = msg.pack()
+    ctx_table = session.ctx_table
+    
+    def relay():
+        # what relay_rtp does with a datagram, up to sending it
+        client_ctx, call_ctx = rtp_route(frame)
+        call = ctx_table.find_call(call_ctx)
+        ctx_table.call_peer_addr(call, client_ctx)
+        table = call.caller_codec and session.rtp_table(call, client_ctx)
+        if table:
+            return rtp_translate(frame, table)
+        return frame
+        
+    for caller_codec in (None, Codecs.PCMU):
+        call.caller_codec = caller_codec
+        t = Timer(relay).timeit(number)
+        name = caller_codec and 'relay, converted' or 'relay, as is'
+        report(name, t, number, 'packet')
+        print '%-40s %10.0f streams/core' % (name, number / t / 100)
+        
+def bench_load(duration=10):
+    '''a short loadgen.py run against a local server, 
+    see loadgen.py for the full set of options'''
+    import subprocess
+    subprocess.call([sys.executable, 'loadgen.py', '--spawn', 
+        '--duration', str(duration)])
+        
+benchmarks = {
+    'load': bench_load,
+    'logging': bench_logging,
+    'messages': bench_messages,
+    'memory': bench_ctx_memory,
+    'metrics': bench_metrics,
+    'concurrency': bench_concurrency,
+    'ctx_ids': bench_ctx_ids,
+    'ctx_table': bench_ctx_table,
+    'transcode': bench_transcode,
+    'db': bench_db,
+    'packer': bench_packer,
+    'outbound': bench_outbound,
+    'pipeline': bench_pipeline,
+    'priority': bench_priority,
+    'snapshot': bench_snapshot,
+    'saturation': bench_saturation,
+    'udp_read': bench_udp_read,
+    'udp_write': bench_udp_write,
+    'users': bench_users,
+    'workers': bench_workers,
+}
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['keep_alive_latency']:
+        keep_alive_latency(sys.argv[2])
+        sys.exit(0)
+    elif sys.argv[1:2] == ['outbound_load']:
+        outbound_load(int(sys.argv[2]), float(sys.argv[3]))
+        sys.exit(0)
+    elif sys.argv[1:2] == ['ctx_memory']:
+        ctx_memory(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        sys.exit(0)
+    elif sys.argv[1:2] == ['login_storm']:
+        login_storm(int(sys.argv[2]), float(sys.argv[3]), 
+            float(sys.argv[4]))
+        sys.exit(0)
+    elif sys.argv[1:2] == ['keep_alive_probe']:
+        keep_alive_probe(int(sys.argv[2]), float(sys.argv[3]), 
+            float(sys.argv[4]))
+        sys.exit(0)
+    elif sys.argv[1:2] == ['saturation_load']:
+        saturation_load(sys.argv[2], float(sys.argv[3]))
+        sys.exit(0)
+    elif sys.argv[1:2] == ['priority_load']:
+        priority_load(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+    elif sys.argv[1:2] == ['snapshot_load']:
+        snapshot_load(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+    elif sys.argv[1:2] == ['rtp_blaster']:
+        rtp_blaster(sys.argv[2], sys.argv[3], float(sys.argv[4]))
+        sys.exit(0)
+        
+    for name in sys.argv[1:] or sorted(benchmarks):
+        print '== %s ==' % name
+        benchmarks[name]()
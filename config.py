@@ -13,9 +13,119 @@ from logger import log
 #60 Seconds
 CLIENT_EXPIRE = 60
 
+# answered calls with no media for that long are hung up
 RTP_EXPIRE = 20
 
-EMPTY_CTX = (0,) #'\x00'*16
+# a partial frame is kept per source up to that many bytes
+MAX_REASSEMBLY_BYTES = 65536
+
+# and dropped if not completed within that many seconds
+REASSEMBLY_TIMEOUT = 5
+
+# seconds between expiry checks, clients and calls expire on this resolution
+EXPIRY_TICK = 1
+
+# locks guarding the ctx_table, clients are spread over them by ctx
+LOCK_STRIPES = 64
+
+# how requests travel from the listeners to the handlers
+# 'threaded' - handlers run on the inbound thread, replies are sent 
+#              by the outbound thread
+# 'inline'   - handlers run on the reactor thread, no queues
+PIPELINE = 'threaded'
+
+# processes serving the udp listeners, see workers.py
+# worker 0 is the main process, the others relay media only
+WORKERS = 1
+
+# replies handed to the reactor at once, at most (threaded pipeline)
+OUTBOUND_BATCH = 256
+
+# seconds the outbound thread waits for more replies to fill a batch,
+# 0 sends whatever is ready
+OUTBOUND_FLUSH_INTERVAL = 0
+
+# classes of the requests and of the replies in the queues of the 
+# threaded pipeline, media is ClientRTP, signaling everything else. 
+# every class is queued apart and served by weighted round robin, 
+# see scheduler.py. (name, weight, limit, deadline):
+# weight   - items served in a row while the other classes wait
+# limit    - items waiting, at most. a request arriving at a full class 
+#            is dropped (admission control, below, turns new work away 
+#            well before that), the handlers wait for room for a reply
+# deadline - seconds an item may wait, it is dropped past that (0 - none)
+TRAFFIC_CLASSES = (
+    ('signaling', 8, 10000, 0),
+    ('media', 1, 2000, 0.1),
+)
+
+# admission control, see session.Admission. past any of these the server 
+# is overloaded and answers new logins and invites with ServerOverloaded, 
+# keep-alives, calls in progress and hangups are served as usual. 0 - no limit
+# signaling requests waiting for a handler
+ADMISSION_QUEUE_DEPTH = 200
+# seconds a handler takes, recent average
+ADMISSION_LATENCY = 0.05
+# calls in progress (invites only)
+ADMISSION_CALLS = 0
+# back to normal once the queue and the latency are under that share 
+# of their limit
+ADMISSION_RESUME = 0.5
+# the server overloaded clients are sent to, 0.0.0.0 - none
+ALTERNATE_SERVER_IP = '0.0.0.0'
+
+# bytes an udp listener reads in one reactor iteration, at most (twisted 
+# reads up to 256KB). the replies and the timers get their turn between 
+# the reads of a media burst, rather than after it
+UDP_READ_BYTES = 8 * 1024
+
+# connected sockets an udp listener may open, one per party of an 
+# established call, for the rtp relayed to that party (0 - none, all 
+# the datagrams are sent with sendto). every one takes a file descriptor
+UDP_PEER_SOCKETS = 0
+
+# the admin endpoint (metrics), see admin.py. 0 - not served, opt in 
+# with a port on a private interface
+ADMIN_PORT = 0
+ADMIN_INTERFACE = '127.0.0.1'
+# entries in a page of clients or calls, at most
+ADMIN_PAGE_LIMIT = 1000
+# threads running the ctx queries, and the queries waiting for one, 
+# at most (the rest are turned away with 503)
+ADMIN_THREADS = 2
+ADMIN_BACKLOG = 32
+
+# seconds between two probes of the reactor loop lag
+REACTOR_LAG_INTERVAL = 0.1
+
+# the session table is written to SNAPSHOT_PATH every SNAPSHOT_INTERVAL 
+# seconds and on shutdown, and restored on startup, so the clients stay 
+# logged in across a restart (see snapshot.py). '' - no snapshots, 
+# 0 - on shutdown only. e.g. '/var/lib/snoip/ctx.snapshot' and 30, a 
+# periodic snapshot forks the server
+SNAPSHOT_PATH = ''
+SNAPSHOT_INTERVAL = 0
+# an older snapshot (seconds) is not restored, its clients are gone
+SNAPSHOT_MAX_AGE = CLIENT_EXPIRE
+
+# a new server takes over the listeners and the session table of the
+# running one through this unix socket (see handoff.py). '' - no handoff.
+# keep it in a directory only the server's user may write to, 
+# e.g. '/var/run/snoip/handoff.sock'
+HANDOFF_SOCKET = ''
+# seconds the running server waits for the new one to serve,
+# it carries on by itself past that
+HANDOFF_TIMEOUT = 10
+# seconds the old server keeps sending the replies it still has
+HANDOFF_DRAIN = 1
+
+# True - a caller offering one G.711 codec (PCMA or PCMU) may call a 
+# client having only the other one, the server converts their media 
+# (see g711.py) on worker 0. the callee is offered the other codec too.
+# False - the callee is offered the codecs of the caller only
+TRANSCODE_G711 = False
+
+EMPTY_CTX = 0 #'\x00'*16
 
 NUM_OF_USERS = license.NUM_OF_USERS
 CONCURRENT_SESSIONS = license.CONCURRENT_SESSIONS
@@ -65,7 +65,12 @@ class Daemon:
         file(self.pidfile,'w+').write("%s\n" % pid)
     
     def delpid(self):
-        os.remove(self.pidfile)
+        # unless a process which replaced this one wrote its own pid
+        try:
+            if int(file(self.pidfile,'r').read().strip()) == os.getpid():
+                os.remove(self.pidfile)
+        except (IOError, ValueError):
+            pass
 
     def start(self):
         """
@@ -2,6 +2,8 @@
 # -*- coding: UTF-8 -*-
 
 
+from __future__ import with_statement
+
 __author__ = 'Tzury Bar Yochay'
 __version__ = '0.1'
 __license__ = 'GPLv3'
@@ -14,81 +16,165 @@ __license__ = 'GPLv3'
 '''
 __all__ = ['db']
 
-import sqlite3
+import sqlite3, threading, itertools
+from contextlib import contextmanager
 from utils import Storage
 from logger import log
 
+# prepared statements kept per connection
+STATEMENT_CACHE = 200
+
 class DB(object):
-    def __init__(self):
-        self.dbname = '.freespeech.db'
-        self.conn = None
+    '''one long lived connection per thread.
+    values always travel as parameters, so the sql text of a statement 
+    does not change between calls and the prepared statement is reused.
+    
+    every execute() commits, unless it runs inside a transaction():
+    
+        with db.transaction():
+            db.insert('users', username='120', password='...')
+            db.update('users', login_status=1, where='username=?', 
+                args=('120',))
+    '''
+    def __init__(self, dbname='.freespeech.db'):
+        self.dbname = dbname
+        self.local = threading.local()
+        
+    @property
+    def conn(self):
+        return getattr(self.local, 'conn', None)
         
     def connect(self, to=None):
-        try:
-            self.conn = sqlite3.connect(to or self.dbname)
-        except:
-            raise Exception('error connecting to db %s' % self.dbname)
+        '''returns the connection of the current thread, opens it once'''
+        if self.conn is None or to:
+            self.close()
+            try:
+                conn = sqlite3.connect(to or self.dbname, 
+                    cached_statements=STATEMENT_CACHE)
+                mode, = conn.execute('PRAGMA journal_mode').fetchone()
+                if mode == 'wal':
+                    # durable at checkpoints, safe against corruption
+                    conn.execute('PRAGMA synchronous=NORMAL')
+            except:
+                raise Exception('error connecting to db %s' 
+                    % (to or self.dbname))
+            self.local.conn = conn
+            self.local.depth = 0
+        return self.local.conn
+            
+    def use_wal(self):
+        '''switches the database to WAL mode, readers no longer wait for 
+        the writer. the mode is kept in the database file (next to it a 
+        -wal and a -shm file), so this is a one time migration, see 
+        `python server.py migrate`. returns the journal mode'''
+        for row in self.select('PRAGMA journal_mode=WAL'):
+            return row.journal_mode
             
     def cursor(self):
-        self.connect()
-        return self.conn.cursor()
+        return self.connect().cursor()
         
     def close(self):
         self.conn and self.conn.close()
-        self.conn = None
+        self.local.conn = None
+        
+    @contextmanager
+    def transaction(self):
+        '''commits everything executed within on exit, rolls it back 
+        on an exception. may be nested, the outermost one commits'''
+        conn = self.connect()
+        self.local.depth += 1
+        try:
+            yield conn
+        except:
+            self.local.depth -= 1
+            if not self.local.depth:
+                conn.rollback()
+            raise
+        else:
+            self.local.depth -= 1
+            if not self.local.depth:
+                conn.commit()
+                
+    def _commit(self, conn):
+        if not self.local.depth:
+            conn.commit()
         
     def insert(self, table, **kwargs):
-        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, 
-            ', '.join(kwargs.keys()),
-            ', '.join([self.sqlquote(v) for v in kwargs.values()]))
-        self.execute(sql)
+        names = sorted(kwargs)
+        self.execute(self._insert_sql(table, names), 
+            [kwargs[name] for name in names])
+            
+    def insert_many(self, table, rows):
+        '''inserts a sequence of dicts, all with the same keys'''
+        rows = iter(rows)
+        try:
+            first = rows.next()
+        except StopIteration:
+            return
+        names = sorted(first)
+        values = lambda row: [row[name] for name in names]
+        self.executemany(self._insert_sql(table, names), 
+            itertools.chain([values(first)], (values(row) for row in rows)))
+            
+    def _insert_sql(self, table, names):
+        return 'INSERT INTO %s (%s) VALUES (%s)' % (table, 
+            ', '.join(names), ', '.join('?' * len(names)))
         
-    def delete(self, table, where='1=0'):
+    def delete(self, table, where='1=0', args=()):
         sql = "DELETE FROM %s" % table
         if where:
             sql += " WHERE %s" % where
-        self.execute(sql)
+        self.execute(sql, args)
         if where == '1=0':
-            log.warnning('db delete - no deletion <%s>' % where)
+            log.warning('db delete - no deletion <%s>' % where)
         
-    def select(self, query):
+    def select(self, query, args=()):
         try:
             cur = self.cursor()
-            cur.execute(query)
+            cur.execute(query, args)
             names = [x[0] for x in cur.description]
-            row = cur.fetchone()
-            while row:
+            for row in cur:
                 yield Storage(dict(zip(names, row)))
-                row = cur.fetchone()
-            self.close()
+        except GeneratorExit:
+            # the caller stopped iterating
+            raise
         except:
             log.exception('db select error <%s>' % query)
-        finally:
-            self.close()
             
     def sqlquote(self, v):
+        '''not used by the queries of this module, which pass values as 
+        parameters. kept for building sql by hand'''
         if (isinstance(v, (int, float))):
             return str(v)
         return '"%s"' % v
         
-    def execute(self, sql):
+    def execute(self, sql, args=()):
         try:
-            self.connect()
-            self.conn.execute(sql)
-            self.conn.commit()
-            self.close()
+            conn = self.connect()
+            conn.execute(sql, args)
+            self._commit(conn)
         except:
             log.exception('db execute sql error <%s>' % sql)
+            if self.local.depth:
+                # let transaction() roll back
+                raise
+            
+    def executemany(self, sql, seq_of_args):
+        '''executes sql once for every sequence of args, 
+        all in a single transaction'''
+        try:
+            with self.transaction() as conn:
+                conn.executemany(sql, seq_of_args)
+        except:
+            log.exception('db executemany sql error <%s>' % sql)
         
-    def update(self, table, **kwargs):        
-        _update = 'UPDATE %s ' % table
-        _set = ' SET ' + ', '.join([
-            k + '=' + self.sqlquote(v) 
-            for k,v in kwargs.iteritems() 
-            if k != 'where'])
-                
-        _where = ('where' in kwargs and ' WHERE %s ' % kwargs['where']) or ''
-        
-        self.execute(_update + _set + _where)
+    def update(self, table, where=None, args=(), **kwargs):
+        '''where is an sql expression, args are its parameters'''
+        names = sorted(kwargs)
+        sql = 'UPDATE %s SET %s' % (table, 
+            ', '.join('%s=?' % name for name in names))
+        if where:
+            sql += ' WHERE %s' % where
+        self.execute(sql, [kwargs[name] for name in names] + list(args))
         
-db = DB()
\ No newline at end of file
+db = DB()
@@ -2,12 +2,14 @@
 # -*- coding: UTF-8 -*-
 
 
+from __future__ import with_statement
+
 __author__ = 'Tzury Bar Yochay'
 __version__ = '0.1'
 __license__ = 'GPLv3'
 
 
-import re
+import re, threading
 import config
 from db import db
 from utils import Storage
@@ -15,16 +17,176 @@ from logger import log
 
 __all__ = [
     'Users',
+    'UserDirectory',
+    'migrate',
 ]
 
-def users():
-    users = Storage()
-    for row in db.select(
-        'select * from users limit %d' % (config.NUM_OF_USERS)):
-        users[row.username] = row
-    return users
+# bumps the change counter of a row, to one above every other row
+_BUMP = ('BEGIN UPDATE users SET changed = '
+    '(SELECT max(changed) FROM users) + 1 WHERE rowid = new.rowid; END')
+
+def migrate(database=db):
+    '''one time changes to the users table (see `python server.py migrate`):
+    the username index, and a change counter, bumped by triggers on every 
+    insert and update, so UserDirectory.refresh() reads only the rows 
+    changed since its last run'''
+    columns = [row.name for row in database.select('PRAGMA table_info(users)')]
+    database.execute('CREATE INDEX IF NOT EXISTS users_username '
+        'ON users(username)')
+    if 'changed' not in columns:
+        database.execute('ALTER TABLE users '
+            'ADD COLUMN changed integer NOT NULL DEFAULT 0')
+    database.execute('CREATE INDEX IF NOT EXISTS users_changed '
+        'ON users(changed)')
+    database.execute('CREATE TRIGGER IF NOT EXISTS users_inserted '
+        'AFTER INSERT ON users ' + _BUMP)
+    # the bump itself is an update, leave it alone
+    database.execute('CREATE TRIGGER IF NOT EXISTS users_updated '
+        'AFTER UPDATE ON users WHEN new.changed = old.changed ' + _BUMP)
+
+class UserDirectory(object):
+    '''the users table, cached by username.
+    
+    refresh() is cheap unless the table has changed: it checks 
+    PRAGMA data_version first, which moves only when another connection 
+    wrote to the database. it then drops the users whose rows are gone 
+    and loads the rows inserted or updated since the last refresh, by 
+    their change counter (see migrate). on a table without the counter 
+    every change reloads the whole table. a username missing from the 
+    cache is looked up in the database, so a new user can log in even 
+    before the next refresh. invalidate() drops a user, or the whole 
+    cache, on demand (the admin endpoint, see admin.py). 
+    the directory only reads the table.'''
+    def __init__(self, limit=config.NUM_OF_USERS, database=db):
+        self.db = database
+        # username -> row
+        self.users = dict()
+        # rowid -> username, of the cached rows
+        self.names = dict()
+        self.limit = limit
+        # the table has the change counter
+        self.tracked = False
+        # the highest change counter loaded
+        self.changed = 0
+        # (connection, PRAGMA data_version) at the last refresh
+        self.version = None
+        self.reload_due = False
+        self.lock = threading.Lock()
+        self.stats = Storage(hits=0, misses=0, loaded=0, refreshes=0, 
+            reloads=0, dropped=0)
+        self.reload()
+        
+    def __len__(self):
+        return len(self.users)
+        
+    def __contains__(self, username):
+        return username in self.users
+        
+    def __iter__(self):
+        return iter(self.users.keys())
+        
+    def __getitem__(self, username):
+        user = self.get(username)
+        if user is None:
+            raise KeyError(username)
+        return user
+        
+    def get(self, username, default=None):
+        user = self.users.get(username)
+        if user is not None:
+            self.stats.hits += 1
+            return user
+            
+        self.stats.misses += 1
+        for user in self.db.select(
+            'SELECT rowid, * FROM users WHERE username=?', (username,)):
+            return self._add(user) or default
+        return default
+        
+    def invalidate(self, username=None):
+        '''drops username from the cache, it is reread on its next lookup.
+        without a username the whole table is reloaded by the next refresh'''
+        if username is None:
+            self.reload_due = True
+        else:
+            self._drop(username)
+            
+    def _drop(self, username):
+        user = self.users.pop(username, None)
+        if user is not None:
+            self.names.pop(user.rowid, None)
+            self.stats.dropped += 1
+        
+    def _add(self, user):
+        previous = self.names.get(user.rowid)
+        if previous is not None and previous != user.username:
+            # renamed
+            self._drop(previous)
+        if user.username not in self.users and len(self.users) >= self.limit:
+            log.warning('user %s exceeds the licensed %d users (ignored)' 
+                % (user.username, self.limit))
+            return None
+        self.users[user.username] = user
+        self.names[user.rowid] = user.username
+        self.stats.loaded += 1
+        return user
+        
+    def _version(self):
+        for row in self.db.select('PRAGMA data_version'):
+            return self.db.conn, row.data_version
+            
+    def _max_changed(self):
+        for row in self.db.select(
+            'SELECT coalesce(max(changed), 0) AS changed FROM users'):
+            return row.changed
+        
+    def reload(self):
+        '''loads the whole table'''
+        with self.lock:
+            self._reload()
+            
+    def _reload(self):
+        self.reload_due = False
+        self.version = self._version()
+        self.tracked = 'changed' in [row.name 
+            for row in self.db.select('PRAGMA table_info(users)')]
+        # before the rows, whatever changes meanwhile is above it
+        self.changed = self.tracked and self._max_changed() or 0
+        users, names = dict(), dict()
+        for user in self.db.select('SELECT rowid, * FROM users '
+            'ORDER BY rowid LIMIT ?', (self.limit,)):
+            users[user.username] = user
+            names[user.rowid] = user.username
+        # replaced at once, lookups never see a partial table
+        self.users, self.names = users, names
+        self.stats.loaded += len(users)
+        self.stats.reloads += 1
+            
+    def refresh(self):
+        '''drops the users deleted and loads the users inserted or 
+        updated since the last refresh'''
+        with self.lock:
+            version = self._version()
+            if version == self.version and not self.reload_due:
+                return
+            if self.reload_due or not self.tracked:
+                self._reload()
+                return
+            self.version = version
+            # a plain cursor, a row object per rowid costs as much as the 
+            # rest of the refresh
+            cursor = self.db.cursor()
+            cursor.execute('SELECT rowid FROM users')
+            rowids = set(row[0] for row in cursor)
+            for rowid in set(self.names) - rowids:
+                self._drop(self.names.get(rowid))
+            for user in self.db.select('SELECT rowid, * FROM users '
+                'WHERE changed > ? ORDER BY changed', (self.changed,)):
+                self._add(user)
+                self.changed = user.changed
+            self.stats.refreshes += 1
     
-Users = users()
+Users = UserDirectory()
 
 if __name__ == '__main__':
     for user in Users:
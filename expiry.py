@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+from __future__ import with_statement
+
+__author__ = 'Tzury Bar Yochay'
+__version__ = '0.1'
+__license__ = 'GPLv3'
+
+'''
+**************************************
+expiry.py (part of freespeech.py)
+**************************************
+'''
+
+__all__ = ['ExpiryWheel']
+
+import time, threading
+
+class ExpiryWheel(object):
+    '''Keys bucketed by the time slot in which they are due.
+
+    Entries are re-checked lazily: when a slot comes due every key in it
+    is asked for its current deadline, a key whose deadline has moved
+    forward is put back in a later slot. So pushing a deadline forward
+    (a keep-alive, an rtp packet) costs nothing but setting the deadline
+    itself, and every key is looked at about once per deadline.'''
+    def __init__(self, resolution=1, now=None):
+        self.resolution = resolution
+        self.buckets = dict()   # slot -> set of keys
+        self.slots = dict()     # key -> slot
+        # every slot up to and including current was processed
+        self.current = self._slot(now or time.time()) - 1
+        self.lock = threading.RLock()
+
+    def _slot(self, when):
+        return int(when // self.resolution)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def schedule(self, key, when):
+        '''make sure key is checked no later than `when`'''
+        with self.lock:
+            slot = max(self._slot(when), self.current + 1)
+            old = self.slots.get(key)
+            if old is not None:
+                if old <= slot:
+                    # checked earlier anyway, it will be moved then
+                    return
+                self.buckets[old].discard(key)
+
+            self.slots[key] = slot
+            self.buckets.setdefault(slot, set()).add(key)
+
+    def schedule_many(self, deadlines):
+        '''schedule() of every (key, when) of deadlines, at once'''
+        with self.lock:
+            earliest = self.current + 1
+            for key, when in deadlines:
+                slot = max(int(when // self.resolution), earliest)
+                old = self.slots.get(key)
+                if old is not None:
+                    if old <= slot:
+                        continue
+                    self.buckets[old].discard(key)
+                self.slots[key] = slot
+                self.buckets.setdefault(slot, set()).add(key)
+
+    def discard(self, key):
+        with self.lock:
+            slot = self.slots.pop(key, None)
+            if slot is not None:
+                self.buckets[slot].discard(key)
+
+    def expire(self, now, deadline_of):
+        '''returns the keys which are due by now.
+        deadline_of(key) returns the current deadline of key,
+        or None if key does not exist anymore'''
+        expired = []
+        with self.lock:
+            # only slots which are entirely in the past
+            last = self._slot(now) - 1
+            while self.current < last:
+                self.current += 1
+                for key in self.buckets.pop(self.current, ()):
+                    del self.slots[key]
+                    deadline = deadline_of(key)
+                    if deadline is None:
+                        continue
+                    elif deadline <= now:
+                        expired.append(key)
+                    else:
+                        self.schedule(key, deadline)
+        return expired
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+__author__ = 'Tzury Bar Yochay'
+__version__ = '0.1'
+__license__ = 'GPLv3'
+
+'''
+**************************************
+g711.py (part of freespeech.py)
+**************************************
+
+conversion between the two G.711 codecs, PCMA (A-law) and PCMU (µ-law).
+
+a G.711 sample is a single byte, so converting a payload is a lookup of
+every byte in a 256 entry table, done by str.translate on the whole
+payload at once. the tables are built on import, every code maps to the
+code of the other law whose level is the nearest.
+
+a call between a PCMA only and a PCMU only client is converted on the
+relay path (see session.relay_rtp and config.TRANSCODE_G711).
+'''
+
+__all__ = ['ALAW_TO_ULAW', 'ULAW_TO_ALAW', 'TABLES', 'OTHER', 'table',
+    'widen']
+
+import audioop, struct
+from bisect import bisect_left
+
+from config import Codecs
+
+def _levels(decode):
+    '''the linear level of every code, by code'''
+    return struct.unpack('=256h', decode(''.join(map(chr, xrange(256))), 2))
+
+def _nearest(source, target):
+    '''the table mapping the codes of source to the codes of target with
+    the nearest level, source and target are levels by code'''
+    codes = sorted(xrange(256), key=target.__getitem__)
+    levels = [target[code] for code in codes]
+    entries = []
+    for level in source:
+        i = bisect_left(levels, level)
+        j = min([j for j in (i - 1, i) if 0 <= j < 256],
+            key=lambda j: (abs(levels[j] - level), abs(levels[j])))
+        entries.append(chr(codes[j]))
+    return ''.join(entries)
+
+_alaw = _levels(audioop.alaw2lin)
+_ulaw = _levels(audioop.ulaw2lin)
+ALAW_TO_ULAW = _nearest(_alaw, _ulaw)
+ULAW_TO_ALAW = _nearest(_ulaw, _alaw)
+del _alaw, _ulaw
+
+# (from codec, to codec) -> table
+TABLES = {
+    (Codecs.PCMA, Codecs.PCMU): ALAW_TO_ULAW,
+    (Codecs.PCMU, Codecs.PCMA): ULAW_TO_ALAW }
+
+# codec -> the codec it converts to
+OTHER = dict(TABLES.keys())
+
+def table(source, target):
+    '''the table converting source to target, None if there is none'''
+    return TABLES.get((source, target))
+
+def widen(codecs):
+    '''(codecs, codec) if a client offering codecs (a list) can be offered
+    more by converting its media: codecs with the other G.711 codec added
+    last, and the G.711 codec of the client. (codecs, None) otherwise'''
+    ours = [codec for codec in codecs if codec in OTHER]
+    if len(ours) != 1:
+        return codecs, None
+    return codecs + [OTHER[ours[0]]], ours[0]
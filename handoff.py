@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+__author__ = 'Tzury Bar Yochay'
+__version__ = '0.1'
+__license__ = 'GPLv3'
+
+'''
+**************************************
+handoff.py (part of freespeech.py)
+**************************************
+
+a restart without downtime, a new server process takes over the
+listening sockets and the session table of the running one.
+
+the running server waits for the new one on a unix stream socket
+(config.HANDOFF_SOCKET, off unless set), which only its user may
+connect to. once the new server connects, the running one
+    - stops reading its listeners, whatever arrives meanwhile waits in
+      the kernel, on the very sockets the new server gets
+    - lets the inbound queue empty and takes a snapshot of the session
+      table (see snapshot.py)
+    - sends the listening sockets (SCM_RIGHTS) and the snapshot
+the new server restores the snapshot, serves on the sockets and says
+so, the old one sends the replies it still has and stops. if the new
+server does not serve within HANDOFF_TIMEOUT the old one reads its
+listeners again and carries on.
+
+every message on the unix socket is prefixed by its length:
+    new -> old   its pid (marshal)
+    old -> new   [(key, socket type)] (marshal), one socket each follows
+    old -> new   the snapshot
+    new -> old   SERVING
+
+the tcp connections open on the old server close with it, their clients
+connect again and find their context.
+'''
+
+__all__ = ['Handover', 'take_over', 'served', 'AdoptedUDPPort',
+    'AdoptedTCPPort']
+
+import os, time, socket, struct, marshal, fcntl, select
+from multiprocessing.reduction import send_handle, recv_handle
+
+from twisted.internet import reactor, udp, tcp
+from twisted.internet.threads import blockingCallFromThread
+
+import session, snapshot
+from config import HANDOFF_SOCKET, HANDOFF_TIMEOUT, HANDOFF_DRAIN, \
+    EXPIRY_TICK
+from logger import log
+
+LENGTH = struct.Struct('!I')
+SERVING = 'serving'
+
+def _send(sock, data):
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+def _recv_exactly(sock, size):
+    # never past the message, a socket may follow it
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('handoff connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def _recv(sock):
+    length, = LENGTH.unpack(_recv_exactly(sock, LENGTH.size))
+    return _recv_exactly(sock, length)
+
+def _ready(sock, writing=False):
+    '''waits for sock, the socket calls of multiprocessing do not honour
+    its timeout'''
+    if writing:
+        ready = select.select([], [sock], [], sock.gettimeout())[1]
+    else:
+        ready = select.select([sock], [], [], sock.gettimeout())[0]
+    if not ready:
+        raise socket.timeout('handoff timed out')
+
+def _send_socket(sock, fd, pid):
+    _ready(sock, True)
+    send_handle(sock, fd, pid)
+
+def _recv_socket(sock):
+    _ready(sock)
+    return recv_handle(sock)
+
+def _adopt(skt):
+    '''a socket received from another process, ready for the reactor'''
+    skt.setblocking(0)
+    flags = fcntl.fcntl(skt.fileno(), fcntl.F_GETFD)
+    fcntl.fcntl(skt.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return skt
+
+class AdoptedUDPPort(udp.Port):
+    '''an udp port on a socket bound by another process'''
+    def __init__(self, skt, proto, maxPacketSize=8192, reactor=None):
+        host, port = skt.getsockname()
+        udp.Port.__init__(self, port, proto, host, maxPacketSize, reactor)
+        self.adopted = skt
+
+    def _bindSocket(self):
+        skt = _adopt(self.adopted)
+        self._realPortNumber = skt.getsockname()[1]
+        self.connected = 1
+        self.socket = skt
+        self.fileno = skt.fileno
+
+class AdoptedTCPPort(tcp.Port):
+    '''a tcp port on a socket another process listens on'''
+    def __init__(self, skt, factory, backlog=50, reactor=None):
+        host, port = skt.getsockname()
+        tcp.Port.__init__(self, port, factory, backlog, host, reactor)
+        self.adopted = skt
+
+    def startListening(self):
+        skt = _adopt(self.adopted)
+        self._realPortNumber = skt.getsockname()[1]
+        self.factory.doStart()
+        self.connected = True
+        self.socket = skt
+        self.fileno = skt.fileno
+        self.numberAccepts = 100
+        self.startReading()
+
+def _pause(ports):
+    '''stops reading ports, on the reactor. the udp peer sockets (see
+    udp.Port.connectPeer) are not handed over, they are closed and the
+    media of their peers goes back to the listener'''
+    for port in ports:
+        port.stopReading()
+        if isinstance(port, udp.Port):
+            for addr in port.getPeers():
+                port.disconnectPeer(addr)
+
+def _resume(ports):
+    for port in ports:
+        port.startReading()
+
+class Handover(object):
+    '''the running server's end. listening() returns {key: listening
+    port} of the ports to hand over, stop() is called on the reactor
+    once a new server took over and the replies were sent'''
+    def __init__(self, listening, stop, path=HANDOFF_SOCKET,
+        timeout=HANDOFF_TIMEOUT, drain=HANDOFF_DRAIN):
+        self.listening = listening
+        self.stop = stop
+        self.path = path
+        self.timeout = timeout
+        self.drain = drain
+
+    def loop(self):
+        '''waits for a new server, runs on a thread of its own'''
+        try:
+            if os.path.exists(self.path):
+                # left behind by a previous run, or by the server this
+                # one took over from
+                os.unlink(self.path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(self.path)
+            # whoever connects gets the session table, nobody can
+            # before listen()
+            os.chmod(self.path, 0600)
+            server.listen(1)
+            server.settimeout(EXPIRY_TICK)
+            while session.thread_loop_active:
+                try:
+                    conn, addr = server.accept()
+                except socket.timeout:
+                    continue
+                if self.hand_over(conn):
+                    break
+            server.close()
+
+            log.info('terminating thread: handoff')
+        except:
+            log.exception('exception')
+
+    def _pause(self):
+        ports = self.listening().items()
+        _pause([port for key, port in ports])
+        return ports
+
+    def _wait(self, busy):
+        '''waits up to drain seconds for busy() to turn False'''
+        deadline = time.time() + self.drain
+        while busy() and time.time() < deadline:
+            time.sleep(0.001)
+
+    def hand_over(self, conn):
+        '''True once the new server on conn serves, False if this one
+        carries on'''
+        ports = None
+        try:
+            conn.settimeout(self.timeout)
+            pid = marshal.loads(_recv(conn))
+            log.info('server %d takes over' % pid)
+            ports = blockingCallFromThread(reactor, self._pause)
+            started = time.time()
+            # the snapshot holds what the requests read so far changed
+            self._wait(lambda: session.queue_depth(session.inbound_messages))
+            data = snapshot.dump()
+            _send(conn, marshal.dumps([(key, port.socketType)
+                for key, port in ports]))
+            for key, port in ports:
+                _send_socket(conn, port.fileno(), pid)
+            _send(conn, data)
+            if _recv(conn) != SERVING:
+                raise ValueError('unexpected handoff reply')
+            paused = time.time() - started
+        except:
+            log.exception('exception')
+            if ports:
+                reactor.callFromThread(_resume,
+                    [port for key, port in ports])
+                log.warning('handoff failed, serving on')
+            return False
+        finally:
+            conn.close()
+
+        log.info('server %d took over %d listeners, %d clients, %d calls, '
+            'the listeners paused for %.1f msec' % (pid, len(ports),
+                len(session.ctx_table), len(session.ctx_table.active_calls),
+                paused * 1e3))
+        self._wait(lambda: session.queue_depth(session.outbound_messages)
+            or session.reply_batcher.pending)
+        reactor.callFromThread(self.stop)
+        return True
+
+def take_over(path=HANDOFF_SOCKET, timeout=HANDOFF_TIMEOUT):
+    '''the new server's end, takes the listening sockets and the session
+    table (restored) of the server running at path. call it before the
+    listeners open. returns the connection, see served(), and the
+    sockets, {key: socket}'''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    conn.connect(path)
+    _send(conn, marshal.dumps(os.getpid()))
+    sockets = dict()
+    for key, socket_type in marshal.loads(_recv(conn)):
+        fd = _recv_socket(conn)
+        sockets[key] = socket.fromfd(fd, socket.AF_INET, socket_type)
+        os.close(fd)
+
+    started = time.time()
+    clients, calls = snapshot.load(_recv(conn))
+    log.info('took over %d listeners, %d clients, %d calls restored in '
+        '%.3f sec' % (len(sockets), clients, calls, time.time() - started))
+    return conn, sockets
+
+def served(conn):
+    '''tells the old server this one serves, once the reactor runs'''
+    try:
+        _send(conn, SERVING)
+    except:
+        log.exception('exception')
+    finally:
+        conn.close()
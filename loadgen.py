@@ -0,0 +1,602 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+from __future__ import with_statement
+
+__author__ = 'Tzury Bar Yochay'
+__version__ = '0.1'
+__license__ = 'GPLv3'
+
+'''
+**************************************
+loadgen.py (part of freespeech.py)
+**************************************
+
+load generator, drives many simulated clients against a server from a
+single reactor: every client logs in, sends keep-alives, and the clients
+are paired into calls (invite, ring, answer, 20ms rtp both ways, hangup)
+over and over until the run is over, then they log out.
+
+it reports the signaling and rtp throughput, the latency of every
+signaling step, the one-way delay and the loss of the rtp, and writes
+the results as json so runs of different commits can be compared.
+
+the clients are the users first_user, first_user + 1, ... and log in
+with the password of the test users ('a' + username, padded with '-'),
+the server accepts as many of them as its license allows
+(config.NUM_OF_USERS). every client has a socket of its own, mind the
+open files limit (ulimit -n) when running thousands of them.
+
+USAGE:
+$ python loadgen.py                               # against a running server
+$ python loadgen.py --spawn --clients 28 --duration 30
+$ python loadgen.py --output new.json --compare old.json
+$ python loadgen.py --spawn --duration 20 --takeover-at 10
+
+--takeover-at has a new server take over from the running one in the
+middle of the run (see handoff.py), the rtp loss is what it cost. it
+needs config.HANDOFF_SOCKET.
+'''
+
+__all__ = ['LoadGenerator', 'SimulatedClient', 'Call', 'Stats']
+
+import os, sys, time, json, random, signal, struct, subprocess
+from optparse import OptionParser
+
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import LoopingCall
+
+import config
+from config import ClientStatus, Codecs
+from messages import *
+from logger import log
+
+# every rtp payload starts with the time it was sent
+TIMESTAMP = struct.Struct('!d')
+# a 20ms frame of G.711
+RTP_PAYLOAD = 160
+RTP_INTERVAL = 0.02
+
+def percentiles(samples, points=(50, 90, 99)):
+    '''{'p50': .., 'p90': .., 'p99': .., 'max': ..} of samples, in ms'''
+    if not samples:
+        return dict(count=0)
+    samples = sorted(samples)
+    result = dict(('p%d' % point,
+        round(samples[min(len(samples) - 1, len(samples) * point // 100)]
+            * 1000, 3)) for point in points)
+    result.update(count=len(samples), max=round(samples[-1] * 1000, 3))
+    return result
+
+class Reservoir(object):
+    '''a uniform sample of at most size values out of all those added'''
+    def __init__(self, size=100000):
+        self.size = size
+        self.values = []
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < self.size:
+                self.values[index] = value
+
+class Stats(object):
+    '''what a run measured'''
+    def __init__(self):
+        # message name -> count
+        self.sent = dict()
+        self.received = dict()
+        # signaling step -> Reservoir of seconds
+        self.latency = dict()
+        # rtp one-way delays, seconds
+        self.delays = Reservoir()
+        # kind -> count
+        self.errors = dict()
+        self.logged_in = 0
+        self.calls = 0
+
+    def count(self, table, key):
+        table[key] = table.get(key, 0) + 1
+
+    def measure(self, step, seconds):
+        if step not in self.latency:
+            self.latency[step] = Reservoir()
+        self.latency[step].add(seconds)
+
+    def error(self, kind):
+        self.count(self.errors, kind)
+
+    def results(self, elapsed):
+        rtp_sent = self.sent.get('ClientRTP', 0)
+        rtp_received = self.received.get('ClientRTP', 0)
+        signaling_sent = sum(self.sent.values()) - rtp_sent
+        signaling_received = sum(self.received.values()) - rtp_received
+        return dict(
+            elapsed=round(elapsed, 3),
+            clients=dict(logged_in=self.logged_in),
+            calls=dict(completed=self.calls,
+                per_sec=round(self.calls / elapsed, 2)),
+            signaling=dict(sent=signaling_sent, received=signaling_received,
+                per_sec=round((signaling_sent + signaling_received)
+                    / elapsed, 1)),
+            latency_ms=dict((step, percentiles(reservoir.values))
+                for step, reservoir in self.latency.items()),
+            rtp=dict(sent=rtp_sent, received=rtp_received,
+                loss=round(1 - float(rtp_received) / rtp_sent, 6)
+                    if rtp_sent else 0,
+                per_sec=round((rtp_sent + rtp_received) / elapsed, 1),
+                delay_ms=percentiles(self.delays.values)),
+            messages=dict(sent=self.sent, received=self.received),
+            errors=self.errors)
+
+class Call(object):
+    '''a call between two simulated clients, and the step it waits for'''
+    def __init__(self, caller, callee):
+        self.caller = caller
+        self.callee = callee
+        self.ctx = None
+        # (step, the time the request of that step was sent)
+        self.pending = None
+        self.established = False
+
+    def expect(self, step):
+        self.pending = (step, time.time())
+
+    def reached(self, stats, step):
+        '''the call got to step, measures it. False if it was not
+        waiting for step'''
+        if not self.pending or self.pending[0] != step:
+            stats.error('unexpected_' + step)
+            return False
+        stats.measure(step, time.time() - self.pending[1])
+        self.pending = None
+        return True
+
+class SimulatedClient(DatagramProtocol):
+    '''a client with a socket of its own'''
+    def __init__(self, generator, username):
+        self.generator = generator
+        self.stats = generator.stats
+        self.username = username
+        self.password = ('a' + username).ljust(20, '-')
+        self.ctx = None
+        self.call = None
+        self.sequence = 0
+        # the login or the keep-alive in flight, with the time it was sent
+        self.pending = None
+        self.next_keep_alive = None
+        self.parser = Parser()
+
+    def send(self, msg):
+        self.stats.count(self.stats.sent, msg.__class__.__name__)
+        self.transport.write(msg.pack(), self.generator.server)
+
+    def login(self):
+        msg = LoginRequest()
+        msg.set_values(username_length=len(self.username),
+            username=self.username, password=self.password,
+            local_ip='0.0.0.0', local_port=0)
+        self.pending = ('login', time.time())
+        self.send(msg)
+
+    def logout(self):
+        if self.ctx:
+            msg = Logout()
+            msg.set_values(client_ctx=self.ctx)
+            self.send(msg)
+            self.ctx = None
+
+    def keep_alive(self, now):
+        msg = KeepAlive()
+        msg.set_values(client_ctx=self.ctx, client_public_ip='0.0.0.0',
+            client_public_port=0)
+        self.pending = ('keep_alive', now)
+        self.next_keep_alive = now + self.generator.keep_alive
+        self.send(msg)
+
+    def send_rtp(self, now):
+        self.sequence += 1
+        msg = ClientRTP()
+        msg.set_values(client_ctx=self.ctx, call_ctx=self.call.ctx,
+            sequence=self.sequence, rtp_bytes_length=RTP_PAYLOAD,
+            rtp_bytes=TIMESTAMP.pack(now).ljust(RTP_PAYLOAD, '\xd5'))
+        self.send(msg)
+
+    def signal(self, message_type, **values):
+        msg = message_type()
+        msg.set_values(client_ctx=self.ctx, call_ctx=self.call.ctx,
+            **values)
+        self.send(msg)
+
+    def datagramReceived(self, data, addr):
+        try:
+            msg_type, buf = self.parser.body(data)
+            msg = MessageTypes[msg_type](buf=buf)
+            self.stats.count(self.stats.received, msg.__class__.__name__)
+            self.handlers.get(msg.__class__, SimulatedClient.unexpected)(
+                self, msg)
+        except:
+            self.stats.error('bad_message')
+            log.exception('exception')
+
+    def _reply_to(self, step):
+        '''measures the reply to the login or keep-alive in flight'''
+        if not self.pending or self.pending[0] != step:
+            self.stats.error('unexpected_' + step)
+            return False
+        self.stats.measure(step, time.time() - self.pending[1])
+        self.pending = None
+        return True
+
+    def login_reply(self, msg):
+        if self._reply_to('login'):
+            self.ctx = msg.client_ctx
+            self.generator.logged_in(self)
+
+    def short_response(self, msg):
+        if self.pending and self.pending[0] == 'login':
+            self.pending = None
+            self.stats.error('login_rejected')
+            self.generator.login_failed(self)
+        else:
+            self.stats.error('short_response')
+
+    def keep_alive_ack(self, msg):
+        self._reply_to('keep_alive')
+
+    def reject_invite(self, msg):
+        self.stats.error('invite_rejected')
+        if self.call and self.call.caller is self:
+            self.generator.call_failed(self.call)
+
+    def forward_invite(self, msg):
+        '''callee, the caller's invite'''
+        call = self.call
+        if call and call.callee is self and call.reached(self.stats,
+            'invite'):
+            call.ctx = msg.call_ctx
+            call.expect('ring')
+            self.signal(ClientInviteAck, client_status=ClientStatus.Ringing,
+                client_public_ip=msg.client_public_ip,
+                client_public_port=msg.client_public_port)
+
+    def forward_ring(self, msg):
+        '''caller, the callee is ringing, the callee answers right away'''
+        call = self.call
+        if call and call.caller is self and call.reached(self.stats, 'ring'):
+            call.ctx = msg.call_ctx
+            call.expect('answer')
+            call.callee.signal(ClientAnswer, codec=Codecs.values()[0])
+
+    def answer(self, msg):
+        '''caller, the call is established'''
+        call = self.call
+        if call and call.caller is self and call.reached(self.stats,
+            'answer'):
+            self.generator.established(call)
+
+    def rtp(self, msg):
+        self.stats.delays.add(
+            time.time() - TIMESTAMP.unpack_from(msg.rtp_bytes)[0])
+
+    def hangup(self, msg):
+        '''callee, the caller hung up'''
+        if self.call and self.call.callee is self:
+            self.signal(HangupRequestAck)
+
+    def hangup_ack(self, msg):
+        '''caller, the callee acked the hangup, the call is over'''
+        call = self.call
+        if call and call.caller is self and call.reached(self.stats,
+            'hangup'):
+            self.generator.call_ended(call)
+
+    def overloaded(self, msg):
+        self.stats.error('overloaded')
+
+    def unexpected(self, msg):
+        self.stats.error('unexpected_' + msg.__class__.__name__)
+
+    handlers = {
+        LoginReply: login_reply,
+        ShortResponse: short_response,
+        KeepAliveAck: keep_alive_ack,
+        ServerRejectInvite: reject_invite,
+        ServerForwardInvite: forward_invite,
+        ServerForwardRing: forward_ring,
+        ClientAnswer: answer,
+        ClientRTP: rtp,
+        HangupRequest: hangup,
+        HangupRequestAck: hangup_ack,
+        ServerOverloaded: overloaded }
+
+class LoadGenerator(object):
+    '''runs the clients through a load test on the reactor,
+    results() returns what was measured'''
+    def __init__(self, server, clients=28, first_user=120, duration=30.0,
+        call_seconds=5.0, pause=1.0, keep_alive=10.0, login_rate=500.0,
+        timeout=2.0, rtp_burst=1):
+        self.server = server
+        self.stats = Stats()
+        self.clients = [SimulatedClient(self, str(first_user + i))
+            for i in xrange(clients)]
+        self.duration = duration
+        self.call_seconds = call_seconds
+        self.pause = pause
+        self.keep_alive = keep_alive
+        self.login_rate = login_rate
+        self.timeout = timeout
+        # rtp packets every party sends each RTP_INTERVAL
+        self.rtp_burst = rtp_burst
+        self.to_login = list(self.clients)
+        self.waiting = set()
+        self.ready = []
+        self.calls = set()
+        # calls with rtp flowing -> the time they hang up
+        self.streaming = dict()
+        self.running = False
+        self.started = self.stopped = None
+        self.loops = []
+
+    def start(self):
+        '''listens and starts logging in, returns once the run is over'''
+        for client in self.clients:
+            reactor.listenUDP(0, client)
+        self._loop(self.login_some, 0.01)
+        self._loop(self.check, 0.1)
+        self._loop(self.send_rtp, RTP_INTERVAL)
+        reactor.run(installSignalHandlers=0)
+
+    def _loop(self, f, interval):
+        loop = LoopingCall(f)
+        loop.start(interval, now=False)
+        self.loops.append(loop)
+
+    def login_some(self):
+        '''logs in the next clients, at most login_rate a second'''
+        for i in xrange(max(1, int(self.login_rate / 100))):
+            if not self.to_login:
+                break
+            client = self.to_login.pop(0)
+            self.waiting.add(client)
+            client.login()
+
+    def logged_in(self, client):
+        self.waiting.discard(client)
+        self.stats.logged_in += 1
+        client.next_keep_alive = time.time() + \
+            random.uniform(0, self.keep_alive)
+        self.ready.append(client)
+        self.begin()
+
+    def login_failed(self, client):
+        self.waiting.discard(client)
+        self.begin()
+
+    def begin(self):
+        '''once every client got an answer to its login,
+        pairs the logged in ones into calls'''
+        if self.running or self.to_login or self.waiting:
+            return
+        self.running = True
+        self.started = time.time()
+        log.info('%d clients logged in' % len(self.ready))
+        reactor.callLater(self.duration, self.stop)
+        ready, self.ready = self.ready, []
+        for caller, callee in zip(ready[::2], ready[1::2]):
+            reactor.callLater(random.uniform(0, self.pause),
+                self.place_call, caller, callee)
+
+    def place_call(self, caller, callee):
+        if not self.running:
+            return
+        call = caller.call = callee.call = Call(caller, callee)
+        self.calls.add(call)
+        call.expect('invite')
+        msg = ClientInvite()
+        msg.set_values(client_ctx=caller.ctx,
+            calle_name_length=len(callee.username),
+            calle_name=callee.username, num_of_codecs=len(Codecs),
+            codec_list=''.join(Codecs.values()))
+        caller.send(msg)
+
+    def established(self, call):
+        call.established = True
+        self.streaming[call] = time.time() + self.call_seconds
+
+    def hang_up(self, call):
+        '''stops the rtp and hangs up a moment later, once the rtp
+        in flight has arrived'''
+        self.streaming.pop(call, None)
+        def hang_up():
+            if call in self.calls:
+                call.expect('hangup')
+                call.caller.signal(HangupRequest)
+        reactor.callLater(0.2, hang_up)
+
+    def call_ended(self, call):
+        self.stats.calls += 1
+        self._release(call, self.pause)
+
+    def call_failed(self, call):
+        self._release(call, max(self.pause, self.timeout))
+
+    def _release(self, call, pause):
+        '''the parties of call place their next call after pause'''
+        self.calls.discard(call)
+        self.streaming.pop(call, None)
+        call.caller.call = call.callee.call = None
+        reactor.callLater(pause, self.place_call, call.caller, call.callee)
+
+    def send_rtp(self):
+        now = time.time()
+        for call, hang_up_time in self.streaming.items():
+            if now >= hang_up_time:
+                self.hang_up(call)
+            else:
+                for i in xrange(self.rtp_burst):
+                    call.caller.send_rtp(now)
+                    call.callee.send_rtp(now)
+
+    def check(self):
+        '''keep-alives, and the requests which were not answered in time'''
+        now = time.time()
+        deadline = now - self.timeout
+        for client in self.clients:
+            if client.pending and client.pending[1] < deadline:
+                self.stats.error(client.pending[0] + '_timeout')
+                if client.pending[0] == 'login':
+                    self.login_failed(client)
+                client.pending = None
+            if client.ctx and client.next_keep_alive <= now:
+                client.keep_alive(now)
+        for call in list(self.calls):
+            if call.pending and call.pending[1] < deadline:
+                self.stats.error(call.pending[0] + '_timeout')
+                self.call_failed(call)
+
+    def stop(self):
+        '''hangs up the calls and logs out, then stops the reactor'''
+        self.running = False
+        self.stopped = time.time()
+        for call in list(self.streaming):
+            self.hang_up(call)
+        def logout():
+            for client in self.clients:
+                client.logout()
+            reactor.callLater(0.5, reactor.stop)
+        reactor.callLater(1.0, logout)
+
+    def results(self):
+        elapsed = (self.stopped or time.time()) - (self.started or time.time())
+        return self.stats.results(max(elapsed, 1e-6))
+
+def git_commit():
+    '''the commit of this tree, None outside of a git checkout'''
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'),
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        return process.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def report(results):
+    print 'clients logged in %d, calls %d (%.2f/sec), elapsed %.1f sec' % (
+        results['clients']['logged_in'], results['calls']['completed'],
+        results['calls']['per_sec'], results['elapsed'])
+    print 'signaling %d sent, %d received, %.1f messages/sec' % (
+        results['signaling']['sent'], results['signaling']['received'],
+        results['signaling']['per_sec'])
+    rtp = results['rtp']
+    print 'rtp %d sent, %d received, %.1f packets/sec, loss %.3f%%' % (
+        rtp['sent'], rtp['received'], rtp['per_sec'], rtp['loss'] * 100)
+    print '%-20s %8s %10s %10s %10s %10s' % (
+        'ms', 'count', 'p50', 'p90', 'p99', 'max')
+    rows = sorted(results['latency_ms'].items()) + [
+        ('rtp delay', rtp['delay_ms'])]
+    for name, values in rows:
+        print '%-20s %8d %10s %10s %10s %10s' % ((name, values['count']) +
+            tuple(values.get(key, '-') for key in ('p50', 'p90', 'p99', 'max')))
+    if results['errors']:
+        print 'errors', ', '.join('%s %d' % item
+            for item in sorted(results['errors'].items()))
+
+def compare(old, new):
+    '''prints the main figures of two results side by side'''
+    def figures(results):
+        yield 'calls/sec', results['calls']['per_sec']
+        yield 'signaling/sec', results['signaling']['per_sec']
+        yield 'rtp/sec', results['rtp']['per_sec']
+        yield 'rtp loss', results['rtp']['loss']
+        for key in ('p50', 'p99'):
+            yield 'rtp delay %s ms' % key, results['rtp']['delay_ms'].get(key)
+        for step, values in sorted(results['latency_ms'].items()):
+            for key in ('p50', 'p99'):
+                yield '%s %s ms' % (step, key), values.get(key)
+    old_figures = dict(figures(old))
+    print '%-24s %12s %12s %8s' % ('', old.get('commit') or 'old',
+        new.get('commit') or 'new', 'change')
+    for name, value in figures(new):
+        before = old_figures.get(name)
+        change = ('%+.1f%%' % ((value - before) * 100.0 / before)
+            if before and value is not None else '')
+        print '%-24s %12s %12s %8s' % (name, before, value, change)
+
+def spawn_server(args=(), wait=2):
+    '''a local server on the configured listeners'''
+    server = subprocess.Popen([sys.executable, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'server.py')]
+        + list(args), stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    time.sleep(wait)
+    return server
+
+def main(argv):
+    udp_port = dict(config.Listeners).get('udp')
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=udp_port)
+    parser.add_option('--spawn', action='store_true',
+        help='run a local server for the test')
+    parser.add_option('--clients', type='int', default=28)
+    parser.add_option('--first-user', type='int', default=120)
+    parser.add_option('--duration', type='float', default=30.0,
+        help='seconds of calls, after all the clients logged in')
+    parser.add_option('--call-seconds', type='float', default=5.0)
+    parser.add_option('--pause', type='float', default=1.0,
+        help='seconds between the calls of a pair of clients')
+    parser.add_option('--keep-alive', type='float', default=10.0)
+    parser.add_option('--login-rate', type='float', default=500.0)
+    parser.add_option('--timeout', type='float', default=2.0)
+    parser.add_option('--rtp-burst', type='int', default=1,
+        help='rtp packets every party sends each 20ms')
+    parser.add_option('--takeover-at', type='float',
+        help='seconds into the run a new local server takes over from '
+            'the running one (see handoff.py)')
+    parser.add_option('--output', help='write the results as json')
+    parser.add_option('--compare', help='json results of an earlier run')
+    options, args = parser.parse_args(argv)
+    if options.takeover_at and not config.HANDOFF_SOCKET:
+        parser.error('--takeover-at needs config.HANDOFF_SOCKET')
+
+    generator = LoadGenerator((options.host, options.port),
+        clients=options.clients, first_user=options.first_user,
+        duration=options.duration, call_seconds=options.call_seconds,
+        pause=options.pause, keep_alive=options.keep_alive,
+        login_rate=options.login_rate, timeout=options.timeout,
+        rtp_burst=options.rtp_burst)
+    servers = options.spawn and [spawn_server()] or []
+    if options.takeover_at:
+        # the old server stops by itself once the new one serves
+        reactor.callLater(options.takeover_at, lambda: servers.append(
+            spawn_server(['takeover'], wait=0)))
+    try:
+        generator.start()
+    finally:
+        for server in servers:
+            if server.poll() is None:
+                server.send_signal(signal.SIGINT)
+                server.wait()
+
+    results = generator.results()
+    results.update(commit=git_commit(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        server='%s:%d' % (options.host, options.port),
+        options=dict((name, value) for name, value
+            in vars(options).items() if name not in ('output', 'compare')))
+    report(results)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -6,6 +6,7 @@ __author__ = 'Tzury Bar Yochay'
 __version__ = '0.1'
 __license__ = 'GPLv3'
 
+import sys, time, threading, atexit, collections
 import logging
 from logging import handlers
 from theme import default_theme as theme
@@ -24,53 +25,211 @@ NOTSET      0
 
 send_to_socket = None
 
-class Logger:    
-    def __init__(self):
+# the formats below use no file names nor line numbers, 
+# skip looking them up on every record
+logging._srcfile = None
+
+# records waiting for the writer thread
+LOG_QUEUE_SIZE = 10000
+
+# DEBUG records are dropped once the queue is that full
+LOG_DEBUG_WATERMARK = LOG_QUEUE_SIZE * 3 / 4
+
+# records written with a single write
+LOG_BATCH = 256
+
+# seconds between writes
+LOG_INTERVAL = 0.05
+
+class Message(object):
+    '''the arguments of a log call, joined only when the record is 
+    written (by the writer thread)'''
+    __slots__ = ('args',)
+    
+    def __init__(self, args):
+        self.args = args
+        
+    def __str__(self):
+        return ''.join(str(i) for i in self.args)
+
+class ColorFormatter(logging.Formatter):
+    '''colours the whole line by its level'''
+    styles = {
+        logging.DEBUG: theme.style_prompt,
+        logging.INFO: theme.style_yellow,
+        logging.WARNING: theme.style_right,
+        logging.ERROR: theme.style_fail,
+    }
+    
+    def format(self, record):
+        return (self.styles.get(record.levelno, '') 
+            + logging.Formatter.format(self, record) 
+            + theme.style_normal)
+
+class AsyncHandler(logging.Handler):
+    '''hands the records over to a writer thread through a bounded queue.
+    
+    The writer wakes up every LOG_INTERVAL seconds, formats the records 
+    queued since and writes them to each of its streams in batches of 
+    LOG_BATCH records. Under pressure DEBUG records are dropped, the others 
+    wait for room in the queue.'''
+    def __init__(self, targets, capacity=LOG_QUEUE_SIZE, 
+        watermark=LOG_DEBUG_WATERMARK, interval=LOG_INTERVAL):
+        logging.Handler.__init__(self)
+        # [(stream, formatter)]
+        self.targets = targets
+        # appends and pops of a deque are atomic, no locks on the hot path
+        self.queue = collections.deque()
+        self.capacity = capacity
+        self.watermark = watermark
+        self.interval = interval
+        self.dropped = 0
+        self._start()
+        atexit.register(self.stop)
+        
+    def _start(self):
+        self.stopped = False
+        self.wakeup = threading.Event()
+        self.idle = threading.Event()
+        self.writer = threading.Thread(target=self._write_loop, 
+            name='log-writer')
+        self.writer.setDaemon(True)
+        self.writer.start()
+        
+    def after_fork(self):
+        '''starts a writer in a forked child, the writer thread stays 
+        behind in the parent, and so do the records queued before'''
+        self.queue.clear()
+        self._start()
+        
+    def emit(self, record):
+        self.put(record.levelno, record)
+        
+    def put(self, level, entry):
+        '''queues a LogRecord, or a (name, level, time, args, exc_info) 
+        entry which the writer turns into a LogRecord'''
+        if len(self.queue) >= self.watermark:
+            if level <= logging.DEBUG:
+                self.dropped += 1
+                return
+            while len(self.queue) >= self.capacity \
+                and self.writer.isAlive():
+                self.wakeup.set()
+                time.sleep(self.interval / 10)
+        self.queue.append(entry)
+        
+    def flush(self):
+        '''waits until every queued record has been written'''
+        while self.queue and self.writer.isAlive():
+            self.idle.clear()
+            self.wakeup.set()
+            self.idle.wait(1)
+            
+    def stop(self):
+        self.flush()
+        self.stopped = True
+        self.wakeup.set()
+        self.writer.join(1)
+        
+    def _record(self, entry):
+        if isinstance(entry, logging.LogRecord):
+            return entry
+        name, level, created, args, exc_info = entry
+        record = logging.LogRecord(name, level, None, None, Message(args), 
+            (), exc_info)
+        record.created = created
+        record.msecs = (created - long(created)) * 1000
+        return record
+        
+    def _write_loop(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            while self.queue:
+                records = []
+                try:
+                    while len(records) < LOG_BATCH:
+                        records.append(self._record(self.queue.popleft()))
+                except IndexError:
+                    pass
+                self.write(records)
+            self.idle.set()
+                
+    def write(self, records):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records.append(logging.makeLogRecord(dict(name='snoip.freespeech',
+                levelno=logging.WARNING, levelname='WARNING', 
+                msg='%d debug records dropped' % dropped)))
+            
+        for stream, formatter in self.targets:
+            try:
+                stream.write(''.join(formatter.format(record) + '\n' 
+                    for record in records))
+                stream.flush()
+            except:
+                for record in records:
+                    self.handleError(record)
+                
+class Logger:
+    '''log.info('a', 1, 'b') logs 'a1b'. nothing is formatted unless 
+    the level is enabled, and then not on the calling thread'''
+    def __init__(self, name='snoip.freespeech', 
+        filename='snoip.freespeech.log', stream=sys.stderr):
         self.file_frmt = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         self.stream_frmt = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         
-        self.logger = logging.getLogger('snoip.freespeech')
+        self.logger = logging.getLogger(name)
         self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        
+        targets = []
         
-        # file handler
-        self.fh = logging.FileHandler('snoip.freespeech.log')
+        # file
+        if filename:
+            self.file = open(filename, 'a')
+            targets.append((self.file, self.file_frmt))
         
-        # stream handler
-        self.ch = logging.StreamHandler()
+        # console, coloured on a terminal only
+        if stream:
+            if hasattr(stream, 'isatty') and stream.isatty():
+                self.stream_frmt = ColorFormatter(self.stream_frmt._fmt)
+            targets.append((stream, self.stream_frmt))
         
         # socket handler
         #self.sh = handlers.SocketHandler('localhost', handlers.DEFAULT_TCP_LOGGING_PORT)
+        #self.logger.addHandler(self.sh)
         
-        self.ch.setFormatter(self.stream_frmt)
-        self.fh.setFormatter(self.file_frmt)
+        self.handler = AsyncHandler(targets)
+        self.logger.addHandler(self.handler)
         
-        self.logger.addHandler(self.ch)
-        self.logger.addHandler(self.fh)
-        #self.logger.addHandler(self.sh)
+    def _log(self, level, args, exc_info=None):
+        # the writer makes the LogRecord, only the time is taken here
+        self.handler.put(level, 
+            (self.logger.name, level, time.time(), args, exc_info))
         
     def debug(self, *args):
-        self.logger.debug(
-            theme.style_prompt 
-            + ''.join(str(i) for i in args) 
-            + theme.style_normal)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, args)
 
     def info(self, *args):
-        self.logger.info(
-            theme.style_yellow 
-            + ''.join(str(i) for i in args) 
-            + theme.style_normal)
+        if self.logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, args)
 
     def exception(self, *args):
-        self.logger.exception(
-            theme.style_fail 
-            + ''.join(str(i) for i in args) 
-            + theme.style_normal)
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, args, sys.exc_info())
 
     def warning(self, *args):
-        self.logger.warning(
-            theme.style_right 
-            + ''.join(str(i) for i in args) 
-            + theme.style_normal)
+        if self.logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, args)
+            
+    def flush(self):
+        self.handler.flush()
+        
+    def after_fork(self):
+        '''call it in a forked child which keeps logging'''
+        self.handler.after_fork()
 
 class CDRLogger:
     def __init__(self):
@@ -17,12 +17,15 @@ __all__ = [
     'StringField',
     'UUIDField',
     'IPField',
+    'Layout',
 ]
 
 import struct
 from logger import log
    
 class Field(object):
+    fmt = None  # struct code used when compiled into a Layout
+    
     def __init__(self, start, format, name=None):
         self._value = None      # value of the field
         self.start = start      # starting position on the buffer
@@ -65,21 +68,29 @@ class Field(object):
         
 class ByteField(Field):
     '''single byte numeric field'''
+    fmt = 'b'
+    
     def __init__(self, start, name=None):
         Field.__init__(self, start, '!b', name)
         
 class CharField(Field):
     '''single byte text field'''
+    fmt = 'c'
+    
     def __init__(self, start, name=None):
         Field.__init__(self, start, '!c', name)
         
 class ShortField(Field):
     '''2 bytes numeric field'''
+    fmt = 'h'
+    
     def __init__(self, start, name=None):
         Field.__init__(self, start, '!h', name)
         
 class IntField(Field):
     '''4 bytes numeric field'''
+    fmt = 'i'
+    
     def __init__(self, start, name=None):
         Field.__init__(self, start, '!i', name)
         
@@ -118,9 +129,21 @@ class UUIDField(StringField):
         
 class IPField(Field):
     '''16 bytes for IPv6, in IPv4 only the first 4 bytes are used'''
+    fmt = '16s'
+    
     def __init__(self, start, name=None):
         Field.__init__(self, start, '!16B', name)
         
+    @staticmethod
+    def encode(v):
+        '''converts a dotted ip string or a sequence of octets 
+        into the 16 bytes sent on the wire'''
+        if isinstance(v, str):
+            if len(v) == 16:
+                return v
+            return ''.join(chr(int(o)) for o in v.split('.')).ljust(16, '\x00')
+        return ''.join(chr(o) for o in v).ljust(16, '\x00')
+        
     def __setattr__(self, k, v):
         '''a wrapper around x.value'''
         if k == 'value':
@@ -132,3 +155,94 @@ class IPField(Field):
                 self._value = v
         else:
             self.__dict__[k] = v
+
+class Layout(object):
+    '''The wire layout of a message class, compiled once from its `seq`.
+    
+    Adjacent fixed-size fields are merged into a single struct.Struct, 
+    a variable length string breaks the run and takes its length from 
+    a count field decoded earlier in the same message. 
+    Values travel as a plain tuple, ordered as in `seq`.'''
+    def __init__(self, seq):
+        self.names = tuple(params[0] for params in seq)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        # (Struct, first, last) for fixed runs, values[first:last]
+        # (None, position, count_position) for variable length strings
+        self.segments = []
+        # fields which must be converted before packing
+        self.encoders = [(i, params[1].encode) 
+            for i, params in enumerate(seq) if hasattr(params[1], 'encode')]
+        
+        codes, first = [], 0
+        for i, params in enumerate(seq):
+            ctr = params[1]
+            size = len(params) == 3 and params[2]
+            if ctr.fmt:
+                codes.append(ctr.fmt)
+            elif isinstance(size, int):
+                codes.append('%ds' % size)
+            else:
+                self._close_run(codes, first, i)
+                self.segments.append((None, i, self.index[size]))
+                codes, first = [], i + 1
+        self._close_run(codes, first, len(self.names))
+        
+        # fast path, the whole message is a single struct
+        self.fixed = (len(self.segments) == 1 
+            and self.segments[0][0] or None)
+        self.size = self.fixed and self.fixed.size
+        
+    def _close_run(self, codes, first, last):
+        if codes:
+            self.segments.append(
+                (struct.Struct('!' + ''.join(codes)), first, last))
+            
+    def unpack(self, buf):
+        '''returns the tuple of values stored in buf, raises ValueError 
+        if buf is shorter or longer than the values it holds'''
+        if self.fixed:
+            if len(buf) != self.size:
+                raise ValueError('%d bytes, expected %d' 
+                    % (len(buf), self.size))
+            return self.fixed.unpack(buf)
+            
+        values, offset = (), 0
+        for st, first, last in self.segments:
+            if st:
+                if len(buf) < offset + st.size:
+                    raise ValueError('%d bytes, truncated at %s' 
+                        % (len(buf), self.names[first]))
+                values += st.unpack_from(buf, offset)
+                offset += st.size
+            else:
+                end = offset + values[last]
+                if values[last] < 0 or len(buf) < end:
+                    raise ValueError('%d bytes, truncated at %s' 
+                        % (len(buf), self.names[first]))
+                values += (buf[offset:end],)
+                offset = end
+        if offset != len(buf):
+            raise ValueError('%d bytes, expected %d' % (len(buf), offset))
+        return values
+        
+    def pack(self, values):
+        '''returns the wire representation of the tuple of values'''
+        if self.encoders:
+            values = list(values)
+            for i, encode in self.encoders:
+                values[i] = encode(values[i])
+                
+        if self.fixed:
+            return self.fixed.pack(*values)
+            
+        parts = []
+        for st, first, last in self.segments:
+            if st:
+                parts.append(st.pack(*values[first:last]))
+            else:
+                if len(values[first]) != values[last]:
+                    raise ValueError('%s is %d bytes, %s says %s' % (
+                        self.names[first], len(values[first]), 
+                        self.names[last], values[last]))
+                parts.append(values[first])
+        return ''.join(parts)
@@ -15,6 +15,7 @@ __all__ = [
     'Parser', 
     'Framer', 
     'BaseMessage', 
+    'AlternateServerMessage', 
     'HangupRequest', 
     'HangupRequestAck', 
     'ClientInvite', 
@@ -34,22 +35,15 @@ __all__ = [
     'ServerRejectInvite', 
     'ShortResponse', 
     'MessageTypes', 
-    'string_to_ctx',
+    'rtp_route',
+    'rtp_translate',
     ]
     
 import struct
-from ctypes import create_string_buffer, c_int
 from utils import Storage
 from logger import log
 from messagefields import *
 
-def string_to_ctx(*args):
-    v = ''.join((str(arg) for arg in args))
-    # ensure we use 32 bit integer on 64 bit CPU
-    h = c_int(hash(v)).value
-    log.debug('hashing %s as %d' % (repr(v), h))
-    return h
-
 class Parser(object):
     def __init__(self):
         pass
@@ -73,20 +67,25 @@ class Parser(object):
             return -1
         
     def valid(self, msg):
-        return (self.bof(msg) 
-                and self.eof(msg) 
-                and self.length(msg) == len(self._body(msg)) 
-                and self.parse_type(msg))
+        '''checks BOF, length, EOF and the type in a single pass,
+        returns the type code of a valid message'''
+        if len(msg) < Framer.OVERHEAD:
+            return False
+            
+        bof, t, length = Framer.HEADER.unpack_from(msg)
+        return (bof == Framer.BOF
+                and length == len(msg) - Framer.OVERHEAD
+                and msg[-Framer.EOF_LEN:] == Framer.EOF
+                and t in MessageTypes and t)
         
     def _body(self, msg):
-        buf = create_string_buffer(self.length(msg))
-        buf.raw = msg[Framer.LEN_POS[1] : -Framer.EOF_LEN]
-        return buf
+        return msg[Framer.LEN_POS[1] : -Framer.EOF_LEN]
         
     def body(self, msg):
         '''returns a tuple (msg_type, msg_buffer)'''
-        if self.valid(msg):
-            return (self.parse_type(msg), self._body(msg))
+        msg_type = self.valid(msg)
+        if msg_type:
+            return (msg_type, self._body(msg))
         else:
             return None
 
@@ -97,6 +96,10 @@ class Framer(object):
     LEN_POS = (4, 6)
     BOF_LEN = len(BOF)
     EOF_LEN = len(EOF)
+    # BOF, type code, length
+    HEADER = struct.Struct('!2s2sh')
+    HEADER_LEN = LEN_POS[1]
+    OVERHEAD = HEADER_LEN + EOF_LEN
     
     @staticmethod
     def frame(type_code, buf):
@@ -114,137 +117,83 @@ class CommMessage(object):
         self.msg_type = msg_type
         self.body = body
         self.msg = msg_type(buf=body)
-        self.client_ctx = None
-        
-        # for login request create new context, 
-        # for others extract from the message
-        if (getattr(self.msg, 'client_ctx', None)):
-            self.client_ctx = self.msg.client_ctx.value
+        self.client_ctx = self.call_ctx = None
+        if self.msg.values is None:
+            # malformed, see valid()
+            return
             
-        elif isinstance(self.msg, (LoginRequest,)):
-            client_ctx = string_to_ctx(self.msg.username.value)
-            log.info('a new client_ctx ', 
-                'username: %s ctx: %s' % (
-                    self.msg.username.value ,repr(client_ctx)))
-            self.client_ctx = client_ctx
+        # a login request has no context yet, the login handler
+        # allocates one
+        if getattr(self.msg, 'client_ctx', None):
+            self.client_ctx = self.msg.client_ctx
             
-        self.call_ctx = getattr(self.msg, 'call_ctx', None) \
-            and self.msg.call_ctx.value
+        self.call_ctx = getattr(self.msg, 'call_ctx', None)
+        
+    def valid(self):
+        '''False if the body did not match the layout of msg_type'''
+        return self.msg.values is not None
         
     def __repr__(self):
         return 'from %s <%s>, type %s, msg %s' % (
             self.addr, self.client_ctx, self.msg_type, repr(self.msg))
                     
+class FieldValue(object):
+    '''descriptor exposing a single value of a message by its field name'''
+    def __init__(self, index):
+        self.index = index
+        
+    def __get__(self, msg, cls=None):
+        if msg is None:
+            return self
+        return msg.values[self.index]
+        
+class MessageMeta(type):
+    '''compiles the `seq` of every message class into a Layout'''
+    def __init__(cls, name, bases, dct):
+        type.__init__(cls, name, bases, dct)
+        cls.layout = Layout(cls.seq)
+        for i, field_name in enumerate(cls.layout.names):
+            setattr(cls, field_name, FieldValue(i))
+            
 class BaseMessage(object):
+    __metaclass__ = MessageMeta
+    
     seq = [] # the sequence of fields stored in the buffer
-    buf = None
+    type_code = None
+    values = None
     
     def __init__(self, *args, **kwargs):
         if 'buf' in kwargs:
             self.deserialize(kwargs['buf'])
             
-        elif 'length' in kwargs:
-            self.buf = create_string_buffer(kwargs['length'])
-            
-        self.type_code = MessageTypes.keyof(self)
-        
-    def _init_buffer(self, newbuffer=None):
-        try:
-            if not self.buf and not newbuffer:
-                length = sum((self.__dict__[field[0]].length 
-                    for field in self.seq))
-                self.buf = self._create_buffer(length)
-                
-            elif newbuffer:
-                # self.buf never initialized
-                if not self.buf:
-                    self.buf = self._create_buffer(len(newbuffer))
-                    
-                # assign or copy the string-value into self.buf
-                if hasattr(newbuffer, 'raw'):
-                    self.buf = newbuffer
-                elif isinstance(newbuffer,str):
-                    self.buf.raw = newbuffer
-        except:
-            log.exception('exception')
-            
-    def _create_buffer(self, length=0):
-        try:
-            '''alocates a writeable buffer'''
-            return create_string_buffer(length)
-        except:
-            log.exception('exception')        
-        
-    def deserialize(self, buf=None):
+    def deserialize(self, buf):
+        '''values stays None if buf does not match the layout'''
         try:
-            if buf:
-                self._init_buffer(buf)
-                
-            self._set_values(self.seq)        
+            self.values = self.layout.unpack(buf)
+        except ValueError, inst:
+            log.debug('malformed ', self.__class__.__name__, ': ', inst)
         except:
             log.exception('exception')
         
     def set_values(self, **kwargs):
         try:
-            items = (p for p in self.seq if p[0] in kwargs)
-            self._set_values(items, kwargs)
+            values = self.values or (None,) * len(self.layout.names)
+            self.values = tuple([kwargs.get(name, value) 
+                for name, value in zip(self.layout.names, values)])
         except:
             log.exception('exception')
             
     def dict_fields(self):
         try:
             '''all fields as dict {name: value, ...}'''
-            x = dict(
-                ((self.__dict__[field[0]].name, 
-                        self.__dict__[field[0]].value) for field in self.seq))
-            return x
+            return dict(zip(self.layout.names, self.values))
         except:
             log.exception('exception')        
         
-    def _set_values(self, items, values_dict=None):
-        try:
-            start = 0 # first field position
-            for params in items:
-                key, ctr = params[0], params[1]
-                format = len(params) == 3 and params[2]
-                args = [start]
-                if format:
-                    if hasattr(format, '__call__'): 
-                        format = format()
-                    args.append(format)
-                
-                # key -> field.name
-                args.append(key)
-                
-                # set a property as field-name and its value as Field instance.
-                self.__dict__[key] = ctr(*args)
-                
-                # set the value either to a supplied argument 
-                # or extract from the buffer
-                if values_dict:
-                    self.__dict__[key].value = values_dict[key]
-                else:
-                    self.__dict__[key].unpack_from(self.buf)
-                    
-                #next field starting point
-                start = self.__dict__[key].end
-        except:
-            log.exception('exception')
-            
-    def _pack_values(self):
-        try:
-            '''packs all the values into the buffer'''
-            self._init_buffer()
-            for v in self.seq:
-                self.__dict__[v[0]].pack_into(self.buf)
-        except:
-            log.exception('exception')
-            
     def serialize(self):
         try:
-            '''packs all values into the buffer and returns the buffer'''
-            self._pack_values()
-            return self.buf.raw
+            '''packs all values and returns the buffer'''
+            return self.layout.pack(self.values)
         except:
             log.exception('exception')
         
@@ -256,169 +205,116 @@ class BaseMessage(object):
             log.exception('exception')
             
 class ShortResponse(BaseMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('result', ShortField)]
-            
-        BaseMessage.__init__(self, *args, **kwargs)
+    seq = [
+        ('client_ctx', IntField),
+        ('result', ShortField)]
         
 class LoginRequest(BaseMessage):    
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('username_length', ByteField), 
-            ('username', StringField, 
-                lambda: '!%dc' % self.username_length.value ), 
-            ('password', StringField, '!20c'), 
-            ('local_ip', IPField), 
-            ('local_port', IntField)]
-            
-        BaseMessage.__init__(self, *args, **kwargs)
+    seq = [
+        ('username_length', ByteField), 
+        ('username', StringField, 'username_length'), 
+        ('password', StringField, 20), 
+        ('local_ip', IPField), 
+        ('local_port', IntField)]
         
 class LoginReply(BaseMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('client_public_ip', IPField),
-            ('client_public_port', IntField),
-            ('ctx_expire', IntField),
-            ('num_of_codecs', ByteField),
-            ('codec_list', StringField, 
-                lambda: '!%dc' % self.num_of_codecs.value)]
-            
-        BaseMessage.__init__(self, *args, **kwargs)
-
+    seq = [
+        ('client_ctx', IntField),
+        ('client_public_ip', IPField),
+        ('client_public_port', IntField),
+        ('ctx_expire', IntField),
+        ('num_of_codecs', ByteField),
+        ('codec_list', StringField, 'num_of_codecs')]
+        
 class AlternateServerMessage(BaseMessage):
     pass
 
     
 class Logout(BaseMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [('client_ctx', IntField)]
-        BaseMessage.__init__(self, *args, **kwargs)
+    seq = [('client_ctx', IntField)]
 
     
 class KeepAlive(BaseMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('client_public_ip', IPField),
-            ('client_public_port', IntField)]
+    seq = [
+        ('client_ctx', IntField),
+        ('client_public_ip', IPField),
+        ('client_public_port', IntField)]
         
-        BaseMessage.__init__(self, *args, **kwargs)
-
 class KeepAliveAck(BaseMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('expire', IntField),
-            ('refresh_contact_list', ByteField)]
+    seq = [
+        ('client_ctx', IntField),
+        ('expire', IntField),
+        ('refresh_contact_list', ByteField)]
         
-        BaseMessage.__init__(self, *args, **kwargs)
-
 class SignalingMessage(BaseMessage):
-    def __init__(self, *args, **kwargs):
-        BaseMessage.__init__(self, *args, **kwargs)
+    pass
     
 class ClientInvite(SignalingMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('calle_name_length', ByteField),
-            ('calle_name', StringField, 
-                lambda: '!%dc' % self.calle_name_length.value),
-            ('num_of_codecs', ByteField),
-            ('codec_list', StringField, 
-                lambda: '!%dc' % self.num_of_codecs.value)]
-            
-        SignalingMessage.__init__(self, *args, **kwargs)
+    seq = [
+        ('client_ctx', IntField),
+        ('calle_name_length', ByteField),
+        ('calle_name', StringField, 'calle_name_length'),
+        ('num_of_codecs', ByteField),
+        ('codec_list', StringField, 'num_of_codecs')]
         
 class ServerRejectInvite(ShortResponse):
-    def __init__(self, *args, **kwargs):
-        ShortResponse.__init__(self, *args, **kwargs)
+    pass
         
 class ServerForwardInvite(SignalingMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('call_ctx', IntField),
-            ('call_type', ByteField),
-            ('client_name_length', ByteField),
-            ('client_name', StringField, 
-                lambda: '!%dc' % self.client_name_length.value),
-            ('client_public_ip', IPField),
-            ('client_public_port', IntField),
-            ('num_of_codecs', ByteField),
-            ('codec_list', StringField, 
-                lambda: '!%dc' % self.num_of_codecs.value)]
-            
-        SignalingMessage.__init__(self, *args, **kwargs)
+    seq = [
+        ('client_ctx', IntField),
+        ('call_ctx', IntField),
+        ('call_type', ByteField),
+        ('client_name_length', ByteField),
+        ('client_name', StringField, 'client_name_length'),
+        ('client_public_ip', IPField),
+        ('client_public_port', IntField),
+        ('num_of_codecs', ByteField),
+        ('codec_list', StringField, 'num_of_codecs')]
         
 class ClientInviteAck(SignalingMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('call_ctx', IntField),
-            ('client_status', CharField),
-            ('client_public_ip', IPField),
-            ('client_public_port', IntField)]
-        
-        SignalingMessage.__init__(self, *args, **kwargs)
+    seq = [
+        ('client_ctx', IntField),
+        ('call_ctx', IntField),
+        ('client_status', CharField),
+        ('client_public_ip', IPField),
+        ('client_public_port', IntField)]
         
 class ServerForwardRing(SignalingMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('call_ctx', IntField),
-            ('client_status', CharField),
-            ('call_type', ByteField),
-            ('client_public_ip', IPField),
-            ('client_public_port', IntField)]
-            
-        SignalingMessage.__init__(self, *args, **kwargs)
-    
+    seq = [
+        ('client_ctx', IntField),
+        ('call_ctx', IntField),
+        ('client_status', CharField),
+        ('call_type', ByteField),
+        ('client_public_ip', IPField),
+        ('client_public_port', IntField)]
+        
 class ClientAnswer(SignalingMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('call_ctx', IntField),
-            ('codec', CharField)]
-            
-        SignalingMessage.__init__(self, *args, **kwargs)
+    seq = [
+        ('client_ctx', IntField),
+        ('call_ctx', IntField),
+        ('codec', CharField)]
         
 class ClientRTP(BaseMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('call_ctx', IntField),
-            ('sequence', IntField),
-            ('rtp_bytes_length', ShortField),
-            ('rtp_bytes', StringField, 
-                lambda: '!%dc' % self.rtp_bytes_length.value)]
-            
-        BaseMessage.__init__(self, *args, **kwargs)
+    seq = [
+        ('client_ctx', IntField),
+        ('call_ctx', IntField),
+        ('sequence', IntField),
+        ('rtp_bytes_length', ShortField),
+        ('rtp_bytes', StringField, 'rtp_bytes_length')]
         
 class HangupRequest(SignalingMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('call_ctx', IntField)]
-            
-        SignalingMessage.__init__(self, *args, **kwargs)
+    seq = [
+        ('client_ctx', IntField),
+        ('call_ctx', IntField)]
         
 class HangupRequestAck(SignalingMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [
-            ('client_ctx', IntField),
-            ('call_ctx', IntField)]
-            
-        SignalingMessage.__init__(self, *args, **kwargs)
+    seq = [
+        ('client_ctx', IntField),
+        ('call_ctx', IntField)]
         
 class ServerOverloaded(BaseMessage):
-    def __init__(self, *args, **kwargs):
-        self.seq = [('alternate_ip', IPField)]
-        
-        BaseMessage.__init__(self, *args, **kwargs)
+    seq = [('alternate_ip', IPField)]
 
 MessageTypes = Storage({
 
@@ -447,7 +343,43 @@ MessageTypes = Storage({
 
 def keyof(_v):
     for k,v in MessageTypes.iteritems():
-        if _v == v or isinstance(_v, v):
+        if _v == v or isinstance(_v, v) \
+            or (isinstance(_v, type) and issubclass(_v, v)):
             return k
 
 MessageTypes.keyof = keyof
+
+# resolve the type code once per class rather than on every instance
+for _ctr in MessageTypes.values():
+    if isinstance(_ctr, type):
+        _ctr.type_code = keyof(_ctr)
+del _ctr
+
+
+# BOF, type code, length, client_ctx, call_ctx
+rtp_header = struct.Struct('!2s2shii')
+
+def rtp_route(msg):
+    '''(client_ctx, call_ctx) of a raw datagram holding exactly one 
+    ClientRTP frame, read without decoding the message, None otherwise'''
+    if (len(msg) < rtp_header.size + Framer.EOF_LEN
+        or msg[Framer.TYPE_POS[0]:Framer.TYPE_POS[1]] != ClientRTP.type_code):
+        return None
+        
+    bof, type_code, length, client_ctx, call_ctx = rtp_header.unpack_from(msg)
+    if (bof != Framer.BOF 
+        or length != len(msg) - Framer.OVERHEAD
+        or msg[-Framer.EOF_LEN:] != Framer.EOF):
+        return None
+        
+    return client_ctx, call_ctx
+
+# the rtp_bytes of a ClientRTP frame follow the sequence and their length
+RTP_BYTES_POS = rtp_header.size + 6
+
+def rtp_translate(msg, table):
+    '''a raw ClientRTP frame (see rtp_route) with its rtp_bytes passed 
+    through str.translate(table)'''
+    return (msg[:RTP_BYTES_POS] 
+        + msg[RTP_BYTES_POS:-Framer.EOF_LEN].translate(table) 
+        + msg[-Framer.EOF_LEN:])
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+__author__ = 'Tzury Bar Yochay'
+__version__ = '0.1'
+__license__ = 'GPLv3'
+
+'''
+**************************************
+metrics.py (part of freespeech.py)
+**************************************
+
+in-process metrics, cheap enough to stay on in production.
+
+updating a metric is an attribute increment (and a bisect for a
+histogram), no locks and no formatting. every metric must be updated
+from a single thread (the reactor, the inbound or the outbound thread),
+readers on other threads see a value which is at most a few updates old.
+gauges are callables, evaluated only when the registry is read.
+
+the registry is served by admin.py, as json or as text in the
+prometheus exposition format.
+'''
+
+__all__ = ['Counter', 'Histogram', 'Gauge', 'Family', 'Registry',
+    'ReactorLag', 'registry', 'LATENCY_BUCKETS']
+
+import time
+from bisect import bisect_left
+from logger import log
+
+# upper bounds, seconds, of the latency histograms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+class Counter(object):
+    __slots__ = ('value',)
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def read(self):
+        return self.value
+
+class Histogram(object):
+    '''counts of the observed values by bucket, the last bucket is
+    for the values above the largest bound'''
+    __slots__ = ('bounds', 'counts', 'sum')
+    kind = 'histogram'
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def read(self):
+        counts = list(self.counts)
+        return dict(count=sum(counts), sum=self.sum,
+            buckets=zip(self.bounds + ('+Inf',), counts))
+
+class Gauge(object):
+    '''a value computed by fn() when it is read'''
+    __slots__ = ('fn',)
+    kind = 'gauge'
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def read(self):
+        return self.fn()
+
+class Family(dict):
+    '''metrics of the same kind keyed by a label, e.g. by message type.
+    new keys are added on first use, by the writer thread'''
+    def __init__(self, label, factory, keys=()):
+        dict.__init__(self)
+        self.label = label
+        self.factory = factory
+        self.kind = factory.kind
+        for key in keys:
+            self[key] = factory()
+
+    def __missing__(self, key):
+        metric = self[key] = self.factory()
+        return metric
+
+    def read(self):
+        return dict((getattr(key, '__name__', str(key)), metric.read())
+            for key, metric in self.items())
+
+class Registry(object):
+    '''the metrics by name, in the order they were registered'''
+    def __init__(self):
+        self.metrics = []
+        self.names = dict()
+
+    def register(self, name, metric, help=''):
+        if name in self.names:
+            raise ValueError('metric %s is already registered' % name)
+        self.names[name] = metric
+        self.metrics.append((name, metric, help))
+        return metric
+
+    def counter(self, name, help=''):
+        return self.register(name, Counter(), help)
+
+    def histogram(self, name, help='', bounds=LATENCY_BUCKETS):
+        return self.register(name, Histogram(bounds), help)
+
+    def gauge(self, name, fn, help=''):
+        return self.register(name, Gauge(fn), help)
+
+    def family(self, name, label, kind=Counter, keys=(), help=''):
+        return self.register(name, Family(label, kind, keys), help)
+
+    def snapshot(self):
+        '''{name: value} of every metric'''
+        values = dict()
+        for name, metric, help in self.metrics:
+            try:
+                values[name] = metric.read()
+            except:
+                log.exception('exception')
+                values[name] = None
+        return values
+
+    def text(self):
+        '''the metrics in the prometheus text exposition format'''
+        lines = []
+        values = self.snapshot()
+        for name, metric, help in self.metrics:
+            if help:
+                lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            value = values[name]
+            if isinstance(metric, Family):
+                for key, item in sorted(value.items()):
+                    lines.extend(_samples(name, metric.kind, item,
+                        '%s="%s"' % (metric.label, key)))
+            else:
+                lines.extend(_samples(name, metric.kind, value))
+        return '\n'.join(lines) + '\n'
+
+def _samples(name, kind, value, labels=''):
+    '''the text lines of a single metric'''
+    if value is None:
+        return []
+    if kind != 'histogram':
+        return ['%s%s %s' % (name, labels and '{%s}' % labels, value)]
+    lines = []
+    cumulative = 0
+    for bound, count in value['buckets']:
+        cumulative += count
+        lines.append('%s_bucket{%sle="%s"} %d' % (name,
+            labels and labels + ',', bound, cumulative))
+    lines.append('%s_sum%s %s' % (name, labels and '{%s}' % labels,
+        value['sum']))
+    lines.append('%s_count%s %d' % (name, labels and '{%s}' % labels,
+        value['count']))
+    return lines
+
+class ReactorLag(object):
+    '''how late the reactor runs a call scheduled every interval seconds,
+    the time the loop spends on everything else before getting to it'''
+    def __init__(self, registry, interval):
+        self.interval = interval
+        self.last = 0.0
+        self.histogram = registry.histogram('reactor_lag_seconds',
+            'delay of a call scheduled on the reactor')
+        registry.gauge('reactor_lag_last_seconds', lambda: self.last,
+            'delay of the last probe of the reactor')
+        self.expected = None
+        self.call = None
+
+    def start(self):
+        from twisted.internet import reactor
+        self.reactor = reactor
+        self.schedule()
+
+    def schedule(self):
+        self.expected = time.time() + self.interval
+        self.call = self.reactor.callLater(self.interval, self.probe)
+
+    def probe(self):
+        self.last = max(0.0, time.time() - self.expected)
+        self.histogram.observe(self.last)
+        self.schedule()
+
+    def stop(self):
+        if self.call and self.call.active():
+            self.call.cancel()
+
+registry = Registry()
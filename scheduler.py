@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+from __future__ import with_statement
+
+__author__ = 'Tzury Bar Yochay'
+__version__ = '0.1'
+__license__ = 'GPLv3'
+
+'''
+**************************************
+scheduler.py (part of freespeech.py)
+**************************************
+'''
+
+__all__ = ['ClassQueue']
+
+import time, threading
+from collections import deque
+from Queue import Empty, Full
+
+from metrics import Family, Counter, Histogram
+
+class ClassQueue(object):
+    '''A queue of items sorted into classes, every class a bounded FIFO
+    of its own, e.g. signaling and media.
+
+    classes is a sequence of (name, weight, limit, deadline),
+    classify(item) returns the name of the class of an item. get()
+    serves the classes by weighted round robin, a class with items
+    waiting is served up to weight items in a row before the next class
+    with items waiting gets its turn, so no class starves the others.
+    An item which waited more than the deadline (seconds, 0 - none) of
+    its class is dropped by get() rather than returned.
+
+    put(), get(), get_nowait() and qsize() are those of Queue.Queue,
+    a single thread is expected to call get(). shedding() tells the
+    producer, before it builds an item, that the item would be lost.
+    waits and late are Families (see metrics.py) of the time the items
+    waited and of the items dropped, by class.'''
+    def __init__(self, classes, classify, waits=None, late=None):
+        self.classify = classify
+        self.names = [name for name, weight, limit, deadline in classes]
+        self.weights = [weight for name, weight, limit, deadline in classes]
+        self.limits = [limit for name, weight, limit, deadline in classes]
+        self.deadlines = [deadline
+            for name, weight, limit, deadline in classes]
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        # (time it was put, item) by class
+        self.queues = [deque() for name in self.names]
+        self.size = 0
+        # the class being served and the items it was served this turn
+        self.turn = 0
+        self.served = 0
+        self.waits = waits if waits is not None else Family(
+            'class', Histogram, self.names)
+        self.late = late if late is not None else Family(
+            'class', Counter, self.names)
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+
+    def qsize(self):
+        return self.size
+
+    def depth(self, name):
+        '''items of class name waiting'''
+        return len(self.queues[self.index[name]])
+
+    def shedding(self, name):
+        '''True if an item of class name put now would be dropped: the 
+        class is full, or its oldest item waited past the deadline 
+        already. False for a name which is not a class. reads without 
+        the mutex'''
+        i = self.index.get(name)
+        if i is None:
+            return False
+        queue, limit, deadline = (self.queues[i], self.limits[i], 
+            self.deadlines[i])
+        if limit and len(queue) >= limit:
+            return True
+        try:
+            return bool(deadline) and time.time() - queue[0][0] > deadline
+        except IndexError:
+            return False
+
+    def put(self, item, block=True):
+        '''queues item, if its class is full waits for room, or raises
+        Full if block is False'''
+        i = self.index[self.classify(item)]
+        queue, limit = self.queues[i], self.limits[i]
+        with self.mutex:
+            while limit and len(queue) >= limit:
+                if not block:
+                    raise Full
+                self.not_full.wait()
+            queue.append((time.time(), item))
+            self.size += 1
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        '''the next item by weighted round robin, see the class doc'''
+        if timeout is not None:
+            end = time.time() + timeout
+        with self.mutex:
+            while True:
+                while not self.size:
+                    if not block:
+                        raise Empty
+                    if timeout is None:
+                        self.not_empty.wait()
+                    else:
+                        remaining = end - time.time()
+                        if remaining <= 0:
+                            raise Empty
+                        self.not_empty.wait(remaining)
+
+                i = self._next()
+                queue = self.queues[i]
+                stamp, item = queue.popleft()
+                self.size -= 1
+                if self.limits[i] and len(queue) == self.limits[i] - 1:
+                    self.not_full.notify_all()
+
+                waited = time.time() - stamp
+                if self.deadlines[i] and waited > self.deadlines[i]:
+                    self.late[self.names[i]].inc()
+                    continue
+                self.waits[self.names[i]].observe(waited)
+                return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def _next(self):
+        '''the class to take an item of, called with items waiting'''
+        queues = self.queues
+        while True:
+            if queues[self.turn] and self.served < self.weights[self.turn]:
+                self.served += 1
+                return self.turn
+            self.turn = (self.turn + 1) % len(queues)
+            self.served = 0
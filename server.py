@@ -13,6 +13,12 @@ from serverfactory import serve
 from logger import log
 import config
 import session
+import workers
+import admin
+import snapshot
+import handoff
+from db import db
+from dblayer import migrate as migrate_users
 from daemon import Daemon
 
 import signal, exceptions
@@ -32,16 +38,66 @@ from twisted.internet import reactor
 # ***********************************************************
 
 class SnoipDaemon(Daemon):
+    num_of_workers = config.WORKERS
+    master = None
+    admin = None
+    # take over from the running server, see handoff.py
+    takeover = False
+    # the session table is this process's, run_all ran and no other 
+    # server took over
+    serving = False
+    
+    def daemonize(self):
+        Daemon.daemonize(self)
+        log.after_fork()
+        
     def run_all(self):
-        functions = (
-            session.handle_inbound_queue, 
-            session.handle_outbound_queue, 
+        '''returns the sockets handed over by the running server, 
+        {(proto, port): socket}, to serve on'''
+        sockets = dict()
+        self.serving = True
+        if self.takeover:
+            conn, sockets = handoff.take_over(config.HANDOFF_SOCKET)
+            reactor.callWhenRunning(handoff.served, conn)
+        elif config.SNAPSHOT_PATH:
+            # before the listeners open, see serve()
+            snapshot.restore(config.SNAPSHOT_PATH)
+            
+        self.master = workers.Master(self.num_of_workers)
+        self.master.start()
+        
+        if config.ADMIN_PORT:
+            self.admin = admin.listen(config.ADMIN_PORT, 
+                config.ADMIN_INTERFACE, sockets.get(('admin', 
+                    config.ADMIN_PORT)))
+        session.reactor_lag.start()
+        
+        functions = session.pipeline_threads() + (
             session.remove_old_clients, 
         )
+        if config.SNAPSHOT_PATH and config.SNAPSHOT_INTERVAL:
+            functions += (snapshot.snapshot_loop,)
+        if config.HANDOFF_SOCKET:
+            functions += (handoff.Handover(self.listening, self.hand_over, 
+                config.HANDOFF_SOCKET).loop,)
         
         for fn in functions:
             Thread(target=fn).start()
+        return sockets
             
+    def listening(self):
+        '''the listening ports a new server takes over, by key'''
+        ports = dict(((entry.proto, entry.listening.getHost().port), 
+            entry.listening) for entry in session.servers_pool.values())
+        if self.admin:
+            ports[('admin', config.ADMIN_PORT)] = self.admin
+        return ports
+        
+    def hand_over(self):
+        '''a new server took over, the session table is its own now'''
+        self.serving = False
+        self.stop_all()
+        
     def stop_all(self, *args):
         #stop the reactor
         if not reactor._stopped:
@@ -49,16 +105,44 @@ class SnoipDaemon(Daemon):
                 "terminating reactor's mainloop")
             reactor.stop()
         
+        # once, stop_all runs on every signal of Daemon.stop
+        if session.thread_loop_active and config.SNAPSHOT_PATH \
+            and self.serving:
+            snapshot.save(config.SNAPSHOT_PATH)
+            
         #stop flag for threads at session module started at run_all() function
         session.thread_loop_active = False
+        session.stop_pipeline()
+        
+        if self.master:
+            self.master.stop()
     
     def run(self):
-        self.run_all()
-        serve(config.Listeners)
+        # Daemon.stop terminates, shut down cleanly (and take a snapshot)
+        signal.signal(signal.SIGTERM, self.stop_all)
+        sockets = self.run_all()
+        serve(config.Listeners, self.num_of_workers > 1, sockets)
         
     def stop(self):
         self.stop_all()
         Daemon.stop(self)
+        
+    def upgrade(self):
+        '''starts a new daemon which takes over from the running one, 
+        the clients and their calls carry on'''
+        try:
+            running = file(self.pidfile,'r').read().strip()
+        except IOError:
+            running = None
+        self.takeover = True
+        self.daemonize()
+        try:
+            self.run()
+        except:
+            log.exception('exception')
+            if running:
+                # the running daemon carries on
+                file(self.pidfile,'w').write("%s\n" % running)
 
 snoip_daemon = SnoipDaemon('/tmp/snoip_daemon.pid')
 
@@ -151,18 +235,25 @@ log_daemon = LogDaemon('/tmp/snoip_log_daemon.pid')
 def start_console_mode():
     try:
         signal.signal(signal.SIGINT, snoip_daemon.stop_all)
-        snoip_daemon.run_all()
-        serve(config.Listeners)
+        sockets = snoip_daemon.run_all()
+        serve(config.Listeners, snoip_daemon.num_of_workers > 1, sockets)
     # why there is no signal on windows? 
     except exceptions.KeyboardInterrupt:
         snoip_daemon.stop_all()    
 
+def migrate():
+    '''one time changes to the database, run it while the server is down'''
+    log.info('database journal mode: %s' % db.use_wal())
+    migrate_users()
+    log.info('users table migrated')
+    
 daemonizer = {
     'snoip': 
     { 
         'start': snoip_daemon.start, 
         'stop': snoip_daemon.stop, 
-        'restart': snoip_daemon.restart
+        'restart': snoip_daemon.restart,
+        'upgrade': snoip_daemon.upgrade
     }
 }
 
@@ -171,8 +262,21 @@ USAGE:
 Start as console application
 $ python server.py 
 
+Start as console application with N processes serving udp
+$ python server.py workers N
+
+Start as console application taking over from the running server
+$ python server.py takeover
+
 Treat as Daemon:
 $ python server.py start|stop|restart
+
+Replace the running daemon without dropping its clients and calls
+(config.HANDOFF_SOCKET must be set):
+$ python server.py upgrade
+
+Migrate the database (once, with the server down):
+$ python server.py migrate
 '''
 
 if __name__ == '__main__':
@@ -181,6 +285,20 @@ if __name__ == '__main__':
         start_console_mode()
     elif sys.argv[1] in ('help', '--help', 'h', '-h'):
         print help_message
+    elif len(sys.argv) == 3 and sys.argv[1] == 'workers':
+        snoip_daemon.num_of_workers = int(sys.argv[2])
+        start_console_mode()
+    elif len(sys.argv) == 2 and sys.argv[1] in ('takeover', 'upgrade') \
+        and not config.HANDOFF_SOCKET:
+        print 'set config.HANDOFF_SOCKET, on both servers, to take over'
+    elif len(sys.argv) == 2 and sys.argv[1] == 'takeover':
+        snoip_daemon.takeover = True
+        start_console_mode()
+    elif len(sys.argv) == 2 and sys.argv[1] == 'migrate':
+        migrate()
+    elif len(sys.argv) == 4 and sys.argv[1] == 'worker':
+        # spawned by workers.Master, with its end of the channel
+        workers.run_worker(int(sys.argv[2]), int(sys.argv[3]))
     elif len(sys.argv) == 2:
         daemon = 'snoip' #sys.argv[1]
         action = sys.argv[1]
@@ -14,9 +14,13 @@ from threading import Thread
 from twisted.internet.protocol import (
     Protocol, DatagramProtocol, Factory, ServerFactory
     )
-from twisted.internet import reactor
+from twisted.internet import reactor, udp
+from twisted.internet.interfaces import IBulkDatagramProtocol
+from zope.interface import implements
 
-import session
+import config, session, handoff
+from messages import rtp_route
+from workers import ReusePort
 from utils import Storage
 from logger import log
 
@@ -24,29 +28,42 @@ from logging import makeLogRecord, getLogger
 from logging.config import fileConfig
 from logging.handlers import DEFAULT_TCP_LOGGING_PORT
 
+class PeerPort(udp.Port):
+    '''an udp port bound to share its address with the sockets it 
+    connects to the parties of the calls (see MediaPeers)'''
+    def __init__(self, *args, **kwargs):
+        udp.Port.__init__(self, *args, **kwargs)
+        # before startListening, the socket is bound to share its address
+        self.maxPeers = config.UDP_PEER_SOCKETS
+    
 class TCPServerPrtocol(Protocol):
     dataReceivedHandler = session.recv_msg
         
     def connectionMade(self):
         self.factory.echoers.append(self)
+        session.servers_pool.learn(
+            self.transport.client, self.factory, self.transport)
         log.info('tcp_connection from %s' % repr(self.transport.client))
         
     def dataReceived(self, data):
-        if not (host, port) in self.factory.echoers:
-            self.factory.echoers.append((host, port))
-            
         host, port = self.transport.client
+        session.servers_pool.learn((host, port), self.factory, self.transport)
         self.dataReceivedHandler((host, port), data)
         
     def connectionLost(self, reason):
         #todo: -> remove this client form the session_ctx_table
         log.info('connection Lost')
         self.factory.echoers.remove(self)
+        session.servers_pool.forget(self.transport.client)
+        session.msg_packer.discard(self.transport.client)
         
         
 class TCPServerFactory(ServerFactory):
     protocol = TCPServerPrtocol
-    echoers = []
+    
+    def __init__(self):
+        # open connections only, removed on connectionLost
+        self.echoers = []
         
     def _broadcast(self, clients, data):
         for client in clients:
@@ -58,45 +75,112 @@ class TCPServerFactory(ServerFactory):
         
     def send_all(self, data):
         self._broadcast(self.echoers, data)
+        
+    def write(self, transport, (host, port), data):
+        '''called by the servers pool with the connection to (host, port)'''
+        transport.write(data)
             
     def send_to(self, (host, port), data):
-        for e in self.echoers:
-            if e.transport.client == (host, port):
-                #print 'TCPServerFactory.send_to', (host, port), repr(data)
-                e.transport.write(data)
-                return True
+        route = session.servers_pool.known_address((host, port))
+        if route and route[0] is self:
+            self.write(route[1], (host, port), data)
+            return True
                 
     def connected_to(self, (host, port)):
-        for e in self.echoers:
-            if e.transport.client == (host, port):
-                return True
+        route = session.servers_pool.known_address((host, port))
+        return bool(route) and route[0] is self
 
 class UDPServer(DatagramProtocol):
-    echoers = []
+    implements(IBulkDatagramProtocol)
     dataReceivedHandler = session.recv_msg
+    # rtp of established calls is relayed right here, on the reactor
+    mediaHandler = session.relay_rtp
     
     def startProtocol(self):
         pass
         
     def datagramReceived(self, data, (host, port)):
-        if not (host, port) in self.echoers:
-            self.echoers.append((host, port))
+        session.servers_pool.learn((host, port), self, self.transport)
         
-        self.dataReceivedHandler((host, port), data)
+        if not self.mediaHandler((host, port), data):
+            self.dataReceivedHandler((host, port), data)
+    
+    def datagramsReceived(self, datagrams):
+        '''all the datagrams read by the port in one reactor iteration.
+        the signaling among them is handled first, the rtp after it'''
+        learn = session.servers_pool.learn
+        media = []
+        for data, (host, port) in datagrams:
+            learn((host, port), self, self.transport)
+            
+            if rtp_route(data):
+                media.append((data, (host, port)))
+            else:
+                self.dataReceivedHandler((host, port), data)
+                
+        for data, (host, port) in media:
+            if not self.mediaHandler((host, port), data):
+                self.dataReceivedHandler((host, port), data)
     
     def send_all(self, data):
-        for (host, port) in self.echoers:
+        for (host, port) in list(session.servers_pool.addresses(self)):
             self.send_to((host, port), data)
             
+    def write(self, transport, (host, port), data):
+        '''called by the servers pool, transport is the listening port'''
+        transport.write(data, (host, port))
+            
     def send_to(self, (host, port), data):
         if self.connected_to((host, port)):
             self.transport.write(data, (host, port))
 
     def connected_to(self, (host, port)):
-        return (host, port) in self.echoers
+        route = session.servers_pool.known_address((host, port))
+        return bool(route) and route[0] is self
         
 
-def serve(listeners):
+class MediaPeers(object):
+    '''ctx_table observer, connects the udp listener of each party of an 
+    established call to that party (see udp.Port.connectPeer), so the 
+    relayed rtp leaves through a connected socket. the routes are changed 
+    on the reactor thread, in the order the calls were told about'''
+    def __init__(self):
+        # call_ctx -> [(udp port, address)] connected for the call
+        self.calls = dict()
+        # (udp port, address) -> number of calls using it
+        self.refs = dict()
+        
+    def __call__(self, event, call):
+        addrs = [session.ctx_table.get_addr(client_ctx) 
+            for client_ctx in (call.caller_ctx, call.callee_ctx)]
+        reactor.callFromThread(self.update, event, call.ctx_id, addrs)
+        
+    def update(self, event, call_ctx, addrs):
+        try:
+            for peer in self.calls.pop(call_ctx, ()):
+                self.refs[peer] -= 1
+                if not self.refs[peer]:
+                    del self.refs[peer]
+                    peer[0].disconnectPeer(peer[1])
+                    
+            if event != 'route':
+                return
+            peers = self.calls[call_ctx] = []
+            for addr in addrs:
+                route = addr and session.servers_pool.known_address(addr)
+                if not route or not isinstance(route[0], UDPServer):
+                    continue
+                peer = (route[1], addr)
+                if peer in self.refs or peer[0].connectPeer(addr):
+                    self.refs[peer] = self.refs.get(peer, 0) + 1
+                    peers.append(peer)
+        except:
+            log.exception('exception')
+            
+def serve(listeners, reuse_port=False, sockets=None):
+    '''reuse_port - share the udp ports with the media workers
+    sockets - {(proto, port): socket} handed over by the server this one 
+        took over from, see handoff.py'''
     starters = {
         'tcp': TCPServerFactory,
         'udp': UDPServer }
@@ -105,12 +189,46 @@ def serve(listeners):
         'tcp': reactor.listenTCP,
         'udp': reactor.listenUDP }
     
+    if reuse_port:
+        reactor_listen['udp'] = lambda port, protocol: reactor.listenWith(
+            ReusePort, port, protocol)
+    elif config.UDP_PEER_SOCKETS:
+        reactor_listen['udp'] = lambda port, protocol: reactor.listenWith(
+            PeerPort, port, protocol)
+    
+    adopted = {
+        'tcp': handoff.AdoptedTCPPort,
+        'udp': handoff.AdoptedUDPPort }
+    
     for proto, port in listeners:
         starter = starters[proto]()
-        reactor_listen[proto](port, starter)
-        session.servers_pool.add(proto, starter)
+        if sockets and (proto, port) in sockets:
+            listening = reactor.listenWith(adopted[proto], 
+                sockets[(proto, port)], starter)
+        else:
+            listening = reactor_listen[proto](port, starter)
+        if proto == 'udp':
+            listening.maxThroughput = config.UDP_READ_BYTES
+            # connected sockets would pull the media of their peers 
+            # away from the other workers. an adopted socket is shared 
+            # only if the server it came from bound it so
+            if not reuse_port:
+                listening.maxPeers = config.UDP_PEER_SOCKETS
+        session.servers_pool.add(proto, starter, listening)
+        # the clients restored from a snapshot reached the server here
+        session.servers_pool.resume(proto, port, starter, listening)
         log.info( 'serving %s on port %s' % (proto, port))
         
+    # the restored addresses of listeners which are gone
+    session.servers_pool.restored.clear()
+    
+    if config.UDP_PEER_SOCKETS and not reuse_port:
+        peers = MediaPeers()
+        session.ctx_table.observers.append(peers)
+        # the calls restored from a snapshot
+        for call in session.ctx_table.calls():
+            peers('route', call)
+        
     #~ reactor.listenTCP(logging.DEFAULT_TCP_LOGGING_PORT, BroadcastFactory())
     reactor.run(installSignalHandlers=0)
     
\ No newline at end of file
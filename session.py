@@ -9,79 +9,180 @@ __version__ = '0.1'
 __license__ = 'GPLv3'
 
 import time, Queue, struct, uuid, threading, sys, traceback
+from contextlib import contextmanager
 
 from twisted.internet import reactor
-import dblayer, messages, config
+import dblayer, messages, config, g711
 
 from messages import *
 from messagefields import *
-from utils import Storage
+from utils import Storage, Record, StripedLocks
 from config import *
 from decorators import printargs
+from expiry import ExpiryWheel
+from allocator import CtxAllocator
 from logger import log, cdr_logger
-from pprint import PrettyPrinter
+from metrics import registry, Histogram, ReactorLag
+from scheduler import ClassQueue
 
-ppformat = PrettyPrinter().pformat
-rlock = lambda: threading.RLock()
 thread_loop_active = True
 
 class Packer(object):
-    '''Packs parts of message into a message object and enqueue it'''
-    def __init__(self, queue):
+    '''Decodes the bytes of every source (udp address or tcp peer) into 
+    frames, packs each complete frame into a message object and enqueue it.
+    
+    A read may carry any number of frames, a frame may span reads. 
+    The bytes of an incomplete frame are kept per source, bounded by 
+    MAX_REASSEMBLY_BYTES and dropped by expire() if the frame is not 
+    completed within REASSEMBLY_TIMEOUT seconds.'''
+    def __init__(self, queue, max_bytes=MAX_REASSEMBLY_BYTES, 
+        timeout=REASSEMBLY_TIMEOUT):
+        # source -> (bytearray, time the partial frame was first seen)
         self.clients = dict()
         self.queue = queue
         self.parser = Parser()
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.expiry = ExpiryWheel(EXPIRY_TICK)
         
     def pack(self, client, msg):
         try:
-            self._recv(client, msg)
-            
-            # check if msg is ready to be packed
-            if self.parser.eof(msg):
-                msg = self.clients[client]
-                if self.parser.valid(msg):
-                    msg_type, buf = self.parser.body(self.clients[client])
-                    ctr = MessageTypes[msg_type]
-                    cm = CommMessage(client, ctr, buf)
-                    self.queue.put(cm)
-                else:
-                    log.warning('unpackable (invalid) message %s' % repr(msg))
-                
-                # clean the packing pipeline for this client
-                del self.clients[client]
+            pending = self.clients.get(client)
+            if pending is None:
+                # the common case, whole frames in a single read, no copies
+                offset = self._decode(client, msg)
+                if offset < len(msg):
+                    self._keep(client, bytearray(msg[offset:]), time.time())
             else:
-                if client not in self.clients:
-                    log.info('msg ignored')
+                buf, started = pending
+                buf.extend(msg)
+                offset = self._decode(client, buf)
+                if offset == 0:
+                    # still the same frame, already scheduled
+                    self._check_size(client, buf)
+                elif offset < len(buf):
+                    # a new partial frame starts
+                    del buf[:offset]
+                    self._keep(client, buf, time.time())
                 else:
-                    log.info('no eof. waiting for more bytes')
+                    self.clients.pop(client, None)
         except:
             log.exception('exception')
             
-    # receives the message and store it in the clients[client]
-    def _recv(self, client, msg):
-        try:
-            # new client or new message
-            if client not in self.clients:
-                # check if message starts fine
-                if self.parser.bof(msg):
-                    # save the incoming msg
-                    self.clients[client] = msg
+    def _keep(self, client, buf, started):
+        '''stores the partial frame of client until more bytes arrive'''
+        if self._check_size(client, buf):
+            self.clients[client] = (buf, started)
+            self.expiry.schedule(client, started + self.timeout)
+            
+    def _check_size(self, client, buf):
+        '''drops the partial frame of client if it grew too large'''
+        if len(buf) > self.max_bytes:
+            log.warning('%s exceeds %d bytes of a partial frame (dropped)' 
+                % (repr(client), self.max_bytes))
+            self.clients.pop(client, None)
+            return False
+        return True
+            
+    def _decode(self, client, data):
+        '''enqueues every complete frame in data, 
+        returns the offset of the first byte which is not consumed'''
+        offset, size = 0, len(data)
+        while size - offset >= Framer.OVERHEAD:
+            bof, msg_type, length = Framer.HEADER.unpack_from(data, offset)
+            end = offset + Framer.OVERHEAD + length
+            if (bof != Framer.BOF or length < 0 
+                or msg_type not in MessageTypes):
+                log.info('unknown message from %s (ignored)' % repr(client))
+                offset = self._resync(data, offset)
+                continue
+                
+            if end > size:
+                # waiting for more bytes
+                break
+                
+            if data[end - Framer.EOF_LEN:end] != Framer.EOF:
+                log.warning('unpackable (invalid) message from %s' 
+                    % repr(client))
+                offset = self._resync(data, offset)
+                continue
+                
+            msg_class = MessageTypes[msg_type]
+            requests_received[msg_class].inc()
+            if self.queue.shedding(message_class(msg_class)):
+                # would be dropped by the queue, not worth decoding
+                requests_shed.inc()
+                offset = end
+                continue
+                
+            body = data[offset + Framer.HEADER_LEN:end - Framer.EOF_LEN]
+            try:
+                request = CommMessage(client, msg_class, str(body))
+                if not request.valid():
+                    log.info('malformed %s from %s (ignored)' 
+                        % (msg_class.__name__, repr(client)))
+                elif admission.admit(msg_class):
+                    self.queue.put(request, False)
                 else:
-                    log.info(
-                        'unknown message from an unknown client (ignored)')
-            else:
-                # concatenate the incoming message to previous packets
-                self.clients[client] = self.clients[client] + msg
-        except:
-            log.exception('exception')
+                    admission.turn_away(client, msg_class)
+            except Queue.Full:
+                requests_shed.inc()
+            except:
+                log.exception('exception')
+            offset = end
+            
+        # a tail which can't be the start of a frame is thrown away
+        if offset < size and not Framer.BOF.startswith(
+                str(data[offset:offset + Framer.BOF_LEN])):
+            log.info('unknown message from %s (ignored)' % repr(client))
+            offset = self._resync(data, offset)
+        return offset
+        
+    def _resync(self, data, offset):
+        '''offset of the next BOF after offset, the end if there is none'''
+        next_bof = data.find(Framer.BOF, offset + 1)
+        if next_bof == -1:
+            return len(data)
+        return next_bof
+        
+    def _deadline(self, client):
+        pending = self.clients.get(client)
+        return pending and pending[1] + self.timeout
+        
+    def expire(self, now):
+        '''drops the partial frames which were not completed in time'''
+        for client in self.expiry.expire(now, self._deadline):
+            log.warning('partial frame from %s timed out (dropped)' 
+                % repr(client))
+            self.clients.pop(client, None)
+            
+    def discard(self, client):
+        '''the source has gone, e.g. its tcp connection was closed'''
+        self.clients.pop(client, None)
+        self.expiry.discard(client)
 
-'''a pool of all the listeners (tcp+udp) and their known clients'''
-class ServersPool(Storage):
+class ServersPool(dict):
+    '''a pool of all the listeners (tcp+udp) and a routing table of 
+    their known clients, address -> (server, transport)'''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        # addresses owned by a client context
+        self.routes = dict()
+        # addresses seen on the wire but not claimed by a client (yet).
+        # sweep() ages them in two generations, so an unclaimed address 
+        # is forgotten one to two sweeps after its last packet
+        self.pending = dict()
+        self.pending_old = dict()
+        # addresses of the clients restored from a snapshot, routed again 
+        # once their listener is open, address -> (proto, listening port)
+        self.restored = dict()
+        
     def send_to(self, (host, port), data):
         if all((host, port, data)):
-            listener = self.known_address((host, port))
-            if listener:
-                listener.server.send_to((host, port), data)
+            route = self.known_address((host, port))
+            if route:
+                server, transport = route
+                server.write(transport, (host, port), data)
                 return
             else:
                 log.info("Unknown address %s:%s at ServerPool.send_to" 
@@ -91,105 +192,270 @@ class ServersPool(Storage):
                 % (host, port, repr(data)))
             
     def known_address(self, (host, port)):
-        '''returns true if found a server which is connected to the client 
-        at the specified address'''
-        for id, listener in self.iteritems():
-            if listener.server.connected_to((host, port)):
-                return listener
+        '''returns the (server, transport) connected to the client 
+        at the specified address, None if unknown'''
+        addr = (host, port)
+        return (self.routes.get(addr) 
+            or self.pending.get(addr) 
+            or self.pending_old.get(addr))
+        
+    def learn(self, addr, server, transport):
+        '''called by the listeners for every packet they receive'''
+        if addr not in self.routes and addr not in self.pending:
+            self.pending[addr] = (server, transport)
+            
+    def claim(self, addr):
+        '''a client context lives at addr, keep the route until released'''
+        route = self.pending.pop(addr, None) or self.pending_old.pop(addr, None)
+        if route:
+            self.routes[addr] = route
+            
+    def release(self, addr):
+        '''the client context which lived at addr has gone'''
+        self.routes.pop(addr, None)
+        
+    def forget(self, addr):
+        '''the connection to addr was closed'''
+        for table in (self.routes, self.pending, self.pending_old):
+            table.pop(addr, None)
+            
+    def sweep(self):
+        '''ages the unclaimed addresses by one generation'''
+        self.pending_old = self.pending
+        self.pending = dict()
+        
+    def listener_of(self, addr):
+        '''(proto, listening port) addr is routed through, None if unknown'''
+        route = self.known_address(addr)
+        if route:
+            for entry in self.values():
+                if entry.server is route[0]:
+                    return entry.proto, route[1].getHost().port
+                    
+    def resume(self, proto, port, server, transport):
+        '''routes the restored addresses of the listener just opened. 
+        a tcp client is back once it connects again'''
+        for addr, listener in self.restored.items():
+            if listener == (proto, port):
+                del self.restored[addr]
+                if proto == 'udp':
+                    self.routes[addr] = (server, transport)
+                    
+    def addresses(self, server):
+        '''all the addresses routed through server'''
+        for table in (self.routes, self.pending, self.pending_old):
+            for addr, route in table.items():
+                if route[0] is server:
+                    yield addr
+        
+    def add(self, proto, server, listening=None):
+        '''listening - the listening port of server'''
+        self[uuid.uuid4().hex] = Storage(proto = proto, server=server, 
+            listening=listening)
+        
+class CtxTable(dict):
+    '''client contexts keyed by client_ctx.
+    a plain dict (not a Storage) so the indexes below are attributes 
+    of the table rather than entries in it.
+    
+    any thread may call the methods below. a client, its call and its 
+    index entries are changed only by the holder of the lock stripe 
+    of that client, an operation on a call holds the stripes of both 
+    parties (see locked()). reads take no lock, and whatever iterates 
+    the table gets a copy (clients(), calls()).'''
+    def __init__(self, *args, **kwargs):
+        self.stripes = StripedLocks(kwargs.pop('stripes', LOCK_STRIPES))
+        dict.__init__(self, *args, **kwargs)
+        # call_ctx -> call, every call which is current for some client
+        self.active_calls = dict()
+        # client_ctx -> the other party's ctx, for both parties of a call
+        self.peers = dict()
+        # callables(event, call), told when the route of a call is set 
+        # ('route') or removed ('drop'), see workers.py
+        self.observers = []
+        
+    def _parties(self, ctxs):
+        '''ctxs and the parties of their calls'''
+        parties = set(ctxs)
+        for client_ctx in ctxs:
+            parties.add(self.peers.get(client_ctx))
+            client = self.get(client_ctx)
+            call = client and client.current_call
+            if call:
+                parties.update((call.caller_ctx, call.callee_ctx))
+        parties.discard(None)
+        return parties
+        
+    @contextmanager
+    def locked(self, *ctxs):
+        '''holds the stripes of ctxs and of the other parties of their 
+        calls. the parties are read before the stripes are taken, if they 
+        changed meanwhile the stripes are taken again'''
+        while True:
+            parties = self._parties(ctxs)
+            stripes = self.stripes.acquire(parties)
+            if self._parties(ctxs) <= parties:
+                break
+            self.stripes.release(stripes)
+        try:
+            yield
+        finally:
+            self.stripes.release(stripes)
+        
+    def _notify(self, event, call):
+        for observer in self.observers:
+            try:
+                observer(event, call)
+            except:
+                log.exception('exception')
+        
+    def add_call(self, call):
+        '''make call the current call of both parties, 
+        False if any of them is gone'''
+        with self.locked(call.caller_ctx, call.callee_ctx):
+            if call.caller_ctx not in self or call.callee_ctx not in self:
+                return False
+            for client_ctx in (call.caller_ctx, call.callee_ctx):
+                previous = self[client_ctx].current_call
+                if previous and previous.ctx_id != call.ctx_id:
+                    log.warning('call <%s> replaced by <%s>' 
+                        % (repr(previous.ctx_id), repr(call.ctx_id)))
+                    self._drop_call(previous)
+                self[client_ctx].current_call = call
                 
-        return None
+            self.active_calls[call.ctx_id] = call
+            self.peers[call.caller_ctx] = call.callee_ctx
+            self.peers[call.callee_ctx] = call.caller_ctx
+            self._notify('route', call)
+            return True
         
-    def add(self, proto, server):
-        self[uuid.uuid4().hex] = Storage(proto = proto, server=server)
+    def _drop_call(self, call):
+        '''clears call from both parties and from the indexes.
+        the caller holds the stripes of both parties'''
+        for client_ctx, other_ctx in ((call.caller_ctx, call.callee_ctx), 
+                (call.callee_ctx, call.caller_ctx)):
+            client = self.get(client_ctx)
+            if client and client.current_call \
+                and client.current_call.ctx_id == call.ctx_id:
+                client.current_call = None
+            if self.peers.get(client_ctx) == other_ctx:
+                del self.peers[client_ctx]
+                
+        if call.ctx_id in self.active_calls:
+            del self.active_calls[call.ctx_id]
+            call_ids.release(call.ctx_id)
+            self._notify('drop', call)
         
-class CtxTable(Storage):
     def add_client(self, (client_ctx, data)):
-        with rlock():
-            if len(self.keys()) < NUM_OF_USERS:
+        '''returns False if the table is full'''
+        with self.locked(client_ctx):
+            previous = self.get(client_ctx)
+            if previous or len(self) < NUM_OF_USERS:
+                if previous and self.client_call(client_ctx):
+                    # logged in again, the call of the old context is over
+                    self.terminate_call(client_ctx, False)
+                if previous and previous.addr != data.addr:
+                    servers_pool.release(previous.addr)
                 self[client_ctx] = data
+                servers_pool.claim(data.addr)
+                client_expiry.schedule(client_ctx, data.expire)
+                return True
+            return False
             
     def remove_client(self, client_ctx):
-        with rlock():
+        with self.locked(client_ctx):
             client = self.get(client_ctx)
             if client:
                 # clear other's party call before removing this party
                 self.terminate_call(client_ctx, False)
                 del self[client_ctx]
+                client_ids.release(client_ctx)
+                servers_pool.release(client.addr)
         
     def clear_orphan_calls(self):
-        for ctx in self.clients_ctx():
-            call = self[ctx].current_call
+        '''drops calls which are no longer current for both parties'''
+        for call in self.calls():
+            with self.locked(call.caller_ctx, call.callee_ctx):
+                caller = self.get(call.caller_ctx)
+                callee = self.get(call.callee_ctx)
+                if not (caller and caller.current_call 
+                        and caller.current_call.ctx_id == call.ctx_id
+                        and callee and callee.current_call 
+                        and callee.current_call.ctx_id == call.ctx_id):
+                    log.warning('ORPHAN CALL REMOVED: CTX ', call.ctx_id)
+                    self._drop_call(call)
+        
+    def mark_answer(self, client_ctx, codec=None):
+        '''the call of client_ctx was answered with codec'''
+        with self.locked(client_ctx):
+            call = self.client_call(client_ctx)
             if call:
-                other_ctx = (call.caller_ctx != ctx and call.caller_ctx) \
-                    or call.callee_ctx
-                
-                if (# other party not exists
-                    not self.get(other_ctx)
-                    
-                    # other party not in call
-                    or not self[other_ctx].current_call
-                    
-                    #other party in call with someone else
-                    or (self[other_ctx].current_call.callee_ctx != ctx
-                        and self[other_ctx].current_call.caller_ctx != ctx)):
-                            
-                    log.warning('ORPHAN CALL REMOVED: CTX ', ctx)
-                    self[ctx].current_call = None
-        
-    def mark_answer(self, client_ctx):
-        call = self.client_call(client_ctx)
-        if call:
-            caller_ctx, callee_ctx = call.caller_ctx, call.callee_ctx
-            if self.get(caller_ctx):
-                self[caller_ctx].current_call.answer_time = time.time()
-            if self.get(callee_ctx):
-                self[callee_ctx].current_call.answer_time = time.time()
+                now = time.time()
+                call.answer_time = now
+                # from now on the call lives as long as media flows
+                call.rtp_expire = now + RTP_EXPIRE
+                call_expiry.schedule(call.ctx_id, call.rtp_expire)
+                call.codec = codec
+                if call.caller_codec:
+                    if not g711.table(call.caller_codec, codec):
+                        # the callee took the codec of the caller
+                        call.caller_codec = None
+                    # the media route depends on it, see rtp_table
+                    self._notify('route', call)
                 
     def terminate_call(self, client_ctx, per_request=True):
-        call = self.client_call(client_ctx)
-        if call:
-            log.info('hanging up call <%s>' % repr(call.ctx_id))
-            call.end_time = time.time()
-            cdr_logger.writeline(call)
-            caller_ctx, callee_ctx = call.caller_ctx, call.callee_ctx
-            if self.get(caller_ctx):
-                self[caller_ctx].current_call = None
-            if self.get(callee_ctx):
-                self[callee_ctx].current_call = None
-            
-            ctx_table.pprint()
-        else:
+        with self.locked(client_ctx):
+            call = self.client_call(client_ctx)
+            if call:
+                log.info('hanging up call <%s>' % repr(call.ctx_id))
+                call.end_time = time.time()
+                cdr_logger.writeline(call)
+                self._drop_call(call)
+            
+        if not call:
             log.info('no calls for client <%s>' % repr(client_ctx))
             
+    # copies, safe to iterate while other threads change the table
     def clients_ctx(self):
         '''all active clients (the keys)'''
-        return self.iterkeys()
+        return self.keys()
             
     def clients(self):
         '''all active clients (the values)'''
-        return self.itervalues()
+        return self.values()
             
     def calls(self):
         '''all active calls'''
-        return (self[client_ctx].current_call 
-                for client_ctx in self.clients_ctx() 
-                if self[client_ctx].current_call)
+        return self.active_calls.values()
             
     def calls_ctx(self):
         '''all active calls contexts ids'''
-        return (call.ctx_id for call in self.calls())
+        return self.active_calls.keys()
             
     def find_call(self, call_ctx):
-        for call in self.calls():
-            if call.ctx_id == call_ctx:
-                return call
-        return None
+        return self.active_calls.get(call_ctx)
+        
+    def peer_addr(self, client_ctx, call_ctx):
+        '''O(1) address of the other party of call_ctx, 
+        None unless client_ctx takes part in that call'''
+        call = self.active_calls.get(call_ctx)
+        return call and self.call_peer_addr(call, client_ctx)
+        
+    def call_peer_addr(self, call, client_ctx):
+        '''address of the party of call which is not client_ctx'''
+        if call.caller_ctx == client_ctx:
+            other = self.get(call.callee_ctx)
+        elif call.callee_ctx == client_ctx:
+            other = self.get(call.caller_ctx)
+        else:
+            return None
+        return other and other.addr
         
     def get_other_addr(self, client_ctx, call_ctx=config.EMPTY_CTX):
         call = None
         if call_ctx != config.EMPTY_CTX:
             call = self.find_call(call_ctx)
-        else:
+        elif client_ctx in self:
             call = self[client_ctx].current_call
             
         if call:
@@ -205,26 +471,79 @@ class CtxTable(Storage):
         
     def get_addr(self, client_ctx):
         '''return the last ip address registered for this client'''
-        return client_ctx in self.clients_ctx() and self[client_ctx].addr
+        return client_ctx in self and self[client_ctx].addr
             
     def set_addr(self, client_ctx, (host, port)):
         '''register the last ip address for this client, used for replies'''
-        if client_ctx in self.clients_ctx():
-            self[client_ctx].addr = (host, port)
+        with self.locked(client_ctx):
+            client = self.get(client_ctx)
+            if not client or client.addr == (host, port):
+                return
+            servers_pool.release(client.addr)
+            client.addr = (host, port)
+            servers_pool.claim((host, port))
+            call = client.current_call
+            if call and call.ctx_id in self.active_calls:
+                self._notify('route', call)
             
     def client_call(self, client_ctx):
-        call_ctx = None
-        if client_ctx in self.clients_ctx():
+        if client_ctx in self:
             call = self[client_ctx].current_call
-            if not call:
-                for call in self.calls():
-                    if (call.caller_ctx == client_ctx 
-                        or call.callee_ctx == client_ctx):
-                        return call
+            if not call and client_ctx in self.peers:
+                # the other party may still hold the call
+                other = self.get(self.peers[client_ctx])
+                call = other and other.current_call
+                if call and client_ctx not in (call.caller_ctx, 
+                        call.callee_ctx):
+                    call = None
             return call
             
-    def pprint(self):
-        log.info('\nContextTable:\n%s>' % ppformat (self))
+    # introspection, for the admin endpoint (see admin.py). these walk 
+    # the table, call them on a thread of their own, never on the 
+    # message path
+    def summary(self):
+        '''counts of the clients by status and of the calls by state'''
+        statuses = dict((code, name) for name, code in ClientStatus.items())
+        by_status = dict()
+        for client in self.clients():
+            status = statuses.get(client.status, repr(client.status))
+            by_status[status] = by_status.get(status, 0) + 1
+        calls = self.calls()
+        answered = len([call for call in calls if call.answer_time])
+        return dict(clients=len(self), clients_by_status=by_status, 
+            calls=len(calls), calls_answered=answered, 
+            calls_ringing=len(calls) - answered, 
+            client_ids=len(client_ids), call_ids=len(call_ids))
+            
+    def describe_client(self, client_ctx):
+        '''the fields of the client, None if it is not logged in'''
+        client = self.get(client_ctx)
+        if client:
+            fields = client.as_dict()
+            fields['current_call'] = (client.current_call 
+                and client.current_call.ctx_id)
+            for name, code in ClientStatus.items():
+                if client.status == code:
+                    fields['status'] = name
+            return fields
+            
+    def describe_call(self, call_ctx):
+        '''the fields of the call, None if it is not active'''
+        call = self.find_call(call_ctx)
+        return call and call.as_dict()
+        
+    def page(self, table, ids, cursor=0, limit=100):
+        '''(keys, next_cursor), up to limit keys of table in the slot 
+        order of ids, their allocator, from slot cursor on. next_cursor 
+        is None on the last page. walks the slots of the page only, 
+        whatever the size of the table'''
+        keys = []
+        for slot, ctx in ids.issued(cursor):
+            if ctx in table:
+                if len(keys) == limit:
+                    return keys, slot
+                keys.append(ctx)
+        return keys, None
         
 def recv_msg(caller, (host, port), msg):
     try:
@@ -233,25 +552,77 @@ def recv_msg(caller, (host, port), msg):
     except:
         log.exception('exception')
             
+def relay_rtp(caller, (host, port), msg):
+    '''media fast path, called by the udp listener on the reactor thread.
+    forwards a ClientRTP datagram to the other party of the call, as is 
+    or converted to its codec (see rtp_table), and returns True, returns
+    False if msg must take the regular path (not an rtp message, partial
+    frame, unknown call)'''
+    try:
+        route = rtp_route(msg)
+        if not route:
+            return False
+            
+        client_ctx, call_ctx = route
+        call = ctx_table.find_call(call_ctx)
+        other_addr = call and ctx_table.call_peer_addr(call, client_ctx)
+        if not other_addr:
+            return False
+            
+        touch_client(client_ctx, ClientRTP, call)
+        table = call.caller_codec and rtp_table(call, client_ctx)
+        if table:
+            msg = rtp_translate(msg, table)
+        servers_pool.send_to(other_addr, msg)
+        rtp_relayed.inc()
+        rtp_relayed_bytes.inc(len(msg))
+        return True
+    except:
+        log.exception('exception')
+        return False
+        
+def rtp_table(call, client_ctx):
+    '''the table converting the rtp client_ctx sends on call for the 
+    other party, None if it is relayed as is'''
+    if not call.caller_codec:
+        return None
+    if client_ctx == call.caller_ctx:
+        return g711.table(call.caller_codec, call.codec)
+    return g711.table(call.codec, call.caller_codec)
+    
+class ClientContext(Record):
+    '''a logged in client, the values of ctx_table'''
+    __slots__ = ('addr', 'status', 'expire', 'last_keep_alive', 'ctx_id', 
+        'current_call', 'client_name')
+        
+class CallContext(Record):
+    '''a call between two clients, current_call of both parties.
+    codec is the one the callee answered with. caller_codec is set when 
+    the caller has another codec and the media is converted (see 
+    g711.py), from the invite until the answer tells'''
+    __slots__ = ('caller_ctx', 'callee_ctx', 'start_time', 'answer_time', 
+        'end_time', 'rtp_expire', 'codec', 'ctx_id', 'caller_codec')
+    
 def create_client_context(comm_msg, status=ClientStatus.Unknown):
     try:
         '''creates the client context for each new logged in client        
-        returns a tuple(ctx_id, client_ctx_data)
-        client_ctx_data.keys() =>
-          addr, status, expire, last_keep_alive, ctx_id, call_ctx, client_name
+        returns a tuple(ctx_id, ClientContext)
         '''
-        ctx_id = comm_msg.client_ctx
         addr = comm_msg.addr
         if servers_pool.known_address(addr):
+            # the same ctx for as long as the user stays logged in
+            ctx_id = client_ids.allocate(comm_msg.msg.username)
+            if ctx_id is None:
+                return None
             now = time.time()
-            ctx = Storage (
+            ctx = ClientContext(
                 addr=addr, 
                 status=status, 
                 expire=now + CLIENT_EXPIRE,
                 last_keep_alive=now, 
                 ctx_id = ctx_id, 
                 current_call = None, 
-                client_name = comm_msg.msg.username.value
+                client_name = comm_msg.msg.username
             )
             return (ctx_id, ctx)
         else:
@@ -262,71 +633,263 @@ def create_client_context(comm_msg, status=ClientStatus.Unknown):
 def create_call_ctx(request):
     try:
         '''creates the call context for each valid invite
-        returns a tuple(ctx_id, call_ctx_data)
-        call_ctx_data.keys() =>
-            caller_ctx, callee_ctx, start_time, answer_time, 
-            end_time, codec, proto, ctx_id
+        returns a tuple(ctx_id, CallContext), None if no call ctx is free
         '''
-        caller_ctx = request.msg.client_ctx.value
-        callee_ctx = string_to_ctx(request.msg.calle_name.value)
-        ctx_id =  string_to_ctx(caller_ctx, callee_ctx)
-        ctx = Storage(
+        caller_ctx = request.msg.client_ctx
+        callee_ctx = client_ids.lookup(request.msg.calle_name)
+        # an invite retransmitted while the call is on gets the same ctx
+        ctx_id = call_ids.allocate((caller_ctx, callee_ctx))
+        if ctx_id is None:
+            return None
+        ctx = CallContext(
             caller_ctx = caller_ctx,
             callee_ctx = callee_ctx,
             start_time = time.time(),
             answer_time = 0,
             end_time = 0,
-            #rtp_expire = 0,
+            rtp_expire = 0,
             codec = None,
-            ctx_id = ctx_id
+            ctx_id = ctx_id,
+            caller_codec = None
         )
         return (ctx_id, ctx)
     except:
         log.exception('exception')
         
+def client_deadline(ctx):
+    '''current expiry of a client, None if it is gone'''
+    client = ctx_table.get(ctx)
+    return client and client.expire
+    
+def call_deadline(call_ctx):
+    '''current media expiry of an answered call, None if it is gone'''
+    call = ctx_table.find_call(call_ctx)
+    return (call and call.answer_time and call.rtp_expire) or None
+    
+def hangup_call(call):
+    '''sends both parties of call the HangupRequest an explicit hangup 
+    of the other party would, the server hangs up on them'''
+    replies = []
+    for client_ctx, other_ctx in ((call.caller_ctx, call.callee_ctx), 
+        (call.callee_ctx, call.caller_ctx)):
+        addr = ctx_table.get_addr(client_ctx)
+        if addr:
+            hangup = HangupRequest()
+            hangup.set_values(client_ctx=other_ctx, call_ctx=call.ctx_id)
+            replies.append(pack_reply(CommMessage(addr, HangupRequest, 
+                hangup.serialize())))
+    # off the handlers, straight to the reactor whatever the pipeline
+    reactor.callFromThread(send_replies, filter(None, replies))
+    
 def remove_old_clients():
     try:
+        last_sweep = time.time()
         while thread_loop_active:
             now = time.time()
-            expired_clients = [client.ctx_id 
-                for client 
-                    in ctx_table.clients() 
-                        if client.expire < now]
-            
+            expired_clients = client_expiry.expire(now, client_deadline)
             for ctx_id in expired_clients:
                 log.info('removing inactive client ' + repr(ctx_id))
                 ctx_table.remove_client(ctx_id)
                 
-            for i in xrange(CLIENT_EXPIRE):
-                if thread_loop_active:
-                    time.sleep(1)
-                else:
-                    break
+            for call_ctx in call_expiry.expire(now, call_deadline):
+                call = ctx_table.find_call(call_ctx)
+                if call:
+                    log.info('no media for %ds, hanging up call <%s>' 
+                        % (RTP_EXPIRE, repr(call_ctx)))
+                    hangup_call(call)
+                    ctx_table.terminate_call(call.caller_ctx)
                     
-            log.info('%d old clients have been removed' % len(expired_clients))
-            ctx_table.clear_orphan_calls()
-            ctx_table.pprint()
+            if expired_clients:
+                log.info('%d old clients have been removed' 
+                    % len(expired_clients))
+                
+            msg_packer.expire(now)
+            users.refresh()
+            
+            if now - last_sweep >= CLIENT_EXPIRE:
+                last_sweep = now
+                ctx_table.clear_orphan_calls()
+                servers_pool.sweep()
+                log.info('%d clients, %d calls' 
+                    % (len(ctx_table), len(ctx_table.active_calls)))
+                log.info('%d users, %d hits, %d misses, %d loaded' 
+                    % (len(users), users.stats.hits, users.stats.misses, 
+                        users.stats.loaded))
+                log.info('outbound %.1f replies/batch, %.1f wakeups/sec' 
+                    % reply_batcher.rates())
+                
+            time.sleep(EXPIRY_TICK)
             
         log.info('terminating thread: remove_old_clients')
     except:
         log.exception('exception')
     
+def handle_request(req):
+    '''runs a single request through the filter and its handlers'''
+    if req.msg_type != ClientRTP:
+        log.info('server received ', req.msg_type, ' to ', req.addr)
+    else:
+        log.debug('server received ', req.msg_type, ' to ', req.addr)
+        
+    started = time.time()
+    _filter(req)
+    elapsed = time.time() - started
+    handler_latency[req.msg_type].observe(elapsed)
+    admission.observe(elapsed)
+    
+def pack_reply(reply):
+    '''returns the reply as (addr, data) ready to be sent, 
+    None if there is nothing to send'''
+    try:
+        if reply and getattr(reply, 'msg') and getattr(reply, 'addr'):
+            if reply.msg_type != ClientRTP:
+                log.info('server sends ', reply.msg_type, ' to ', reply.addr)
+            else:
+                log.debug('server sends ', reply.msg_type, ' to ', reply.addr)
+                
+            replies_sent[reply.msg_type].inc()
+            return reply.addr, Framer.frame(reply.msg_type.type_code, 
+                reply.body)
+    except:
+        log.exception('exception')
+        
+def send_replies(replies):
+    '''writes a batch of (addr, data), runs on the reactor thread'''
+    for addr, data in replies:
+        try:
+            servers_pool.send_to(addr, data)
+        except:
+            log.exception('exception')
+            
+class ReplyBatcher(object):
+    '''Hands the packed replies, (addr, data) pairs, to the reactor 
+    which writes them in a single callback. 
+    
+    While a batch waits for the reactor the replies added meanwhile join 
+    it, so the reactor is woken up once per flush whatever the number of 
+    replies. schedule(fn) arranges for fn to run on the reactor thread.'''
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.pending = []
+        self.lock = threading.Lock()
+        self.stats = Storage(replies=0, batches=0, wakeups=0, largest=0)
+        self.window = (time.time(), 0, 0, 0)
+        
+    def add(self, replies):
+        with self.lock:
+            wake = not self.pending
+            self.pending.extend(replies)
+        if wake:
+            self.stats.wakeups += 1
+            self.schedule(self.flush)
+            
+    def flush(self):
+        with self.lock:
+            replies, self.pending = self.pending, []
+        if replies:
+            self.stats.batches += 1
+            self.stats.replies += len(replies)
+            self.stats.largest = max(self.stats.largest, len(replies))
+            send_replies(replies)
+            
+    def rates(self):
+        '''(replies per batch, wakeups per second) since the last call'''
+        now = time.time()
+        since, replies, batches, wakeups = self.window
+        self.window = (now, self.stats.replies, self.stats.batches, 
+            self.stats.wakeups)
+        return ((self.stats.replies - replies) 
+                / float(max(1, self.stats.batches - batches)),
+            (self.stats.wakeups - wakeups) / max(now - since, 1e-6))
+    
+class Admission(object):
+    '''Admission control, decides on the reactor whether a request is 
+    queued or turned away with ServerOverloaded (see config.py).
+    
+    Only new work, a login or an invite, is ever turned away. The server 
+    is overloaded once the signaling requests waiting in the inbound 
+    queue or the recent handler latency reach their limit, and stays so 
+    until both are under ADMISSION_RESUME of it. An invite is also turned 
+    away while the calls in progress are at ADMISSION_CALLS.'''
+    new_work = (LoginRequest, ClientInvite)
+    # weight of the last request in the recent handler latency
+    weight = 0.05
+    # seconds without a handler running for the recent latency to halve, 
+    # while new work is turned away nothing else may bring it down
+    half_life = 1.0
+    
+    def __init__(self, max_depth=ADMISSION_QUEUE_DEPTH, 
+        max_latency=ADMISSION_LATENCY, max_calls=ADMISSION_CALLS, 
+        resume=ADMISSION_RESUME, alternate_ip=ALTERNATE_SERVER_IP):
+        self.max_depth = max_depth
+        self.max_latency = max_latency
+        self.max_calls = max_calls
+        self.resume = resume
+        # seconds, moving average updated by the handling thread, 
+        # and when it was last updated
+        self.latency = 0.0
+        self.observed = time.time()
+        self.overloaded = False
+        reply = ServerOverloaded()
+        reply.set_values(alternate_ip=alternate_ip)
+        self.reply = reply.pack()
+        
+    def observe(self, elapsed):
+        '''a handler took elapsed seconds'''
+        self.latency += (elapsed - self.latency) * self.weight
+        self.observed = time.time()
+        
+    def recent_latency(self):
+        '''the recent handler latency, decayed by the time no handler ran'''
+        idle = max(0.0, time.time() - self.observed)
+        return self.latency * 0.5 ** (idle / self.half_life)
+        
+    def load(self):
+        '''the inbound queue depth or the recent handler latency, 
+        whichever is closer to its limit, as a share of it'''
+        load = 0.0
+        if self.max_depth:
+            load = (queue_depth(inbound_messages, 'signaling') 
+                / float(self.max_depth))
+        if self.max_latency:
+            load = max(load, self.recent_latency() / self.max_latency)
+        return load
+        
+    def admit(self, msg_type):
+        '''False if a request of msg_type must be turned away'''
+        if msg_type not in self.new_work:
+            return True
+        load = self.load()
+        if load >= 1.0 and not self.overloaded:
+            self.overloaded = True
+            log.info('server is overloaded (load %.2f), new logins and '
+                'invites are sent to %s' % (load, ALTERNATE_SERVER_IP))
+        elif load < self.resume and self.overloaded:
+            self.overloaded = False
+            log.info('server takes new logins and invites again')
+            
+        if self.overloaded:
+            return False
+        return not (msg_type == ClientInvite and self.max_calls 
+            and len(ctx_table.active_calls) >= self.max_calls)
+        
+    def turn_away(self, addr, msg_type):
+        '''tells the client at addr to go to the alternate server'''
+        log.debug('server sends ', ServerOverloaded, ' to ', addr)
+        admission_rejected[msg_type].inc()
+        servers_pool.send_to(addr, self.reply)
+        
 def handle_inbound_queue():
     try:
         while thread_loop_active:
-            try:
-                req = inbound_messages.get(block=0)
-                if req:
-                    if req.msg_type != ClientRTP:
-                        log.info('server received %s to %s' 
-                            % (req.msg_type, repr(req.addr)))
-                    else:
-                        log.debug('server received %s to %s' 
-                            % (req.msg_type, repr(req.addr)))
-                        
-                    _filter(req)
-            except Queue.Empty:
-                time.sleep(0.010)
+            # blocks until a request arrives, stop_pipeline() wakes 
+            # the thread up with None
+            req = inbound_messages.get()
+            if req:
+                try:
+                    handle_request(req)
+                except:
+                    log.exception('exception')
                 
         log.info('terminating thread: handle_inbound_queue')
     except:
@@ -335,40 +898,114 @@ def handle_inbound_queue():
 def handle_outbound_queue():
     while thread_loop_active:
         try:
-            reply = outbound_messages.get(block=0)
-            if reply and getattr(reply, 'msg') and getattr(reply, 'addr'):
-                if reply.msg_type != ClientRTP:
-                    log.info('server sends %s to %s' 
-                        % (reply.msg_type, repr(reply.addr)))
-                else:
-                    log.debug('server sends %s to %s' 
-                        % (reply.msg_type, repr(reply.addr)))
-                    
+            # wait for a reply, then take whatever else arrives within
+            # OUTBOUND_FLUSH_INTERVAL, up to OUTBOUND_BATCH replies
+            replies = []
+            reply = outbound_messages.get()
+            deadline = time.time() + OUTBOUND_FLUSH_INTERVAL
+            while reply:
+                packed = pack_reply(reply)
+                if packed:
+                    replies.append(packed)
+                if len(replies) >= OUTBOUND_BATCH:
+                    break
                 try:
-                    data = reply.msg.pack()
-                    reactor.callFromThread(
-                        servers_pool.send_to,reply.addr, data)
-                        
-                except Exception, inst:
-                    log.exception('exception')
+                    timeout = deadline - time.time()
+                    if timeout > 0:
+                        reply = outbound_messages.get(timeout=timeout)
+                    else:
+                        reply = outbound_messages.get_nowait()
+                except Queue.Empty:
+                    break
                     
-        except Queue.Empty:
-            time.sleep(0.010)
+            if replies:
+                reply_batcher.add(replies)
         except:
             log.exception('exception')
             
     log.info('terminating thread: handle_outbound_queue')
     
+def message_class(msg_class):
+    '''the traffic class of a message type, see TRAFFIC_CLASSES'''
+    if msg_class is ClientRTP:
+        return 'media'
+    return 'signaling'
+    
+def traffic_class(msg):
+    '''the class of a request or a reply in the pipeline queues'''
+    return message_class(msg and msg.msg_type)
+    
+class InlineInbound(object):
+    '''stands in for the inbound queue in the inline pipeline,
+    requests are handled right away on the reactor thread'''
+    def shedding(self, name):
+        return False
+        
+    def put(self, req, block=True):
+        try:
+            handle_request(req)
+        except:
+            log.exception('exception')
+            
+class ReactorOutbound(object):
+    '''stands in for the outbound queue in the inline pipeline,
+    replies are collected and written once per reactor iteration'''
+    def put(self, reply):
+        packed = pack_reply(reply)
+        if packed:
+            reply_batcher.add((packed,))
+        
+def use_pipeline(mode):
+    '''selects how requests travel from the listeners to the handlers, 
+    must be called before the listeners start.
+    'threaded': handlers run on the inbound thread, 
+        replies are sent by the outbound thread. both queues serve 
+        signaling ahead of media, see TRAFFIC_CLASSES.
+    'inline': handlers run on the reactor thread, no queues'''
+    global inbound_messages, outbound_messages, pipeline_mode, reply_batcher
+    if mode == 'inline':
+        inbound_messages = InlineInbound()
+        outbound_messages = ReactorOutbound()
+        reply_batcher = ReplyBatcher(lambda fn: reactor.callLater(0, fn))
+    elif mode == 'threaded':
+        inbound_messages = ClassQueue(TRAFFIC_CLASSES, traffic_class, 
+            inbound_wait, inbound_late)
+        outbound_messages = ClassQueue(TRAFFIC_CLASSES, traffic_class, 
+            outbound_wait, outbound_late)
+        reply_batcher = ReplyBatcher(reactor.callFromThread)
+    else:
+        raise ValueError('unknown pipeline mode %s' % repr(mode))
+        
+    pipeline_mode = mode
+    msg_packer.queue = inbound_messages
+    
+def pipeline_threads():
+    '''the functions to run on their own thread for the current pipeline'''
+    if pipeline_mode == 'threaded':
+        return (handle_inbound_queue, handle_outbound_queue)
+    return ()
+    
+def stop_pipeline():
+    '''wakes up the threads blocked on the queues so they can exit'''
+    if pipeline_mode == 'threaded':
+        for queue in (inbound_messages, outbound_messages):
+            try:
+                queue.put(None, False)
+            except Queue.Full:
+                # a thread with work waiting is not blocked, it sees
+                # thread_loop_active on its next round
+                pass
+
 def _filter(request):
     try:
         _out = None
         msg = request.msg
         msg_type = request.msg_type
-        ctx = getattr(msg, 'client_ctx', None) and msg.client_ctx.value
+        ctx = getattr(msg, 'client_ctx', None)
         
         # login-request, otherwise context must exists in ctx_table
         if not ctx and msg_type != LoginRequest \
-            or (ctx and ctx not in ctx_table.clients_ctx()):                
+            or (ctx and ctx not in ctx_table):                
             log.warning(
                 'filter is throwing away unknown '
                 'msg_type/client_ctx: %s, %s, %s'
@@ -387,7 +1024,7 @@ def _filter(request):
                     % (request.client_ctx, 
                         ctx_table[request.client_ctx].addr, addr))
                 
-                ctx_table[request.client_ctx].addr = addr
+                ctx_table.set_addr(request.client_ctx, addr)
             
             if msg_type == LoginRequest:
                 _out = login_handler(request)
@@ -409,22 +1046,19 @@ def _filter(request):
     except:
         log.exception('exception')
         
-def touch_client(ctx, msg_type):
+def touch_client(ctx, msg_type, call=None):
+    '''pushes the expiry of the client (and of its call, on rtp) forward.
+    only the deadlines are stamped, the expiry wheels pick them up lazily'''
     try:
-        if ctx in ctx_table:
+        client = ctx_table.get(ctx)
+        if client:
             time_stamp = time.time()
-            expire = time_stamp + CLIENT_EXPIRE
-            ctx_table[ctx].last_keep_alive = time_stamp
-            ctx_table[ctx].expire = expire
-            '''
-            if ctx_table[ctx].current_call and msg_type == ClientRTP:
-                caller = ctx_table[ctx].current_call.caller_ctx
-                callee = ctx_table[ctx].current_call.callee_ctx
-                if ctx_table[caller].current_call:
-                    ctx_table[caller].current_call.rtp_expire = expire
-                if ctx_table[callee].current_call:
-                    ctx_table[callee].current_call.rtp_expire = expire
-            '''    
+            client.last_keep_alive = time_stamp
+            client.expire = time_stamp + CLIENT_EXPIRE
+            if msg_type == ClientRTP:
+                call = call or client.current_call
+                if call:
+                    call.rtp_expire = time_stamp + RTP_EXPIRE
                 
     except:
         log.exception('exception')        
@@ -466,7 +1100,7 @@ def login_handler(request):
             codecs = sorted(Codecs.values())
             lr.set_values(client_ctx=ctx_id, client_public_ip=ip , 
                 client_public_port=port, 
-                ctx_expire=ctx_table[ctx_id].expire - time.time(), 
+                ctx_expire=int(ctx_table[ctx_id].expire - time.time()), 
                 num_of_codecs=len(codecs), 
                 codec_list=''.join((c for c in codecs)))
             buf = lr.serialize()
@@ -480,7 +1114,7 @@ def login_handler(request):
             '''returns login-denied reply'''
             ld = ShortResponse()
             ld.set_values(client_ctx = 0, 
-                result = struct.unpack('!h', Errors.LoginFailure))
+                result = struct.unpack('!h', Errors.LoginFailure)[0])
             buf = ld.serialize()
             log.info('login error')
             yield CommMessage(request.addr, ShortResponse, buf)
@@ -488,16 +1122,21 @@ def login_handler(request):
             log.exception('exception')
         
     try:
-        username, password = (request.msg.username.value, 
-            request.msg.password.value)
+        username, password = (request.msg.username, 
+            request.msg.password)
             
         dbuser = verify_login(username, password)
         if dbuser:
             #creates new client context and register it
-            ctx_id, ctx_data = create_client_context(
+            context = create_client_context(
                 request, status=dbuser.login_status)
+            if not context:
+                return deny_login()
                 
-            ctx_table.add_client((ctx_id, ctx_data))
+            ctx_id, ctx_data = context
+            if not ctx_table.add_client((ctx_id, ctx_data)):
+                client_ids.release(ctx_id)
+                return deny_login()
             return reply_login(ctx_id, ctx_data)
         else:
             return deny_login()
@@ -507,8 +1146,7 @@ def login_handler(request):
         
 def logout_handler(request):
     try:
-        with rlock():
-            ctx_table.remove_client(request.client_ctx)
+        ctx_table.remove_client(request.client_ctx)
     except:
         log.exception('exception')
 
@@ -529,8 +1167,8 @@ class CallSession(object):
     def isretransmit(request):        
         if request.msg_type == ClientInvite:
             # case a: A invites B. B is already in call sesssion with A
-            caller_ctx = request.msg.client_ctx.value
-            callee_ctx = string_to_ctx(request.msg.calle_name.value)
+            caller_ctx = request.msg.client_ctx
+            callee_ctx = client_ids.lookup(request.msg.calle_name)
             call = ctx_table[callee_ctx].current_call
             value = (call 
                 and call.callee_ctx == callee_ctx 
@@ -543,8 +1181,8 @@ class CallSession(object):
         
     def _handle_invite(self, request):
         try:
-            caller_ctx = request.msg.client_ctx.value
-            callee_ctx = string_to_ctx(request.msg.calle_name.value)
+            caller_ctx = request.msg.client_ctx
+            callee_ctx = client_ids.lookup(request.msg.calle_name)
             
             # calle is not logged in
             if callee_ctx not in ctx_table:
@@ -562,18 +1200,33 @@ class CallSession(object):
                         request)
 
             #todo: add here `away-status` case handler
-            matched_codecs = self._matched_codecs(request.msg.codec_list.value)
+            matched_codecs = self._matched_codecs(request.msg.codec_list)
             log.debug('matched_codecs: %s' % matched_codecs)
             # caller codecs do not match with the server's
             if not matched_codecs:
                 log.info('codecs mismatch -- rejecting invite')
                 return self._reject(config.Errors.CodecMismatch, request)
             else:
+                caller_codec = None
+                if TRANSCODE_G711:
+                    # the callee may answer with a codec the server 
+                    # converts the caller's to
+                    matched_codecs, caller_codec = g711.widen(
+                        matched_codecs)
                 # create call ctx
-                call_ctx_id, call_ctx = create_call_ctx(request)            
-                # mark the caller as in another call session
-                ctx_table[caller_ctx].current_call = call_ctx
-                ctx_table[callee_ctx].current_call = call_ctx
+                context = create_call_ctx(request)
+                if not context:
+                    log.info('no call ctx is free, rejecting invite.')
+                    return self._reject(config.Errors.CalleeUnavailable, 
+                        request)
+                call_ctx_id, call_ctx = context
+                call_ctx.caller_codec = caller_codec
+                # mark both parties as in this call session
+                if not ctx_table.add_call(call_ctx):
+                    # a party has gone meanwhile
+                    call_ids.release(call_ctx_id)
+                    return self._reject(config.Errors.CalleeNotFound, 
+                        request)
                 # send ServerForwardInvite to the calle
                 return self._forward_invite(call_ctx, matched_codecs)
         except:
@@ -632,16 +1285,17 @@ class CallSession(object):
                 if isinstance(msg, ClientInviteAck):                
                     return self._forward_invite_ack(msg, other_addr)
                 elif isinstance(msg, ClientAnswer):
-                    ctx_table.mark_answer(client_ctx)
-                    return self._forward_client_answer(msg, other_addr)
+                    ctx_table.mark_answer(client_ctx, msg.codec)
+                    return self._forward_client_answer(msg, other_addr, 
+                        call_ctx_data)
                 elif isinstance(msg, (HangupRequest, HangupRequestAck)):
                     return self._handle_hangup(request, other_addr)
             elif isinstance(msg, (HangupRequest)):
                 return self._handle_hangup(request, other_addr)
             else:
-                log.warning('_handle_signaling: call is out of context %s' 
-                    % repr(call_ctx))
-                ctx_table.pprint()
+                out_of_context[request.msg_type].inc()
+                log.warning('_handle_signaling: call is out of context ', 
+                    call_ctx)
                 
         except:
             log.exception('exception')
@@ -661,12 +1315,18 @@ class CallSession(object):
             if call:
                 other_addr = ctx_table.get_other_addr(request.client_ctx, 
                     request.call_ctx)
+                table = call.caller_codec and rtp_table(call, 
+                    request.client_ctx)
+                if table:
+                    request.msg.set_values(
+                        rtp_bytes=request.msg.rtp_bytes.translate(table))
                 buf = request.msg.serialize()
                 yield CommMessage(other_addr, ClientRTP, buf)
             else:
-                log.warning('%s _handle_rtp: call is out of context %s' 
-                    % (repr(self) ,repr(call)))
-                ctx_table.pprint()
+                # stray media after a hangup, common and harmless
+                out_of_context[ClientRTP].inc()
+                log.debug('_handle_rtp: call is out of context ', 
+                    request.call_ctx)
         except:
             log.exception('exception')
             
@@ -676,9 +1336,8 @@ class CallSession(object):
                 % (repr(request.client_ctx), repr(reason)))
             ctx = request.client_ctx
             sri = ServerRejectInvite()
-            result = ShortField(0)
-            result.unpack_from(reason)
-            sri.set_values(client_ctx = ctx, result = result.value)            
+            result = struct.unpack('!h', reason)[0]
+            sri.set_values(client_ctx = ctx, result = result)
             addr = ctx_table.get_addr(request.client_ctx)
             yield CommMessage(addr, ServerRejectInvite, sri.serialize())
         except:
@@ -688,20 +1347,23 @@ class CallSession(object):
         try:
             sfr = ServerForwardRing()
             sfr.set_values(
-                client_ctx = cia.client_ctx.value,
-                call_ctx = cia.call_ctx.value,
-                client_status = cia.client_status.value,
+                client_ctx = cia.client_ctx,
+                call_ctx = cia.call_ctx,
+                client_status = cia.client_status,
                 call_type = call_type,
-                client_public_ip = cia.client_public_ip.value,
-                client_public_port = cia.client_public_port.value)
+                client_public_ip = cia.client_public_ip,
+                client_public_port = cia.client_public_port)
             buf = sfr.serialize()
             yield CommMessage(addr, ServerForwardRing,buf)
         except:
             log.exception('exception')
         
-    def _forward_client_answer(self, msg, addr):
+    def _forward_client_answer(self, msg, addr, call=None):
         try:
             # ?todo?: should copy call_ctx_data from the other party?
+            if call and call.caller_codec:
+                # the caller goes on with its own codec
+                msg.set_values(codec=call.caller_codec)
             buf = msg.serialize()
             yield CommMessage(addr, ClientAnswer,buf)
         except:
@@ -714,19 +1376,122 @@ class CallSession(object):
 # main table which I store all the contexts in
 ctx_table = CtxTable()
 
+# client_ctx of every logged in username, call_ctx of every call
+client_ids = CtxAllocator()
+call_ids = CtxAllocator()
+
 # a reference for all the server launched by the reactor
 servers_pool = ServersPool()
 
+# when to look at each client (CLIENT_EXPIRE) and answered call (RTP_EXPIRE)
+client_expiry = ExpiryWheel(EXPIRY_TICK)
+call_expiry = ExpiryWheel(EXPIRY_TICK)
+
 # Packer.pack will pack each request into this queue
-inbound_messages = Queue.Queue()
+inbound_messages = None
 
 # replies from server to client
-outbound_messages = Queue.Queue()
+outbound_messages = None
 
 # packs any incoming message and put it in the inbound_messages queue
 msg_packer = Packer(inbound_messages)
 
+# writes the replies on the reactor thread
+reply_batcher = None
+
+# sets both queues, see use_pipeline() at the end of the module
+pipeline_mode = None
+
+# turns new work away when the server is overloaded
+admission = Admission()
+
 users = dblayer.Users
     
 #_call_session = CallSession()
 call_session_handler = CallSession().handle
+
+#########################################
+# metrics, see metrics.py and admin.py
+# each is updated by a single thread, the one named
+#########################################
+
+def queue_depth(queue, traffic_class=None):
+    '''requests or replies waiting in queue, of traffic_class if given, 
+    0 in the inline pipeline'''
+    if not isinstance(queue, ClassQueue):
+        return 0
+    if traffic_class:
+        return queue.depth(traffic_class)
+    return queue.qsize()
+
+# reactor (Packer)
+requests_received = registry.family('requests_received', 'type', 
+    keys=[message_type for message_type in MessageTypes.values() 
+        if isinstance(message_type, type)], 
+    help='frames decoded, by message type')
+# inbound thread, the reactor in the inline pipeline
+handler_latency = registry.family('handler_latency_seconds', 'type', 
+    kind=Histogram, help='time to handle a request, by message type')
+# outbound thread, the reactor in the inline pipeline
+replies_sent = registry.family('replies_sent', 'type', 
+    help='replies packed, by message type')
+# inbound thread, the reactor in the inline pipeline
+out_of_context = registry.family('out_of_context', 'type', 
+    help='signaling and rtp of calls which are not active, by type')
+# reactor (Packer)
+admission_rejected = registry.family('admission_rejected', 'type', 
+    help='requests answered with ServerOverloaded, by message type')
+requests_shed = registry.counter('requests_shed', 
+    'requests dropped since their class of the inbound queue was full '
+    'or late')
+# reactor (relay_rtp)
+rtp_relayed = registry.counter('rtp_relayed_packets', 
+    'rtp packets relayed on the media fast path')
+rtp_relayed_bytes = registry.counter('rtp_relayed_bytes', 
+    'bytes of the rtp packets relayed on the media fast path')
+
+traffic_classes = [name for name, weight, limit, deadline in TRAFFIC_CLASSES]
+# inbound thread (ClassQueue.get)
+inbound_wait = registry.family('inbound_wait_seconds', 'class', 
+    kind=Histogram, keys=traffic_classes, 
+    help='time a request waited for a handler, by traffic class')
+inbound_late = registry.family('inbound_late', 'class', 
+    keys=traffic_classes, 
+    help='requests dropped past the deadline of their traffic class')
+# outbound thread (ClassQueue.get)
+outbound_wait = registry.family('outbound_wait_seconds', 'class', 
+    kind=Histogram, keys=traffic_classes, 
+    help='time a reply waited to be packed, by traffic class')
+outbound_late = registry.family('outbound_late', 'class', 
+    keys=traffic_classes, 
+    help='replies dropped past the deadline of their traffic class')
+
+registry.gauge('inbound_queue_depth', 
+    lambda: queue_depth(inbound_messages), 'requests waiting for a handler')
+registry.gauge('outbound_queue_depth', 
+    lambda: queue_depth(outbound_messages), 'replies waiting to be packed')
+registry.gauge('overloaded', lambda: int(admission.overloaded), 
+    'new logins and invites are turned away')
+registry.gauge('handler_latency_recent_seconds', admission.recent_latency, 
+    'moving average of the time to handle a request')
+registry.gauge('reassembly_buffers', lambda: len(msg_packer.clients), 
+    'sources with a partial frame')
+registry.gauge('reassembly_bytes', 
+    lambda: sum(len(buf) for buf, started in msg_packer.clients.values()), 
+    'bytes of the partial frames')
+registry.gauge('active_clients', lambda: len(ctx_table), 
+    'logged in clients')
+registry.gauge('active_calls', lambda: len(ctx_table.active_calls), 
+    'calls in progress')
+registry.gauge('outbound_batches', lambda: reply_batcher.stats.batches, 
+    'batches of replies handed to the reactor')
+registry.gauge('outbound_wakeups', lambda: reply_batcher.stats.wakeups, 
+    'reactor wakeups of the outbound stage')
+registry.gauge('user_directory_size', lambda: len(users), 
+    'users in the user directory cache')
+
+# reactor, started by server.py
+reactor_lag = ReactorLag(registry, REACTOR_LAG_INTERVAL)
+
+# the queues take the metrics above
+use_pipeline(PIPELINE)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+__author__ = 'Tzury Bar Yochay'
+__version__ = '0.1'
+__license__ = 'GPLv3'
+
+'''
+**************************************
+snapshot.py (part of freespeech.py)
+**************************************
+
+snapshots of the session table, so a restart does not log every client
+out. once config.SNAPSHOT_PATH is set, the server writes one every
+config.SNAPSHOT_INTERVAL seconds (if set) and on shutdown, and restores
+the last one on startup, before the listeners open: the clients keep
+their client_ctx, their addresses and their calls.
+
+a snapshot is binary, column by column: the numbers (ids, times, ports)
+as arrays, the strings (names, hosts, statuses, codecs) marshalled.
+the periodic snapshots are written by a forked child, which sees the
+table as it was at the fork while the server carries on.
+'''
+
+__all__ = ['dump', 'load', 'save', 'fork_save', 'restore', 'snapshot_loop']
+
+import os, sys, time, gc, marshal, struct
+from array import array
+from itertools import izip, islice
+
+import session
+from config import SNAPSHOT_PATH, SNAPSHOT_INTERVAL, SNAPSHOT_MAX_AGE, \
+    EXPIRY_TICK, NUM_OF_USERS
+from session import ClientContext, CallContext
+from logger import log
+
+MAGIC = 'FSSNAP02'
+# a snapshot of a server that does not convert codecs (no caller_codec
+# column), the server it takes over from may be one
+MAGIC_01 = 'FSSNAP01'
+# magic, byte order of the arrays, time taken, clients, calls
+HEADER = struct.Struct('!8scdII')
+# every column is prefixed by its length
+LENGTH = struct.Struct('!I')
+BYTE_ORDER = sys.byteorder[0]
+
+def _numbers(typecode, values):
+    return array(typecode, values).tostring()
+
+def dump():
+    '''the session table as a snapshot (a string). takes no lock, the
+    table is expected to stand still (a forked child, a server which is
+    stopping), otherwise the snapshot may miss the last few changes'''
+    table = session.ctx_table
+    clients = table.values()
+    calls = table.active_calls.values()
+    listeners = [session.servers_pool.listener_of(client.addr) or ('', 0)
+        for client in clients]
+
+    columns = []
+    for allocator in (session.client_ids, session.call_ids):
+        generations, free = allocator.state()
+        columns += [generations,
+            _numbers('i', [slot for slot, generation in free]),
+            _numbers('H', [generation for slot, generation in free])]
+    columns += [
+        _numbers('i', [client.ctx_id for client in clients]),
+        _numbers('d', [client.expire for client in clients]),
+        _numbers('d', [client.last_keep_alive for client in clients]),
+        _numbers('H', [client.addr[1] for client in clients]),
+        _numbers('H', [port for proto, port in listeners]),
+        _numbers('i', [client.current_call and client.current_call.ctx_id
+            or 0 for client in clients]),
+        marshal.dumps([client.addr[0] for client in clients]),
+        marshal.dumps([proto for proto, port in listeners]),
+        marshal.dumps([client.client_name for client in clients]),
+        marshal.dumps([client.status for client in clients]),
+        _numbers('i', [call.ctx_id for call in calls]),
+        _numbers('i', [call.caller_ctx for call in calls]),
+        _numbers('i', [call.callee_ctx for call in calls]),
+        _numbers('d', [call.start_time for call in calls]),
+        _numbers('d', [call.answer_time for call in calls]),
+        _numbers('d', [call.end_time for call in calls]),
+        _numbers('d', [call.rtp_expire for call in calls]),
+        marshal.dumps([call.codec for call in calls]),
+        marshal.dumps([call.caller_codec for call in calls])]
+
+    parts = [HEADER.pack(MAGIC, BYTE_ORDER, time.time(), len(clients),
+        len(calls))]
+    for column in columns:
+        parts += [LENGTH.pack(len(column)), column]
+    return ''.join(parts)
+
+def _columns(data, offset):
+    while offset < len(data):
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        yield data[offset:offset + length]
+        offset += length
+
+def load(data, limit=NUM_OF_USERS, now=None):
+    '''fills the empty session table from a snapshot taken by dump(),
+    at most limit clients. the deadlines are pushed forward by the time
+    the snapshot is old, the time the clients could not reach the server.
+    returns the number of clients and of calls restored'''
+    # the collector would walk the growing table every few hundred 
+    # records, none of them is garbage
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _load(data, limit, now)
+    finally:
+        if enabled:
+            gc.enable()
+
+def _load(data, limit, now):
+    magic, byte_order, taken, num_of_clients, num_of_calls = \
+        HEADER.unpack_from(data)
+    if magic not in (MAGIC, MAGIC_01):
+        raise ValueError('not a snapshot of the session table')
+    columns = _columns(data, HEADER.size)
+
+    def numbers(typecode):
+        values = array(typecode)
+        values.fromstring(columns.next())
+        if byte_order != BYTE_ORDER:
+            values.byteswap()
+        return values
+
+    allocators = []
+    for allocator in (session.client_ids, session.call_ids):
+        generations = numbers('H').tostring()
+        allocators.append((allocator, generations,
+            zip(numbers('i'), numbers('H'))))
+
+    shift = max(0.0, (now or time.time()) - taken)
+    table = session.ctx_table
+    restored = session.servers_pool.restored
+    ctxs, expires, keep_alives, ports, listener_ports, current_calls = [
+        numbers(typecode) for typecode in 'iddHHi']
+    hosts, protos, names, statuses = [marshal.loads(columns.next())
+        for i in xrange(4)]
+    # the records are built field by field, keywords cost a lot more
+    new_client = ClientContext.__new__
+    # client_ctx -> call_ctx
+    current = dict()
+    deadlines = []
+    for ctx, expire, keep_alive, host, port, proto, listener_port, name, \
+        status, call_ctx in islice(izip(ctxs, expires, keep_alives, hosts, 
+            ports, protos, listener_ports, names, statuses, current_calls), 
+            limit):
+        client = new_client(ClientContext)
+        client.addr = (host, port)
+        client.status = status
+        client.expire = expire + shift
+        client.last_keep_alive = keep_alive
+        client.ctx_id = ctx
+        client.current_call = None
+        client.client_name = name
+        table[ctx] = client
+        deadlines.append((ctx, client.expire))
+        if proto:
+            restored[(host, port)] = (proto, listener_port)
+        if call_ctx:
+            current[ctx] = call_ctx
+    session.client_expiry.schedule_many(deadlines)
+
+    new_call = CallContext.__new__
+    deadlines = []
+    call_columns = [numbers(typecode) for typecode in 'iiidddd'] + [
+        marshal.loads(columns.next())]
+    if magic == MAGIC:
+        call_columns.append(marshal.loads(columns.next()))
+    else:
+        call_columns.append([None] * len(call_columns[0]))
+    for ctx, caller_ctx, callee_ctx, start, answer, end, rtp_expire, \
+        codec, caller_codec in izip(*call_columns):
+        if caller_ctx not in table or callee_ctx not in table:
+            continue
+        call = new_call(CallContext)
+        call.caller_ctx = caller_ctx
+        call.callee_ctx = callee_ctx
+        call.start_time = start
+        call.answer_time = answer
+        call.end_time = end
+        call.rtp_expire = rtp_expire and rtp_expire + shift
+        call.codec = codec
+        call.ctx_id = ctx
+        call.caller_codec = caller_codec
+        table.active_calls[ctx] = call
+        table.peers[caller_ctx] = callee_ctx
+        table.peers[callee_ctx] = caller_ctx
+        if answer:
+            deadlines.append((ctx, call.rtp_expire))
+    session.call_expiry.schedule_many(deadlines)
+
+    for client_ctx, call_ctx in current.iteritems():
+        table[client_ctx].current_call = table.active_calls.get(call_ctx)
+
+    (client_ids, generations, free), (call_ids, call_generations,
+        call_free) = allocators
+    client_ids.restore(generations, free, dict((ctx, client.client_name)
+        for ctx, client in table.iteritems()))
+    call_ids.restore(call_generations, call_free, dict(
+        (ctx, (call.caller_ctx, call.callee_ctx))
+        for ctx, call in table.active_calls.iteritems()))
+    return len(table), len(table.active_calls)
+
+def _write(path, data):
+    '''replaces path with data, a reader sees either file whole'''
+    temp = '%s.%d' % (path, os.getpid())
+    out = open(temp, 'wb')
+    try:
+        out.write(data)
+        out.flush()
+        os.fsync(out.fileno())
+    finally:
+        out.close()
+    os.rename(temp, path)
+
+def save(path=SNAPSHOT_PATH):
+    '''writes a snapshot to path, on the calling thread'''
+    try:
+        started = time.time()
+        _write(path, dump())
+        log.info('snapshot of %d clients, %d calls written in %.3f sec'
+            % (len(session.ctx_table), len(session.ctx_table.active_calls),
+                time.time() - started))
+    except:
+        log.exception('exception')
+
+def fork_save(path=SNAPSHOT_PATH):
+    '''writes a snapshot to path from a forked child, the calling thread
+    waits for it. the child sees the table as it was at the fork, the
+    pages are copied only as the server changes them'''
+    if not hasattr(os, 'fork'):
+        return save(path)
+    try:
+        started = time.time()
+        pid = os.fork()
+        if pid == 0:
+            # only this thread lives on in the child, whatever lock the
+            # other threads held stays held: no logging, no locks
+            code = 1
+            try:
+                _write(path, dump())
+                code = 0
+            finally:
+                os._exit(code)
+        forked = time.time() - started
+        pid, status = os.waitpid(pid, 0)
+        if status:
+            log.warning('snapshot to %s failed (status %d)' % (path, status))
+        else:
+            log.info('snapshot written in %.3f sec, fork took %.1f msec'
+                % (time.time() - started, forked * 1e3))
+    except:
+        log.exception('exception')
+
+def restore(path=SNAPSHOT_PATH, max_age=SNAPSHOT_MAX_AGE):
+    '''restores the snapshot at path, if there is one and it is recent.
+    call it before the listeners open'''
+    try:
+        if not os.path.exists(path):
+            return
+        age = time.time() - os.path.getmtime(path)
+        if age > max_age:
+            log.info('snapshot %s is %d sec old, not restored' % (path, age))
+            return
+        started = time.time()
+        data = open(path, 'rb').read()
+        clients, calls = load(data)
+        log.info('%d clients, %d calls restored from %s in %.3f sec'
+            % (clients, calls, path, time.time() - started))
+    except:
+        log.exception('exception')
+
+def snapshot_loop():
+    '''writes a snapshot every SNAPSHOT_INTERVAL seconds'''
+    try:
+        due = time.time() + SNAPSHOT_INTERVAL
+        while session.thread_loop_active:
+            if time.time() >= due:
+                fork_save()
+                due = time.time() + SNAPSHOT_INTERVAL
+            time.sleep(EXPIRY_TICK)
+
+        log.info('terminating thread: snapshot_loop')
+    except:
+        log.exception('exception')
@@ -1563,6 +1563,22 @@ class IUDPTransport(Interface):
         """
 
 
+class IBulkDatagramProtocol(Interface):
+    """
+    A datagram protocol which is handed all the datagrams read in one
+    event loop iteration at once, instead of one C{datagramReceived} call
+    per datagram.
+    """
+
+    def datagramsReceived(datagrams):
+        """
+        Called with the datagrams read in one event loop iteration.
+
+        @param datagrams: a list of C{(datagram, addr)} tuples, in the
+            order they were received. C{addr} is a tuple of (ip, port).
+        """
+
+
 class IUDPConnectedTransport(Interface):
     """
     DEPRECATED. Transport for UDP ConnectedPacketProtocols.
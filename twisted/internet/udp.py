@@ -48,11 +48,16 @@ class Port(base.BasePort):
     addressFamily = socket.AF_INET
     socketType = socket.SOCK_DGRAM
     maxThroughput = 256 * 1024 # max bytes we read in one eventloop iteration
+    maxPeers = 0 # max peers connected with connectPeer at once
 
     # Actual port number being listened on, only set to a non-None
     # value when we are actually listening.
     _realPortNumber = None
 
+    # Set when the protocol provides IBulkDatagramProtocol, datagrams are
+    # then handed over a batch at a time.
+    _bulk = False
+
     def __init__(self, port, proto, interface='', maxPacketSize=8192, reactor=None):
         """Initialize with a numeric port to listen on.
         """
@@ -63,6 +68,7 @@ class Port(base.BasePort):
         self.interface = interface
         self.setLogStr()
         self._connectedAddr = None
+        self._peers = {}
 
     def __repr__(self):
         if self._realPortNumber is not None:
@@ -86,6 +92,9 @@ class Port(base.BasePort):
     def _bindSocket(self):
         try:
             skt = self.createInternetSocket()
+            if self.maxPeers:
+                # the sockets of connectPeer share my address
+                skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             skt.bind((self.interface, self.port))
         except socket.error, le:
             raise error.CannotListenError, (self.interface, self.port, le)
@@ -101,16 +110,28 @@ class Port(base.BasePort):
         self.fileno = self.socket.fileno
 
     def _connectToProtocol(self):
+        self._bulk = interfaces.IBulkDatagramProtocol.providedBy(
+            self.protocol)
         self.protocol.makeConnection(self)
         self.startReading()
 
 
     def doRead(self):
         """Called when my socket is ready for reading."""
+        self._readFrom(self.socket)
+
+
+    def _readFrom(self, skt):
+        """
+        Read the pending datagrams of C{skt}, my socket or the socket of
+        one of my connected peers, and deliver them to the protocol.
+        """
+        if self._bulk:
+            return self._doBulkRead(skt)
         read = 0
         while read < self.maxThroughput:
             try:
-                data, addr = self.socket.recvfrom(self.maxPacketSize)
+                data, addr = skt.recvfrom(self.maxPacketSize)
             except socket.error, se:
                 no = se.args[0]
                 if no in (EAGAIN, EINTR, EWOULDBLOCK):
@@ -128,6 +149,39 @@ class Port(base.BasePort):
                     log.err()
 
 
+    def _doBulkRead(self, skt):
+        """
+        Read the pending datagrams of C{skt} and hand them all to the
+        protocol in a single C{datagramsReceived} call.
+        """
+        recvfrom = skt.recvfrom
+        maxThroughput, maxPacketSize = self.maxThroughput, self.maxPacketSize
+        datagrams = []
+        read = 0
+        try:
+            while read < maxThroughput:
+                try:
+                    data, addr = recvfrom(maxPacketSize)
+                except socket.error, se:
+                    no = se.args[0]
+                    if no in (EAGAIN, EINTR, EWOULDBLOCK):
+                        break
+                    if (no == ECONNREFUSED) or (platformType == "win32" and no == WSAECONNRESET):
+                        if self._connectedAddr:
+                            self.protocol.connectionRefused()
+                    else:
+                        raise
+                else:
+                    datagrams.append((data, addr))
+                    read += len(data)
+        finally:
+            if datagrams:
+                try:
+                    self.protocol.datagramsReceived(datagrams)
+                except:
+                    log.err()
+
+
     def write(self, datagram, addr=None):
         """Write a datagram.
 
@@ -149,6 +203,12 @@ class Port(base.BasePort):
                     raise
         else:
             assert addr != None
+            peer = self._peers and self._peers.get(addr)
+            if peer:
+                try:
+                    return peer.send(datagram)
+                except socket.error:
+                    return peer.write(datagram)
             if not addr[0].replace(".", "").isdigit():
                 warnings.warn("Please only pass IPs to write(), not hostnames", DeprecationWarning, stacklevel=2)
             try:
@@ -170,6 +230,60 @@ class Port(base.BasePort):
     def writeSequence(self, seq, addr):
         self.write("".join(seq), addr)
 
+    def connectPeer(self, addr):
+        """
+        Send the datagrams for C{addr} through a socket of their own, bound
+        to my address and connected to C{addr}, so the kernel resolves the
+        route to the peer once rather than on every write.
+
+        Meant for long lived flows (media) to a few peers, anything else is
+        still sent with C{sendto}. The kernel hands the datagrams from
+        C{addr} to the connected socket as well, they are read from it and
+        delivered to the protocol just like the ones I receive.
+
+        My socket is bound to share its address only when C{maxPeers} is
+        set before I start listening, peers cannot be connected otherwise.
+
+        @param addr: a tuple (ip, port).
+        @return: True if C{addr} is connected, False if it could not be
+            (C{maxPeers} are connected, my socket was not bound to share
+            its address, or I am in connected mode).
+        """
+        if addr in self._peers:
+            return True
+        if len(self._peers) >= self.maxPeers or self._connectedAddr:
+            return False
+        if not self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR):
+            return False
+        try:
+            peer = _ConnectedPeer(self, addr)
+        except socket.error:
+            log.err()
+            return False
+        self._peers[addr] = peer
+        peer.startReading()
+        return True
+
+    def disconnectPeer(self, addr):
+        """
+        Go back to sending to C{addr} with C{sendto}, closes the socket
+        opened by L{connectPeer}. The datagrams it received meanwhile are
+        delivered first.
+        """
+        peer = self._peers.pop(addr, None)
+        if peer is not None:
+            try:
+                peer.doRead()
+            except:
+                log.err()
+            peer.connectionLost(None)
+
+    def getPeers(self):
+        """
+        The addresses connected with L{connectPeer}.
+        """
+        return self._peers.keys()
+
     def connect(self, host, port):
         """'Connect' to remote server."""
         if self._connectedAddr:
@@ -202,6 +316,8 @@ class Port(base.BasePort):
         """
         log.msg('(Port %s Closed)' % self._realPortNumber)
         self._realPortNumber = None
+        for addr in self.getPeers():
+            self._peers.pop(addr).connectionLost(reason)
         base.BasePort.connectionLost(self, reason)
         if hasattr(self, "protocol"):
             # we won't have attribute in ConnectedPort, in cases
@@ -232,6 +348,69 @@ class Port(base.BasePort):
         return address.IPv4Address('UDP', *(self.socket.getsockname() + ('INET_UDP',)))
 
 
+class _ConnectedPeer(log.Logger):
+    """
+    A socket bound to the address of a L{Port} and connected to one of its
+    peers, see L{Port.connectPeer}.
+    """
+
+    def __init__(self, port, addr):
+        self.port = port
+        self.addr = addr
+        self.reactor = port.reactor
+        skt = port.createInternetSocket()
+        try:
+            # before the bind, the port bound its own socket the same way
+            skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            skt.bind(port.socket.getsockname())
+            skt.connect(addr)
+        except:
+            skt.close()
+            raise
+        self.socket = skt
+        self.fileno = skt.fileno
+        self.send = skt.send
+
+    def logPrefix(self):
+        return self.port.logPrefix()
+
+    def startReading(self):
+        self.reactor.addReader(self)
+
+    def doRead(self):
+        self.port._readFrom(self.socket)
+
+    def write(self, datagram):
+        """
+        Send C{datagram} to the peer, L{Port.write} calls C{send} directly
+        and falls back to this when it fails.
+        """
+        try:
+            return self.socket.send(datagram)
+        except socket.error, se:
+            no = se.args[0]
+            if no == EINTR:
+                return self.write(datagram)
+            elif no == EMSGSIZE:
+                raise error.MessageLengthError, "message too long"
+            elif no == ECONNREFUSED:
+                # as for an unconnected port, the peer is not there (yet)
+                return
+            else:
+                raise
+
+    def connectionLost(self, reason):
+        """
+        Stop reading and close the socket, called by the port or by the
+        reactor if reading failed.
+        """
+        if self.port._peers.get(self.addr) is self:
+            del self.port._peers[self.addr]
+        self.reactor.removeReader(self)
+        self.socket.close()
+
+
+
 class ConnectedPort(Port):
     """DEPRECATED.
 
@@ -6,10 +6,14 @@
 Tests for implementations of L{IReactorUDP} and L{IReactorMulticast}.
 """
 
+import socket
+
+from zope.interface import implements
+
 from twisted.trial import unittest, util
 
 from twisted.internet.defer import Deferred, gatherResults, maybeDeferred
-from twisted.internet import protocol, reactor, error, defer, interfaces
+from twisted.internet import protocol, reactor, error, defer, interfaces, udp
 from twisted.python import runtime
 
 
@@ -111,6 +115,30 @@ class BadClient(protocol.DatagramProtocol):
 
 
 
+class BulkServer(Mixin, protocol.DatagramProtocol):
+    """
+    A DatagramProtocol which receives its datagrams in batches.
+    """
+    implements(interfaces.IBulkDatagramProtocol)
+
+    packetsExpected = 0
+    packetsReceived = None
+
+    def __init__(self):
+        Mixin.__init__(self)
+        self.batches = []
+
+
+    def datagramsReceived(self, datagrams):
+        self.batches.append(datagrams)
+        self.packets.extend(self.batches[-1])
+        if (self.packetsReceived is not None
+            and len(self.packets) >= self.packetsExpected):
+            d, self.packetsReceived = self.packetsReceived, None
+            d.callback(None)
+
+
+
 class OldConnectedUDPTestCase(unittest.TestCase):
     def testStartStop(self):
         client = Client()
@@ -545,6 +573,176 @@ class UDPTestCase(unittest.TestCase):
         return d
 
 
+class BulkReadTestCase(unittest.TestCase):
+    """
+    Tests for the delivery of datagrams to L{IBulkDatagramProtocol}
+    providers.
+    """
+
+    def setUp(self):
+        self.server = BulkServer()
+        self.port = reactor.listenUDP(0, self.server, interface="127.0.0.1")
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+
+
+    def tearDown(self):
+        self.client.close()
+        return self.port.stopListening()
+
+
+    def sendPackets(self, packets):
+        """
+        Send C{packets} to the server, returns a L{Deferred} which fires
+        once they were all received.
+        """
+        d = self.server.packetsReceived = defer.Deferred()
+        self.server.packetsExpected = len(packets)
+        addr = (self.port.getHost().host, self.port.getHost().port)
+        for packet in packets:
+            self.client.sendto(packet, addr)
+        return d
+
+
+    def test_batch(self):
+        """
+        The datagrams pending when the port is read are handed to
+        C{datagramsReceived} together, in order, with their source address.
+        """
+        packets = ["a", "bb", "", "ccc"]
+        def cbReceived(ignored):
+            clientAddr = self.client.getsockname()
+            self.assertEquals(self.server.packets,
+                              [(packet, clientAddr) for packet in packets])
+            self.assertEquals(len(self.server.batches), 1)
+        return self.sendPackets(packets).addCallback(cbReceived)
+
+
+    def test_maxThroughput(self):
+        """
+        Reading stops once C{maxThroughput} bytes were read, the rest are
+        read by the following eventloop iterations.
+        """
+        self.port.maxThroughput = 10
+        packets = ["x" * 6, "y" * 6, "z" * 6]
+        def cbReceived(ignored):
+            self.assertEquals([data for data, addr in self.server.packets],
+                              packets)
+            self.assertEquals([len(batch) for batch in self.server.batches],
+                              [2, 1])
+        return self.sendPackets(packets).addCallback(cbReceived)
+
+
+
+class ConnectedPeerTestCase(unittest.TestCase):
+    """
+    Tests for L{Port.connectPeer} and L{Port.disconnectPeer}.
+    """
+
+    def setUp(self):
+        self.server = Server()
+        self.port = udp.Port(0, self.server, interface="127.0.0.1")
+        self.port.maxPeers = 1
+        self.port.startListening()
+        self.serverAddr = (self.port.getHost().host, self.port.getHost().port)
+        self.peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.peer.bind(("127.0.0.1", 0))
+        self.peer.settimeout(5)
+        self.peerAddr = self.peer.getsockname()
+
+
+    def tearDown(self):
+        self.peer.close()
+        return self.port.stopListening()
+
+
+    def test_write(self):
+        """
+        Datagrams written to a connected peer come from the address of the
+        port, the others are still sent.
+        """
+        other = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        other.bind(("127.0.0.1", 0))
+        other.settimeout(5)
+        self.assertEquals(self.port.connectPeer(self.peerAddr), True)
+        self.assertEquals(self.port.getPeers(), [self.peerAddr])
+        self.port.write("connected", self.peerAddr)
+        self.port.write("sendto", other.getsockname())
+        self.assertEquals(self.peer.recvfrom(100),
+                          ("connected", self.serverAddr))
+        self.assertEquals(other.recvfrom(100), ("sendto", self.serverAddr))
+        other.close()
+
+
+    def test_receive(self):
+        """
+        Datagrams from a connected peer are delivered to the protocol, with
+        the address of the peer.
+        """
+        self.port.connectPeer(self.peerAddr)
+        d = self.server.packetReceived = defer.Deferred()
+        self.peer.sendto("hello", self.serverAddr)
+        def cbReceived(ignored):
+            self.assertEquals(self.server.packets,
+                              [("hello", self.peerAddr)])
+        return d.addCallback(cbReceived)
+
+
+    def test_disconnect(self):
+        """
+        After L{Port.disconnectPeer} the peer is written to with
+        C{sendto}, and its datagrams are received by the port again.
+        """
+        self.port.connectPeer(self.peerAddr)
+        self.port.disconnectPeer(self.peerAddr)
+        self.assertEquals(self.port.getPeers(), [])
+        self.port.write("sendto", self.peerAddr)
+        self.assertEquals(self.peer.recvfrom(100),
+                          ("sendto", self.serverAddr))
+        d = self.server.packetReceived = defer.Deferred()
+        self.peer.sendto("hello", self.serverAddr)
+        def cbReceived(ignored):
+            self.assertEquals(self.server.packets,
+                              [("hello", self.peerAddr)])
+        return d.addCallback(cbReceived)
+
+
+    def test_maxPeers(self):
+        """
+        No more than C{maxPeers} peers are connected at once.
+        """
+        self.assertEquals(self.port.connectPeer(self.peerAddr), True)
+        self.assertEquals(self.port.connectPeer(self.peerAddr), True)
+        self.assertEquals(self.port.connectPeer(("127.0.0.1", 9)), False)
+        self.assertEquals(self.port.getPeers(), [self.peerAddr])
+
+
+    def test_notShared(self):
+        """
+        No peer is connected to a port which started listening before
+        C{maxPeers} was set, its socket is not bound to share its address.
+        """
+        port = reactor.listenUDP(0, Server(), interface="127.0.0.1")
+        port.maxPeers = 1
+        self.assertEquals(port.connectPeer(self.peerAddr), False)
+        self.assertEquals(port.socket.getsockopt(socket.SOL_SOCKET,
+                                                 socket.SO_REUSEADDR), 0)
+        return port.stopListening()
+
+
+    def test_stopListening(self):
+        """
+        The connected peers are closed with the port.
+        """
+        self.port.connectPeer(self.peerAddr)
+        peer = self.port._peers[self.peerAddr]
+        def cbStopped(ignored):
+            self.assertEquals(self.port.getPeers(), [])
+            self.assertRaises(socket.error, peer.socket.send, "closed")
+        return self.port.stopListening().addCallback(cbStopped)
+
+
+
 class ReactorShutdownInteraction(unittest.TestCase):
     """Test reactor shutdown interaction"""
 
@@ -4,7 +4,9 @@
 __author__ = 'Tzury Bar Yochay'
 __version__ = '0.1'
 __license__ = 'GPLv3'
-__all__ = ['Storage',]
+__all__ = ['Storage', 'Record', 'StripedLocks']
+
+import threading
 
 # tweak by anand @ webpy
 class Storage(dict):
@@ -12,4 +14,47 @@ class Storage(dict):
         self = dict.__new__(cls, *args, **kwargs)
         self.__dict__ = self
         return self
-        
\ No newline at end of file
+
+class Record(object):
+    '''an object with a fixed set of attributes, named by the __slots__ 
+    of the subclass. unlike Storage it carries no dict per instance.
+    attributes not given to the constructor are None'''
+    __slots__ = ()
+    
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError('%s has no field %s' 
+                % (self.__class__.__name__, ', '.join(kwargs)))
+                
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+        
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.__slots__))
+
+class StripedLocks(object):
+    '''a fixed number of locks shared by any number of keys, 
+    key is guarded by lock number hash(key) % stripes.
+    
+    acquire() takes the locks of several keys at once, always in the 
+    order of their numbers, so two threads can not deadlock on them. 
+    the locks are reentrant, a thread may acquire keys it already holds'''
+    def __init__(self, stripes=64):
+        self.locks = [threading.RLock() for i in xrange(stripes)]
+        
+    def stripes(self, keys):
+        return sorted(set(hash(key) % len(self.locks) for key in keys))
+        
+    def acquire(self, keys):
+        '''returns what release() takes'''
+        stripes = self.stripes(keys)
+        for stripe in stripes:
+            self.locks[stripe].acquire()
+        return stripes
+        
+    def release(self, stripes):
+        for stripe in reversed(stripes):
+            self.locks[stripe].release()
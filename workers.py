@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+__author__ = 'Tzury Bar Yochay'
+__version__ = '0.1'
+__license__ = 'GPLv3'
+
+'''
+**************************************
+workers.py (part of freespeech.py)
+**************************************
+
+several processes serving the same udp ports.
+
+every worker binds the udp listeners with SO_REUSEPORT so the kernel
+spreads the incoming datagrams between them. worker 0 is the main
+process, it owns the ctx_table and handles all signaling (an invite
+spans two client contexts, they can not be split between processes).
+workers 1..N-1 relay the media of the calls worker 0 publishes to them
+and hand anything else over to worker 0.
+
+worker 0 and every media worker talk over a unix datagram socketpair,
+the worker inherits its end (no path in the filesystem, no other
+process can reach it):
+    F  worker -> 0   a datagram the worker could not handle
+    H  worker -> 0   a worker started, send it all the routes
+    T  worker -> 0   (client_ctx, call_ctx) pairs with media since last T
+    R  0 -> worker   route of a call, both parties ctx and address
+    D  0 -> worker   a call has ended
+'''
+
+__all__ = ['ReusePort', 'Master', 'Worker', 'run_worker', 'ChannelPort']
+
+import os, sys, socket, struct, subprocess
+
+from twisted.internet import reactor, udp, unix
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.interfaces import IBulkDatagramProtocol
+from twisted.internet.task import LoopingCall
+from zope.interface import implements
+
+import config
+import session
+from messages import ClientRTP, rtp_route
+from logger import log
+
+# kind, client ip, client port, listener port. the datagram follows
+FORWARD = struct.Struct('!c4sHH')
+# kind, worker index
+HELLO = struct.Struct('!cB')
+# kind, call_ctx, caller_ctx, caller ip, caller port, callee ...
+ROUTE = struct.Struct('!ci' + 'i4sH' * 2)
+# kind, call_ctx
+DROP = struct.Struct('!ci')
+# a touched (client_ctx, call_ctx) pair, follows the kind byte
+TOUCH = struct.Struct('!ii')
+# keep the touch reports well below the datagram size of the channel
+TOUCHES_PER_REPORT = 512
+
+# SO_REUSEPORT is missing from the socket module of older pythons
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+class ReusePort(udp.Port):
+    '''an udp port which shares its address with the same port of
+    the other workers'''
+    def createInternetSocket(self):
+        skt = udp.Port.createInternetSocket(self)
+        skt.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return skt
+
+class Channel(DatagramProtocol):
+    '''receiving end of the unix socket of a worker'''
+    def __init__(self, handler):
+        self.handler = handler
+
+    def datagramReceived(self, envelope, addr):
+        try:
+            self.handler(envelope)
+        except:
+            log.exception('exception')
+
+class ChannelPort(unix.DatagramPort):
+    '''a unix datagram port on an end of a socketpair, bound to no path'''
+    def __init__(self, skt, proto, maxPacketSize=65536, reactor=None):
+        unix.DatagramPort.__init__(self, None, proto, maxPacketSize,
+            reactor=reactor)
+        self.channel = skt
+
+    def _bindSocket(self):
+        self.channel.setblocking(0)
+        self.connected = 1
+        self.socket = self.channel
+        self.fileno = self.channel.fileno
+
+def listen_channel(skt, handler):
+    return reactor.listenWith(ChannelPort, skt, Channel(handler))
+
+class Sender(object):
+    '''sending end, the channel of every worker by index.
+    safe to use from any thread'''
+    def __init__(self, channels=None):
+        self.channels = channels or dict()
+
+    def send(self, index, envelope):
+        try:
+            self.channels[index].send(envelope)
+            return True
+        except (socket.error, KeyError), e:
+            log.warning('worker %d is not reachable (%s)' % (index, e))
+            return False
+
+class Master(object):
+    '''worker 0, spawns the media workers and keeps them updated
+    with the routes of the calls in the session table'''
+    def __init__(self, num_of_workers):
+        self.session = session
+        self.num_of_workers = num_of_workers
+        self.sender = Sender()
+        self.processes = []
+        self.handlers = {
+            'F': self.forwarded,
+            'H': self.hello,
+            'T': self.touched }
+
+    def start(self):
+        if self.num_of_workers < 2:
+            return
+        self.session.ctx_table.observers.append(self.publish)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'server.py')
+        for index in xrange(1, self.num_of_workers):
+            ours, theirs = socket.socketpair(socket.AF_UNIX,
+                socket.SOCK_DGRAM)
+            self.sender.channels[index] = ours
+            listen_channel(ours, self.dispatch)
+            # the worker inherits its end
+            self.processes.append(subprocess.Popen([sys.executable, script,
+                'worker', str(index), str(theirs.fileno())]))
+            theirs.close()
+        log.info('started %d media workers' % len(self.processes))
+
+    def stop(self):
+        for process in self.processes:
+            try:
+                process.terminate()
+                process.wait()
+            except OSError:
+                pass
+        self.processes = []
+
+    def dispatch(self, envelope):
+        self.handlers[envelope[0]](envelope)
+
+    def listener(self, port):
+        '''the local udp listener bound to port'''
+        for entry in self.session.servers_pool.values():
+            if entry.proto == 'udp' \
+                and entry.server.transport.getHost().port == port:
+                return entry.server
+
+    def forwarded(self, envelope):
+        kind, ip, port, listener_port = FORWARD.unpack_from(envelope)
+        listener = self.listener(listener_port)
+        if listener:
+            # as if it was received here
+            listener.datagramReceived(envelope[FORWARD.size:],
+                (socket.inet_ntoa(ip), port))
+
+    def hello(self, envelope):
+        kind, index = HELLO.unpack(envelope)
+        log.info('media worker %d is up' % index)
+        for call in self.session.ctx_table.active_calls.values():
+            self.sender.send(index, self.route_of(call))
+
+    def touched(self, envelope):
+        touch_client = self.session.touch_client
+        find_call = self.session.ctx_table.find_call
+        for offset in xrange(1, len(envelope), TOUCH.size):
+            client_ctx, call_ctx = TOUCH.unpack_from(envelope, offset)
+            touch_client(client_ctx, ClientRTP, find_call(call_ctx))
+
+    def _udp_addr(self, client_ctx):
+        '''address of client if it is reached over udp, None otherwise'''
+        addr = self.session.ctx_table.get_addr(client_ctx)
+        route = addr and self.session.servers_pool.known_address(addr)
+        if route and isinstance(route[0], DatagramProtocol):
+            return addr
+
+    def route_of(self, call):
+        '''R envelope of call, or D if media can not bypass worker 0'''
+        if self.session.rtp_table(call, call.caller_ctx):
+            # converted on the relay path of worker 0
+            return DROP.pack('D', call.ctx_id)
+        parties = []
+        for client_ctx in (call.caller_ctx, call.callee_ctx):
+            addr = self._udp_addr(client_ctx)
+            if not addr:
+                return DROP.pack('D', call.ctx_id)
+            parties += [client_ctx, socket.inet_aton(addr[0]), addr[1]]
+        return ROUTE.pack('R', call.ctx_id, *parties)
+
+    def publish(self, event, call):
+        '''ctx_table observer'''
+        if event == 'route':
+            envelope = self.route_of(call)
+        else:
+            envelope = DROP.pack('D', call.ctx_id)
+        for index in xrange(1, self.num_of_workers):
+            self.sender.send(index, envelope)
+
+class MediaListener(DatagramProtocol):
+    implements(IBulkDatagramProtocol)
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def datagramReceived(self, data, (host, port)):
+        if not self.worker.relay(self.transport, data):
+            self.worker.forward(self.transport.getHost().port, data,
+                (host, port))
+
+    def datagramsReceived(self, datagrams):
+        '''all the datagrams read by the port in one reactor iteration'''
+        relay = self.worker.relay
+        for data, (host, port) in datagrams:
+            if not relay(self.transport, data):
+                self.worker.forward(self.transport.getHost().port,
+                    data, (host, port))
+
+class Worker(object):
+    '''a media worker, relays the rtp of the calls published by worker 0'''
+    def __init__(self, index, channel):
+        self.index = index
+        self.channel = channel
+        self.sender = Sender({0: channel})
+        # call_ctx -> {client_ctx: address of the other party}
+        self.routes = dict()
+        # client_ctx -> call_ctx, media seen since the last report
+        self.touches = dict()
+        self.parent = os.getppid()
+        self.handlers = {
+            'R': self.route,
+            'D': self.drop }
+
+    def dispatch(self, envelope):
+        self.handlers[envelope[0]](envelope)
+
+    def route(self, envelope):
+        (kind, call_ctx, caller_ctx, caller_ip, caller_port,
+            callee_ctx, callee_ip, callee_port) = ROUTE.unpack(envelope)
+        self.routes[call_ctx] = {
+            caller_ctx: (socket.inet_ntoa(callee_ip), callee_port),
+            callee_ctx: (socket.inet_ntoa(caller_ip), caller_port) }
+
+    def drop(self, envelope):
+        kind, call_ctx = DROP.unpack(envelope)
+        self.routes.pop(call_ctx, None)
+
+    def relay(self, transport, data):
+        '''sends rtp of a known call to the other party, returns True.
+        False for anything else'''
+        route = rtp_route(data)
+        if not route:
+            return False
+        client_ctx, call_ctx = route
+        other_addr = self.routes.get(call_ctx, {}).get(client_ctx)
+        if not other_addr:
+            return False
+        transport.write(data, other_addr)
+        self.touches[client_ctx] = call_ctx
+        return True
+
+    def forward(self, listener_port, data, (host, port)):
+        self.sender.send(0, FORWARD.pack('F', socket.inet_aton(host),
+            port, listener_port) + data)
+
+    def hello(self):
+        self.sender.send(0, HELLO.pack('H', self.index))
+
+    def report(self):
+        '''tells worker 0 which clients had media, so it keeps their
+        contexts and calls alive. stops the worker if the main process
+        has gone'''
+        try:
+            if os.getppid() != self.parent:
+                log.warning('media worker %d lost its main process'
+                    % self.index)
+                reactor.stop()
+                return
+            touches, self.touches = self.touches.items(), dict()
+            for i in xrange(0, len(touches), TOUCHES_PER_REPORT):
+                self.sender.send(0, 'T' + ''.join(TOUCH.pack(*pair)
+                    for pair in touches[i:i + TOUCHES_PER_REPORT]))
+        except:
+            log.exception('exception')
+
+def run_worker(index, fd, listeners=config.Listeners):
+    '''entry point of a media worker process, fd is its end of the
+    channel to worker 0'''
+    channel = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_DGRAM)
+    os.close(fd)
+    worker = Worker(index, channel)
+    listen_channel(channel, worker.dispatch)
+    for proto, port in listeners:
+        if proto == 'udp':
+            reactor.listenWith(ReusePort, port, MediaListener(worker))
+            log.info('media worker %d serving udp on port %s' % (index, port))
+    LoopingCall(worker.report).start(config.EXPIRY_TICK, now=False)
+    worker.hello()
+    reactor.run()